@@ -12,6 +12,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import re
+
 from six import text_type
 
 import jsonschema
@@ -23,6 +25,8 @@ from twisted.internet import defer
 from synapse.api.errors import SynapseError
 from synapse.storage.presence import UserPresenceState
 from synapse.types import RoomID, UserID
+from synapse.util.caches import CACHE_SIZE_FACTOR
+from synapse.util.caches.expiringcache import ExpiringCache
 
 FILTER_SCHEMA = {
     "additionalProperties": False,
@@ -195,16 +199,36 @@ def matrix_user_id_validator(user_id_str):
     return UserID.from_string(user_id_str)
 
 
+# How long to keep compiled FilterCollections for stored filters around after
+# they were last used.
+FILTER_COLLECTION_CACHE_EXPIRY_MS = 30 * 60 * 1000
+
+
 class Filtering(object):
 
     def __init__(self, hs):
         super(Filtering, self).__init__()
         self.store = hs.get_datastore()
 
+        # Stored filters can't be changed, so we keep the compiled
+        # FilterCollection for each (user_localpart, filter_id) rather than
+        # rebuilding it on every sync.
+        self._filter_collection_cache = ExpiringCache(
+            "filter_collection_cache", hs.get_clock(),
+            max_len=int(CACHE_SIZE_FACTOR * 10000),
+            expiry_ms=FILTER_COLLECTION_CACHE_EXPIRY_MS,
+            reset_expiry_on_get=True,
+        )
+
     @defer.inlineCallbacks
     def get_user_filter(self, user_localpart, filter_id):
-        result = yield self.store.get_user_filter(user_localpart, filter_id)
-        defer.returnValue(FilterCollection(result))
+        cache_key = (user_localpart, filter_id)
+        filter_collection = self._filter_collection_cache.get(cache_key)
+        if filter_collection is None:
+            result = yield self.store.get_user_filter(user_localpart, filter_id)
+            filter_collection = FilterCollection(result)
+            self._filter_collection_cache[cache_key] = filter_collection
+        defer.returnValue(filter_collection)
 
     def add_user_filter(self, user_localpart, user_filter):
         self.check_valid_filter(user_filter)
@@ -240,15 +264,26 @@ class FilterCollection(object):
 
         room_filter_json = self._filter_json.get("room", {})
 
-        self._room_filter = Filter({
+        # The top-level "rooms" and "not_rooms" apply to all of the room
+        # filters, so we fold them into each of those filters up front rather
+        # than checking every event against two filters.
+        room_filter = {
             k: v for k, v in room_filter_json.items()
             if k in ("rooms", "not_rooms")
-        })
+        }
 
-        self._room_timeline_filter = Filter(room_filter_json.get("timeline", {}))
-        self._room_state_filter = Filter(room_filter_json.get("state", {}))
-        self._room_ephemeral_filter = Filter(room_filter_json.get("ephemeral", {}))
-        self._room_account_data = Filter(room_filter_json.get("account_data", {}))
+        self._room_timeline_filter = Filter(_merge_room_filters(
+            room_filter, room_filter_json.get("timeline", {}),
+        ))
+        self._room_state_filter = Filter(_merge_room_filters(
+            room_filter, room_filter_json.get("state", {}),
+        ))
+        self._room_ephemeral_filter = Filter(_merge_room_filters(
+            room_filter, room_filter_json.get("ephemeral", {}),
+        ))
+        self._room_account_data = Filter(_merge_room_filters(
+            room_filter, room_filter_json.get("account_data", {}),
+        ))
         self._presence_filter = Filter(filter_json.get("presence", {}))
         self._account_data = Filter(filter_json.get("account_data", {}))
 
@@ -264,6 +299,13 @@ class FilterCollection(object):
     def get_filter_json(self):
         return self._filter_json
 
+    def room_timeline_filter(self):
+        """Returns the Filter to apply to room timelines (including the
+        top-level room restrictions), which may be used to filter events in
+        the database (see `filter_to_clause`).
+        """
+        return self._room_timeline_filter
+
     def timeline_limit(self):
         return self._room_timeline_filter.limit()
 
@@ -286,16 +328,16 @@ class FilterCollection(object):
         return self._account_data.filter(events)
 
     def filter_room_state(self, events):
-        return self._room_state_filter.filter(self._room_filter.filter(events))
+        return self._room_state_filter.filter(events)
 
     def filter_room_timeline(self, events):
-        return self._room_timeline_filter.filter(self._room_filter.filter(events))
+        return self._room_timeline_filter.filter(events)
 
     def filter_room_ephemeral(self, events):
-        return self._room_ephemeral_filter.filter(self._room_filter.filter(events))
+        return self._room_ephemeral_filter.filter(events)
 
     def filter_room_account_data(self, events):
-        return self._room_account_data.filter(self._room_filter.filter(events))
+        return self._room_account_data.filter(events)
 
     def blocks_all_presence(self):
         return (
@@ -333,6 +375,15 @@ class Filter(object):
 
         self.contains_url = self.filter_json.get("contains_url", None)
 
+        # Compiled forms of the above, so that checking an event is a handful
+        # of set lookups and regex matches.
+        self._rooms = _compile_literals(self.rooms)
+        self._not_rooms = _compile_literals(self.not_rooms)
+        self._senders = _compile_literals(self.senders)
+        self._not_senders = _compile_literals(self.not_senders)
+        self._types = _compile_wildcards(self.types)
+        self._not_types = _compile_wildcards(self.not_types)
+
     def filters_all_types(self):
         return "*" in self.not_types
 
@@ -388,26 +439,24 @@ class Filter(object):
         Returns:
             bool: True if the event fields match
         """
-        literal_keys = {
-            "rooms": lambda v: room_id == v,
-            "senders": lambda v: sender == v,
-            "types": lambda v: _matches_wildcard(event_type, v)
-        }
-
-        for name, match_func in literal_keys.items():
-            not_name = "not_%s" % (name,)
-            disallowed_values = getattr(self, not_name)
-            if any(map(match_func, disallowed_values)):
+        if room_id in self._not_rooms:
+            return False
+        if self._rooms is not None and room_id not in self._rooms:
+            return False
+
+        if sender in self._not_senders:
+            return False
+        if self._senders is not None and sender not in self._senders:
+            return False
+
+        if _matches_compiled_wildcards(event_type, self._not_types):
+            return False
+        if self._types is not None:
+            if not _matches_compiled_wildcards(event_type, self._types):
                 return False
 
-            allowed_values = getattr(self, name)
-            if allowed_values is not None:
-                if not any(map(match_func, allowed_values)):
-                    return False
-
-        contains_url_filter = self.filter_json.get("contains_url")
-        if contains_url_filter is not None:
-            if contains_url_filter != contains_url:
+        if self.contains_url is not None:
+            if self.contains_url != contains_url:
                 return False
 
         return True
@@ -454,17 +503,101 @@ class Filter(object):
             filter: A new filter including the given rooms and the old
                     filter's rooms.
         """
-        newFilter = Filter(self.filter_json)
-        newFilter.rooms += room_ids
-        return newFilter
+        filter_json = dict(self.filter_json)
+        filter_json["rooms"] = list(self.rooms or []) + list(room_ids)
+        return Filter(filter_json)
+
+
+def _compile_literals(values):
+    """Compiles a list of allowed or disallowed values from a filter into a
+    set for fast lookups.
 
+    Args:
+        values (list[str]|None)
+
+    Returns:
+        frozenset[str]|None: None if `values` is None.
+    """
+    if values is None:
+        return None
+    return frozenset(values)
+
+
+def _compile_wildcards(values):
+    """Compiles a list of filter values, any of which may end in a "*"
+    wildcard, into a set of literal values and a single regex matching all
+    of the wildcard prefixes.
+
+    Args:
+        values (list[str]|None)
+
+    Returns:
+        tuple[frozenset[str], re.RegexObject|None]|None: None if `values` is
+        None. Otherwise the literal values, plus a regex to match against the
+        start of a value (or None if there were no wildcards).
+    """
+    if values is None:
+        return None
+
+    literals = frozenset(v for v in values if not v.endswith("*"))
+    prefixes = [v[:-1] for v in values if v.endswith("*")]
+
+    regex = None
+    if prefixes:
+        regex = re.compile("|".join(re.escape(p) for p in prefixes))
+
+    return literals, regex
+
+
+def _matches_compiled_wildcards(actual_value, compiled):
+    """Checks whether a value matches the output of `_compile_wildcards`.
+
+    Args:
+        actual_value (str|None)
+        compiled (tuple[frozenset[str], re.RegexObject|None])
+
+    Returns:
+        bool
+    """
+    literals, regex = compiled
+    if actual_value in literals:
+        return True
+    if regex is not None and actual_value is not None:
+        return regex.match(actual_value) is not None
+    return False
+
+
+def _merge_room_filters(room_filter_json, filter_json):
+    """Combines the top-level "rooms" and "not_rooms" of a room filter with
+    one of its sub-filters (e.g. "timeline"), such that an event matches the
+    result iff it matches both.
+
+    Args:
+        room_filter_json (dict): the "rooms"/"not_rooms" of the room filter.
+        filter_json (dict): the sub-filter.
+
+    Returns:
+        dict: the definition of the combined filter.
+    """
+    if not room_filter_json:
+        return filter_json
+
+    filter_json = dict(filter_json)
+
+    rooms = room_filter_json.get("rooms")
+    if rooms is not None:
+        if filter_json.get("rooms") is not None:
+            allowed = set(filter_json["rooms"])
+            rooms = [room_id for room_id in rooms if room_id in allowed]
+        filter_json["rooms"] = rooms
+
+    not_rooms = room_filter_json.get("not_rooms")
+    if not_rooms:
+        filter_json["not_rooms"] = (
+            list(filter_json.get("not_rooms", [])) + list(not_rooms)
+        )
 
-def _matches_wildcard(actual_value, filter_value):
-    if filter_value.endswith("*"):
-        type_prefix = filter_value[:-1]
-        return actual_value.startswith(type_prefix)
-    else:
-        return actual_value == filter_value
+    return filter_json
 
 
 DEFAULT_FILTER_COLLECTION = FilterCollection({})
@@ -38,7 +38,7 @@ from synapse.replication.slave.storage.receipts import SlavedReceiptsStore
 from synapse.replication.slave.storage.registration import SlavedRegistrationStore
 from synapse.replication.slave.storage.transactions import SlavedTransactionStore
 from synapse.replication.tcp.client import ReplicationClientHandler
-from synapse.replication.tcp.streams import ReceiptsStream
+from synapse.replication.tcp.streams import CurrentStateDeltaStream, ReceiptsStream
 from synapse.server import HomeServer
 from synapse.storage.engines import create_engine
 from synapse.types import ReadReceipt
@@ -66,17 +66,19 @@ class FederationSenderSlaveStore(
 
     def _get_federation_out_pos(self, db_conn):
         sql = (
-            "SELECT stream_id FROM federation_stream_position"
+            "SELECT shard_index, stream_id FROM federation_stream_position"
             " WHERE type = ?"
         )
         sql = self.database_engine.convert_param_style(sql)
 
         txn = db_conn.cursor()
         txn.execute(sql, ("federation",))
-        rows = txn.fetchall()
+        positions = dict(txn.fetchall())
         txn.close()
 
-        return rows[0][0] if rows else -1
+        # a new shard starts off from where the first shard has got to
+        shard_index = self.hs.config.worker_federation_sender_shard_index
+        return positions.get(shard_index, positions.get(0, -1))
 
 
 class FederationSenderServer(HomeServer):
@@ -207,8 +209,11 @@ class FederationSenderHandler(object):
         self.store = hs.get_datastore()
         self._is_mine_id = hs.is_mine_id
         self.federation_sender = hs.get_federation_sender()
+        self.presence_audience = hs.get_presence_audience()
         self.replication_client = replication_client
 
+        self._shard_index = hs.config.worker_federation_sender_shard_index
+
         self.federation_position = self.store.federation_out_pos_startup
         self._fed_position_linearizer = Linearizer(name="_fed_position_linearizer")
 
@@ -225,7 +230,10 @@ class FederationSenderHandler(object):
         )
 
     def stream_positions(self):
-        return {"federation": self.federation_position}
+        return {
+            "federation": self.federation_position,
+            CurrentStateDeltaStream.NAME: self.presence_audience.get_current_token(),
+        }
 
     def process_replication_rows(self, stream_name, token, rows):
         # The federation stream contains things that we want to send out, e.g.
@@ -238,6 +246,10 @@ class FederationSenderHandler(object):
         elif stream_name == "events":
             self.federation_sender.notify_new_events(token)
 
+        # ... and keep track of who should get our users' presence
+        elif stream_name == CurrentStateDeltaStream.NAME:
+            self.presence_audience.process_replication_rows(token, rows)
+
         # ... and when new receipts happen
         elif stream_name == ReceiptsStream.NAME:
             run_as_background_process(
@@ -273,12 +285,15 @@ class FederationSenderHandler(object):
             with (yield self._fed_position_linearizer.queue(None)):
                 if self._last_ack < self.federation_position:
                     yield self.store.update_federation_out_pos(
-                        "federation", self.federation_position
+                        "federation", self.federation_position,
+                        shard_index=self._shard_index,
                     )
 
                     # We ACK this token over replication so that the master can drop
                     # its in memory queues
-                    self.replication_client.send_federation_ack(self.federation_position)
+                    self.replication_client.send_federation_ack(
+                        self.federation_position, self._shard_index,
+                    )
                     self._last_ack = self.federation_position
         except Exception:
             logger.exception("Error updating federation stream position")
@@ -82,6 +82,12 @@ class PusherServer(HomeServer):
     DATASTORE_CLASS = PusherSlaveStore
 
     def remove_pusher(self, app_id, push_key, user_id):
+        # Only the worker running the pusher should be asking for its removal
+        if not self.get_pusherpool().is_pusher_shard_for_user(user_id):
+            logger.warn(
+                "Not removing pusher for %s, which is not in our shard", user_id,
+            )
+            return
         self.get_tcp_replication().send_remove_pusher(app_id, push_key, user_id)
 
     def _listen_http(self, listener_config):
@@ -156,6 +162,10 @@ class PusherReplicationHandler(ReplicationClientHandler):
         try:
             if stream_name == "pushers":
                 for row in rows:
+                    if not self.pusher_pool.is_pusher_shard_for_user(row.user_id):
+                        # another pusher worker is responsible for this pusher
+                        continue
+
                     if row.deleted:
                         yield self.stop_pusher(row.user_id, row.app_id, row.pushkey)
                     else:
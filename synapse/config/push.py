@@ -22,6 +22,26 @@ class PushConfig(Config):
         push_config = config.get("push", {})
         self.push_include_content = push_config.get("include_content", True)
 
+        # If set, rotate this many push actions into event_push_summary at a
+        # time, every push_notif_rotation_interval_ms, rather than rotating
+        # everything every half an hour.
+        self.push_notif_rotation_chunk_size = push_config.get(
+            "notif_rotation_chunk_size", 0,
+        )
+        self.push_notif_rotation_interval_ms = self.parse_duration(
+            push_config.get("notif_rotation_interval", "10s"),
+        )
+
+        # The maximum number of concurrent requests to each push gateway, and
+        # the window within which to coalesce notifications for a gateway into
+        # a single request (0 to disable coalescing)
+        self.push_gateway_max_concurrent_requests = push_config.get(
+            "gateway_max_concurrent_requests", 50,
+        )
+        self.push_gateway_batch_window_ms = push_config.get(
+            "gateway_batch_window_ms", 0,
+        )
+
         # There was a a 'redact_content' setting but mistakenly read from the
         # 'email'section'. Check for the flag in the 'push' section, and log,
         # but do not honour it to avoid nasty surprises when people upgrade.
@@ -58,4 +78,33 @@ class PushConfig(Config):
         #
         #push:
         #  include_content: true
+        #
+        #  # Notifications older than a day are periodically rotated from the
+        #  # per-event event_push_actions table into per-room totals in
+        #  # event_push_summary. By default this is done every half an hour, in
+        #  # batches of up to 10000 push actions until it has caught up, which
+        #  # can cause spikes of database load on busy servers.
+        #  #
+        #  # Setting `notif_rotation_chunk_size` instead rotates up to that many
+        #  # push actions every `notif_rotation_interval`, spreading the work
+        #  # out evenly. The chunk size must be big enough to keep up with the
+        #  # rate of new notifications: the `synapse_push_notif_rotation_lag`
+        #  # metric shows how far behind the rotation is.
+        #  #
+        #  notif_rotation_chunk_size: 500
+        #  notif_rotation_interval: 10s
+        #
+        #  # The maximum number of concurrent requests to make to each push
+        #  # gateway. Further notifications for the gateway are queued until
+        #  # an earlier request completes. Defaults to 50.
+        #  #
+        #  gateway_max_concurrent_requests: 50
+        #
+        #  # If set, notifications for the same push gateway which are the same
+        #  # apart from the devices they are for (for instance the same event
+        #  # pushed to several devices) are coalesced into a single request to
+        #  # the gateway if they are sent within this many milliseconds of each
+        #  # other. Defaults to 0, which sends each notification separately.
+        #  #
+        #  gateway_batch_window_ms: 50
         """
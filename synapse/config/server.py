@@ -78,6 +78,15 @@ class ServerConfig(Config):
 
         self.filter_timeline_limit = config.get("filter_timeline_limit", -1)
 
+        # How long the notifier may wait to coalesce wakeups of the clients
+        # listening for new events, and how many to wake per reactor iteration.
+        self.notifier_wakeup_coalesce_ms = config.get(
+            "notifier_wakeup_coalesce_ms", 0,
+        )
+        self.notifier_wakeup_batch_size = config.get(
+            "notifier_wakeup_batch_size", 1000,
+        )
+
         # Whether we should block invites sent to users on this server
         # (other than those sent by local server admins)
         self.block_non_admin_invites = config.get(
@@ -121,6 +130,30 @@ class ServerConfig(Config):
             for domain in federation_domain_whitelist:
                 self.federation_domain_whitelist[domain] = True
 
+        # The maximum number of transactions which may be in flight to a remote
+        # server at once, if it is responding to them quickly. See
+        # PerDestinationQueue.
+        self.federation_transaction_max_in_flight = config.get(
+            "federation_transaction_max_in_flight", 1,
+        )
+        if self.federation_transaction_max_in_flight < 1:
+            raise ConfigError(
+                "federation_transaction_max_in_flight must be at least 1",
+            )
+
+        # Limits on the idle connections kept open to remote servers for reuse
+        # by later federation requests. See MatrixFederationAgent.
+        self.federation_max_idle_connections_per_host = config.get(
+            "federation_max_idle_connections_per_host", 5,
+        )
+        self.federation_idle_connection_timeout_ms = config.get(
+            "federation_idle_connection_timeout_ms", 2 * 60 * 1000,
+        )
+
+        # Whether to complete joins to remote rooms before the rest of the
+        # room state has been persisted. See FederationHandler.do_invite_join.
+        self.partial_state_joins = config.get("partial_state_joins", False)
+
         if self.public_baseurl is not None:
             if self.public_baseurl[-1] != '/':
                 self.public_baseurl += '/'
@@ -327,6 +360,20 @@ class ServerConfig(Config):
         #
         #filter_timeline_limit: 5000
 
+        # If set, clients waiting for new events (e.g. in /sync) are woken up
+        # at most once per this many milliseconds, rather than after every
+        # event. Wakeups are then spread over several reactor iterations (see
+        # notifier_wakeup_batch_size), which avoids stalling the reactor when
+        # an event is sent in a room with many members. The default is 0,
+        # which wakes clients up immediately.
+        #
+        #notifier_wakeup_coalesce_ms: 50
+
+        # When coalescing wakeups, the maximum number of client streams to wake
+        # up per reactor iteration.
+        #
+        #notifier_wakeup_batch_size: 1000
+
         # Whether room invites to users on this server should be blocked
         # (except those sent by local server admins). The default is False.
         #
@@ -350,6 +397,36 @@ class ServerConfig(Config):
         #  - nyc.example.com
         #  - syd.example.com
 
+        # The maximum number of transactions which may be in flight to a single
+        # remote server at once. Extra transactions are only sent to servers
+        # which are responding quickly, and can help keep up with busy servers
+        # over high latency links. Defaults to 1, which sends transactions to
+        # each server one at a time.
+        #
+        #federation_transaction_max_in_flight: 4
+
+        # Connections made to remote servers for federation are kept open after
+        # a request has finished, so that later requests to the same server
+        # don't have to set up a new connection. These options limit the number
+        # of idle connections kept open to each server (defaults to 5), and how
+        # long they are kept open for, in milliseconds (defaults to 2 minutes).
+        #
+        #federation_max_idle_connections_per_host: 10
+        #federation_idle_connection_timeout_ms: 600000
+
+        # When joining a room over federation, finish the join once the state
+        # that clients need to display the room (its name, topic, power levels,
+        # etc.) has been stored, and store the rest of the state (mostly the
+        # room's members) in the background. This makes joining rooms with lots
+        # of members much faster.
+        #
+        # Until the rest of the state has been stored, local users can't send
+        # events to the room other than to leave it, and events received from
+        # other servers are queued. If the rest of the state can't be fetched
+        # within a day, the local users leave the room again. Defaults to False.
+        #
+        #partial_state_joins: true
+
         # List of ports that Synapse should listen on, their purpose and their
         # configuration.
         #
@@ -372,6 +449,11 @@ class ServerConfig(Config):
         #       X-Forwarded-For header as the client IP. Useful when Synapse is
         #       behind a reverse-proxy.
         #
+        #   log_phase_breakdown: Only valid for an 'http' listener. Set to true to
+        #       add a line to the access log for each request, breaking down the
+        #       time and database activity spent in each phase of processing it
+        #       (e.g. the different parts of a /sync).
+        #
         #   resources: Only valid for an 'http' listener. A list of resources to host
         #       on this port. Options for each resource are:
         #
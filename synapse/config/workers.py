@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from ._base import Config
+from ._base import Config, ConfigError
 
 
 class WorkerConfig(Config):
@@ -45,9 +45,34 @@ class WorkerConfig(Config):
 
         self.worker_name = config.get("worker_name", self.worker_app)
 
+        # Federation readers stage the PDUs they receive in the database under
+        # their name, and process the ones staged under it (including after a
+        # restart), so they mustn't share a name with the main process. (Only
+        # one federation_reader may handle /send, so the others don't stage
+        # anything, and it doesn't matter if they share a name.)
+        if (
+            self.worker_app == "synapse.app.federation_reader" and
+            self.worker_name == "master"
+        ):
+            raise ConfigError("worker_name must not be 'master'")
+
         self.worker_main_http_uri = config.get("worker_main_http_uri", None)
         self.worker_cpu_affinity = config.get("worker_cpu_affinity")
 
+        # The pushers can be split between several pusher workers, each of
+        # which runs the pushers for the users which hash to its shard.
+        self.worker_pusher_shard_count, self.worker_pusher_shard_index = (
+            _read_shard_config(config, "worker_pusher")
+        )
+
+        # Similarly, outgoing federation can be split between several
+        # federation senders, each of which sends to the destinations which hash
+        # to its shard.
+        (
+            self.worker_federation_sender_shard_count,
+            self.worker_federation_sender_shard_index,
+        ) = _read_shard_config(config, "worker_federation_sender")
+
         # This option is really only here to support `--manhole` command line
         # argument.
         manhole = config.get("worker_manhole")
@@ -83,3 +108,22 @@ class WorkerConfig(Config):
             self.worker_log_file = args.log_file
         if args.manhole is not None:
             self.worker_manhole = args.worker_manhole
+
+
+def _read_shard_config(config, prefix):
+    """Read the `<prefix>_shard_count` and `<prefix>_shard_index` options.
+
+    Returns:
+        tuple[int, int]: the shard count and index
+    """
+    shard_count = config.get(prefix + "_shard_count", 1)
+    shard_index = config.get(prefix + "_shard_index", 0)
+    if shard_count < 1:
+        raise ConfigError("%s_shard_count must be at least 1" % (prefix,))
+    if not 0 <= shard_index < shard_count:
+        raise ConfigError(
+            "%s_shard_index must be between 0 and %s_shard_count - 1" % (
+                prefix, prefix,
+            )
+        )
+    return shard_count, shard_index
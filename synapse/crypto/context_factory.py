@@ -15,6 +15,7 @@
 
 import logging
 
+from prometheus_client import Counter
 from zope.interface import implementer
 
 from OpenSSL import SSL, crypto
@@ -24,8 +25,19 @@ from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 from twisted.internet.ssl import CertificateOptions, ContextFactory
 from twisted.python.failure import Failure
 
+from synapse.util.caches.lrucache import LruCache
+
+# The maximum number of servers to remember a TLS session for, so that later
+# connections to them can resume it rather than doing a full handshake.
+TLS_SESSION_CACHE_SIZE = 1000
+
 logger = logging.getLogger(__name__)
 
+tls_session_resumption_counter = Counter(
+    "synapse_http_federation_tls_session_resumptions",
+    "Number of outbound TLS connections which tried to resume a previous session",
+)
+
 
 class ServerContextFactory(ContextFactory):
     """Factory for PyOpenSSL SSL contexts that are used to handle incoming
@@ -94,11 +106,21 @@ class ClientTLSOptions(object):
     """
     Client creator for TLS without certificate identity verification. This is a
     copy of twisted.internet._sslverify.ClientTLSOptions with the identity
-    verification left out. For documentation, see the twisted documentation.
+    verification left out, and with TLS session resumption added. For
+    documentation, see the twisted documentation.
+
+    Args:
+        hostname (unicode)
+        ctx (OpenSSL.SSL.Context)
+        session_cache (LruCache|None): cache of the last TLS session for each
+            hostname, which new connections will try to resume. None to disable
+            session resumption.
     """
 
-    def __init__(self, hostname, ctx):
+    def __init__(self, hostname, ctx, session_cache=None):
         self._ctx = ctx
+        self._hostname = hostname
+        self._session_cache = session_cache
 
         if isIPAddress(hostname) or isIPv6Address(hostname):
             self._hostnameBytes = hostname.encode('ascii')
@@ -113,6 +135,13 @@ class ClientTLSOptions(object):
         context = self._ctx
         connection = SSL.Connection(context, None)
         connection.set_app_data(tlsProtocol)
+
+        if self._session_cache is not None:
+            session = self._session_cache.get(self._hostname)
+            if session is not None:
+                tls_session_resumption_counter.inc()
+                connection.set_session(session)
+
         return connection
 
     def _identityVerifyingInfoCallback(self, connection, where, ret):
@@ -121,6 +150,13 @@ class ClientTLSOptions(object):
         if where & SSL.SSL_CB_HANDSHAKE_START and self._sendSNI:
             connection.set_tlsext_host_name(self._hostnameBytes)
 
+        # With TLS 1.3 the session tickets arrive after the handshake, which
+        # also triggers SSL_CB_HANDSHAKE_DONE, so we pick them up here too.
+        if where & SSL.SSL_CB_HANDSHAKE_DONE and self._session_cache is not None:
+            session = connection.get_session()
+            if session is not None:
+                self._session_cache.set(self._hostname, session)
+
 
 class ClientTLSOptionsFactory(object):
     """Factory for Twisted ClientTLSOptions that are used to make connections
@@ -130,6 +166,11 @@ class ClientTLSOptionsFactory(object):
         # We don't use config options yet
         self._options = CertificateOptions(verify=False)
 
+        # hostname -> the last TLS session established with it
+        self._session_cache = LruCache(TLS_SESSION_CACHE_SIZE)
+
     def get_options(self, host):
         # Use _makeContext so that we get a fresh OpenSSL CTX each time.
-        return ClientTLSOptions(host, self._options._makeContext())
+        return ClientTLSOptions(
+            host, self._options._makeContext(), self._session_cache,
+        )
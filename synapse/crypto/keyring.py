@@ -17,7 +17,7 @@
 import logging
 from collections import namedtuple
 
-from six import raise_from
+from six import iteritems, raise_from
 from six.moves import urllib
 
 from signedjson.key import (
@@ -42,7 +42,10 @@ from synapse.api.errors import (
     RequestSendFailed,
     SynapseError,
 )
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.util import logcontext, unwrapFirstError
+from synapse.util.async_helpers import ThreadedBatcher
+from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.logcontext import (
     LoggingContext,
     PreserveLoggingContext,
@@ -54,6 +57,23 @@ from synapse.util.retryutils import NotRetryingDestination
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of verify keys to hold in memory
+VERIFY_KEY_CACHE_SIZE = 10000
+
+# How long before a key's valid_until_ts we start trying to refresh it
+KEY_REFRESH_MARGIN_MS = 30 * 60 * 1000
+
+# How long to wait before retrying a failed refresh
+KEY_REFRESH_RETRY_MS = 5 * 60 * 1000
+
+# How long to keep using a key after its valid_until_ts has passed, while we
+# try to refresh it. (Keys aren't rejected once they have expired, so this just
+# limits how often we go back to the database for them.)
+EXPIRED_KEY_CACHE_MS = 10 * 60 * 1000
+
+# How long to remember that a server has no key with a given key ID
+UNKNOWN_KEY_CACHE_MS = 2 * 60 * 1000
+
 
 VerifyKeyRequest = namedtuple("VerifyRequest", (
     "server_name", "key_ids", "json_object", "deferred"
@@ -77,6 +97,24 @@ class KeyLookupError(ValueError):
     pass
 
 
+class _CachedVerifyKey(object):
+    """A verify key held in the Keyring's in-memory cache"""
+    __slots__ = ["verify_key", "valid_until_ts", "expires_ts", "refresh_ts"]
+
+    def __init__(self, verify_key, valid_until_ts, expires_ts, refresh_ts):
+        self.verify_key = verify_key
+
+        # when our copy of the key stops being valid (0 if unknown)
+        self.valid_until_ts = valid_until_ts
+
+        # when we stop using the cached key and look it up again
+        self.expires_ts = expires_ts
+
+        # when we next try to refresh the key in the background, if it is
+        # still valid by then
+        self.refresh_ts = refresh_ts
+
+
 class Keyring(object):
     def __init__(self, hs):
         self.store = hs.get_datastore()
@@ -93,6 +131,30 @@ class Keyring(object):
         # These are regular, logcontext-agnostic Deferreds.
         self.key_downloads = {}
 
+        # Keys we have already fetched, so that checking signatures from busy
+        # servers doesn't need to go to the database. Keys are refreshed in
+        # the background when they are about to expire.
+        #
+        # map from (server_name, key_id) to _CachedVerifyKey
+        self._verify_key_cache = ExpiringCache(
+            "verify_keys", self.clock, max_len=VERIFY_KEY_CACHE_SIZE,
+        )
+
+        # Key IDs which we failed to find a key for, so that we don't keep
+        # looking them up.
+        #
+        # map from (server_name, key_id) to the time the entry expires
+        self._unknown_key_cache = ExpiringCache(
+            "unknown_verify_keys", self.clock,
+            max_len=VERIFY_KEY_CACHE_SIZE, expiry_ms=UNKNOWN_KEY_CACHE_MS,
+        )
+
+        # Signatures are checked in the thread pool, to keep the reactor free
+        # when lots of events are checked at once.
+        self._signature_verifier = ThreadedBatcher(
+            hs.get_reactor(), verify_signed_json,
+        )
+
     def verify_json_for_server(self, server_name, json_object):
         return logcontext.make_deferred_yieldable(
             self.verify_json_objects_for_server(
@@ -127,7 +189,13 @@ class Keyring(object):
                     Codes.UNAUTHORIZED,
                 ))
             else:
-                deferred = defer.Deferred()
+                cached = self._get_cached_verify_key(server_name, key_ids)
+                if cached:
+                    deferred = defer.succeed(cached)
+                elif self._are_unknown_keys(server_name, key_ids):
+                    deferred = defer.fail(_no_key_error(server_name, key_ids))
+                else:
+                    deferred = defer.Deferred()
 
             logger.debug("Verifying for %s with key_ids %s",
                          server_name, key_ids)
@@ -138,13 +206,18 @@ class Keyring(object):
 
             verify_requests.append(verify_request)
 
-        run_in_background(self._start_key_lookups, verify_requests)
+        # Only look up the keys we don't already have
+        pending_requests = [
+            rq for rq in verify_requests if not rq.deferred.called
+        ]
+        if pending_requests:
+            run_in_background(self._start_key_lookups, pending_requests)
 
         # Pass those keys to handle_key_deferred so that the json object
         # signatures can be verified
         handle = preserve_fn(_handle_key_deferred)
         return [
-            handle(rq) for rq in verify_requests
+            handle(rq, self._signature_verifier) for rq in verify_requests
         ]
 
     @defer.inlineCallbacks
@@ -207,6 +280,86 @@ class Keyring(object):
         except Exception:
             logger.exception("Error starting key lookups")
 
+    def _get_cached_verify_key(self, server_name, key_ids):
+        """Look for a key to verify a signature in the in-memory cache.
+
+        If the key is due to be refreshed, a refresh is started in the
+        background. Keys which have already expired, or whose validity we
+        don't know, aren't refreshed here: once their cache entry expires they
+        are looked up again from the store.
+
+        Args:
+            server_name (str)
+            key_ids (iterable[str]): the key IDs the object was signed with
+
+        Returns:
+            tuple[str, str, VerifyKey]|None: (server_name, key_id, verify_key),
+                or None if none of the keys are cached.
+        """
+        now = self.clock.time_msec()
+        for key_id in key_ids:
+            entry = self._verify_key_cache.get((server_name, key_id))
+            if entry is None or entry.expires_ts <= now:
+                continue
+
+            if entry.refresh_ts <= now < entry.valid_until_ts:
+                entry.refresh_ts = now + KEY_REFRESH_RETRY_MS
+                run_as_background_process(
+                    "refresh_verify_keys", self._refresh_keys, server_name, [key_id],
+                )
+
+            return server_name, key_id, entry.verify_key
+
+        return None
+
+    def _are_unknown_keys(self, server_name, key_ids):
+        """Check if we recently failed to find any of the given keys
+        """
+        now = self.clock.time_msec()
+        return all(
+            self._unknown_key_cache.get((server_name, key_id), 0) > now
+            for key_id in key_ids
+        )
+
+    def _cache_verify_key(self, server_name, key_id, verify_key, valid_until_ts):
+        """Add a key to the in-memory cache.
+
+        Args:
+            server_name (str)
+            key_id (str)
+            verify_key (VerifyKey)
+            valid_until_ts (int|None): when our copy of the key stops being
+                valid, if known.
+        """
+        now = self.clock.time_msec()
+        valid_until_ts = valid_until_ts or 0
+        self._verify_key_cache[(server_name, key_id)] = _CachedVerifyKey(
+            verify_key,
+            valid_until_ts=valid_until_ts,
+            expires_ts=max(valid_until_ts, now + EXPIRED_KEY_CACHE_MS),
+            refresh_ts=valid_until_ts - KEY_REFRESH_MARGIN_MS,
+        )
+        self._unknown_key_cache.pop((server_name, key_id), None)
+
+    @defer.inlineCallbacks
+    def _refresh_keys(self, server_name, key_ids):
+        """Fetch fresh copies of the given keys from the perspectives servers
+        or the server itself. The keys are added to the cache as they are
+        fetched.
+        """
+        missing_key_ids = set(key_ids)
+        try:
+            for fn in (self.get_keys_from_perspectives, self.get_keys_from_server):
+                results = yield fn([(server_name, missing_key_ids)])
+                missing_key_ids.difference_update(results.get(server_name, {}))
+                if not missing_key_ids:
+                    return
+        except Exception as e:
+            logger.info(
+                "Failed to refresh keys %s for %s: %s %s",
+                key_ids, server_name, type(e).__name__, str(e),
+            )
+
     @defer.inlineCallbacks
     def wait_for_previous_lookups(self, server_names, server_to_deferred):
         """Waits for any previous key lookups for the given servers to finish.
@@ -322,14 +475,17 @@ class Keyring(object):
                     if not missing_keys:
                         break
 
+                expires_ts = self.clock.time_msec() + UNKNOWN_KEY_CACHE_MS
+                for verify_request in requests_missing_keys:
+                    for key_id in verify_request.key_ids:
+                        self._unknown_key_cache[
+                            (verify_request.server_name, key_id)
+                        ] = expires_ts
+
                 with PreserveLoggingContext():
                     for verify_request in requests_missing_keys:
-                        verify_request.deferred.errback(SynapseError(
-                            401,
-                            "No key for %s with id %s" % (
-                                verify_request.server_name, verify_request.key_ids,
-                            ),
-                            Codes.UNAUTHORIZED,
+                        verify_request.deferred.errback(_no_key_error(
+                            verify_request.server_name, verify_request.key_ids,
                         ))
 
         def on_err(err):
@@ -352,12 +508,22 @@ class Keyring(object):
             Deferred: resolves to dict[str, dict[str, VerifyKey]]: map from
                 server_name -> key_id -> VerifyKey
         """
+        @defer.inlineCallbacks
+        def get_keys(server_name, key_ids):
+            keys = yield self.store.get_server_verify_keys(server_name, key_ids)
+            if keys:
+                valid_until = yield self.store.get_server_key_valid_until_ts(
+                    server_name, list(keys),
+                )
+                for key_id, verify_key in iteritems(keys):
+                    self._cache_verify_key(
+                        server_name, key_id, verify_key, valid_until.get(key_id),
+                    )
+            defer.returnValue((server_name, keys))
+
         res = yield logcontext.make_deferred_yieldable(defer.gatherResults(
             [
-                run_in_background(
-                    self.store.get_server_verify_keys,
-                    server_name, key_ids,
-                ).addCallback(lambda ks, server: (server, ks), server_name)
+                run_in_background(get_keys, server_name, key_ids)
                 for server_name, key_ids in server_name_and_key_ids
             ],
             consumeErrors=True,
@@ -643,6 +809,11 @@ class Keyring(object):
             consumeErrors=True,
         ).addErrback(unwrapFirstError))
 
+        for key_id, verify_key in iteritems(response_keys):
+            self._cache_verify_key(
+                server_name, key_id, verify_key, ts_valid_until_ms,
+            )
+
         results[server_name] = response_keys
 
         defer.returnValue(results)
@@ -669,12 +840,22 @@ class Keyring(object):
         ).addErrback(unwrapFirstError))
 
 
+def _no_key_error(server_name, key_ids):
+    return SynapseError(
+        401,
+        "No key for %s with id %s" % (server_name, key_ids),
+        Codes.UNAUTHORIZED,
+    )
+
+
 @defer.inlineCallbacks
-def _handle_key_deferred(verify_request):
+def _handle_key_deferred(verify_request, signature_verifier):
     """Waits for the key to become available, and then performs a verification
 
     Args:
         verify_request (VerifyKeyRequest):
+        signature_verifier (ThreadedBatcher): batcher which calls
+            verify_signed_json
 
     Returns:
         Deferred[None]
@@ -713,7 +894,7 @@ def _handle_key_deferred(verify_request):
         key_id, verify_key.alg, verify_key.version, server_name,
     ))
     try:
-        verify_signed_json(json_object, server_name, verify_key)
+        yield signature_verifier.submit(json_object, server_name, verify_key)
     except SignatureVerifyException as e:
         logger.debug(
             "Error verifying signature for %s:%s:%s with key %s: %s",
@@ -28,6 +28,7 @@ from synapse.events.utils import prune_event
 from synapse.http.servlet import assert_params_in_dict
 from synapse.types import get_domain_from_id
 from synapse.util import logcontext, unwrapFirstError
+from synapse.util.async_helpers import ThreadedBatcher
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +43,12 @@ class FederationBase(object):
         self.store = hs.get_datastore()
         self._clock = hs.get_clock()
 
+        # Content hashes are checked in the thread pool, along with the
+        # signatures (see Keyring).
+        self._content_hash_checker = ThreadedBatcher(
+            hs.get_reactor(), check_event_content_hash,
+        )
+
     @defer.inlineCallbacks
     def _check_sigs_and_hash_and_fetch(self, origin, pdus, room_version,
                                        outlier=False, include_none=False):
@@ -146,9 +153,12 @@ class FederationBase(object):
 
         ctx = logcontext.LoggingContext.current_context()
 
-        def callback(_, pdu):
+        def check_hash(_, pdu):
+            return self._content_hash_checker.submit(pdu)
+
+        def callback(hash_matches, pdu):
             with logcontext.PreserveLoggingContext(ctx):
-                if not check_event_content_hash(pdu):
+                if not hash_matches:
                     # let's try to distinguish between failures because the event was
                     # redacted (which are somewhat expected) vs actual ball-tampering
                     # incidents.
@@ -194,6 +204,7 @@ class FederationBase(object):
             return failure
 
         for deferred, pdu in zip(deferreds, pdus):
+            deferred.addCallback(check_hash, pdu)
             deferred.addCallbacks(
                 callback, errback,
                 callbackArgs=[pdu],
@@ -19,8 +19,6 @@ import itertools
 import logging
 import random
 
-from six.moves import range
-
 from prometheus_client import Counter
 
 from twisted.internet import defer
@@ -41,6 +39,7 @@ from synapse.api.errors import (
 from synapse.events import builder, room_version_to_event_format
 from synapse.federation.federation_base import FederationBase, event_from_pdu_json
 from synapse.util import logcontext, unwrapFirstError
+from synapse.util.async_helpers import ObservableDeferred, concurrently_execute
 from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.logcontext import make_deferred_yieldable, run_in_background
 from synapse.util.logutils import log_function
@@ -53,6 +52,9 @@ sent_queries_counter = Counter("synapse_federation_client_sent_queries", "", ["t
 
 PDU_RETRY_TIME_MS = 1 * 60 * 1000
 
+# The maximum number of events get_pdus will fetch at once
+MAX_CONCURRENT_PDU_FETCHES = 10
+
 
 class InvalidResponseError(RuntimeError):
     """Helper for _try_destination_list: indicates that the server returned a response
@@ -83,6 +85,10 @@ class FederationClient(FederationBase):
             reset_expiry_on_get=False,
         )
 
+        # event_id -> ObservableDeferred for the get_pdu requests in flight, so
+        # that concurrent requests for the same event are deduplicated.
+        self._pdu_fetches = {}
+
     def _clear_tried_cache(self):
         """Clear pdu_destination_tried cache"""
         now = self._clock.time_msec()
@@ -222,6 +228,10 @@ class FederationClient(FederationBase):
         Will attempt to get the PDU from each destination in the list until
         one succeeds.
 
+        If the PDU is already being fetched, waits for that request to finish
+        first. Destinations which failed to return the PDU recently are
+        skipped.
+
         Args:
             destinations (list): Which home servers to query
             event_id (str): event to fetch
@@ -236,12 +246,43 @@ class FederationClient(FederationBase):
             Deferred: Results in the requested PDU.
         """
 
-        # TODO: Rate limit the number of times we try and get the same event.
-
         ev = self._get_pdu_cache.get(event_id)
         if ev:
             defer.returnValue(ev)
 
+        fetch = self._pdu_fetches.get(event_id)
+        if fetch is not None:
+            # wait for the other request; if that fails we'll try any of our
+            # destinations which it didn't.
+            try:
+                yield make_deferred_yieldable(fetch.observe())
+            except Exception:
+                pass
+
+            ev = self._get_pdu_cache.get(event_id)
+            if ev:
+                defer.returnValue(ev)
+
+        d = run_in_background(
+            self._get_pdu_from_destinations,
+            destinations, event_id, room_version, outlier, timeout,
+        )
+        fetch = ObservableDeferred(d, consumeErrors=True)
+        self._pdu_fetches[event_id] = fetch
+
+        def remove(r):
+            if self._pdu_fetches.get(event_id) is fetch:
+                del self._pdu_fetches[event_id]
+            return r
+
+        d.addBoth(remove)
+
+        signed_pdu = yield make_deferred_yieldable(fetch.observe())
+        defer.returnValue(signed_pdu)
+
+    @defer.inlineCallbacks
+    def _get_pdu_from_destinations(self, destinations, event_id, room_version,
+                                   outlier, timeout):
         pdu_attempts = self.pdu_destination_tried.setdefault(event_id, {})
 
         format_ver = room_version_to_event_format(room_version)
@@ -276,6 +317,8 @@ class FederationClient(FederationBase):
                 pdu_attempts[destination] = now
 
             except SynapseError as e:
+                pdu_attempts[destination] = now
+
                 logger.info(
                     "Failed to get PDU %s from %s because %s",
                     event_id, destination, e,
@@ -300,6 +343,49 @@ class FederationClient(FederationBase):
 
         defer.returnValue(signed_pdu)
 
+    @defer.inlineCallbacks
+    def get_pdus(self, destinations, event_ids, room_version, outlier=False,
+                 timeout=None):
+        """Requests several PDUs from the remote home servers.
+
+        Up to MAX_CONCURRENT_PDU_FETCHES events are fetched at once, each from
+        the destinations in a random order, so that the requests are spread
+        across the servers.
+
+        Args:
+            destinations (list[str]): Which home servers to query
+            event_ids (iterable[str]): events to fetch
+            room_version (str): version of the room
+            outlier (bool): Indicates whether the PDUs are `outlier`s
+            timeout (int): How long to try (in ms) each destination for before
+                moving to the next destination. None indicates no timeout.
+
+        Returns:
+            Deferred[dict[str, EventBase]]: map from event_id to the PDUs which
+            were fetched. Events which couldn't be fetched are omitted.
+        """
+        pdus = {}
+
+        @defer.inlineCallbacks
+        def fetch(event_id):
+            srvs = list(destinations)
+            random.shuffle(srvs)
+
+            try:
+                pdu = yield self.get_pdu(
+                    srvs, event_id, room_version, outlier=outlier, timeout=timeout,
+                )
+            except Exception:
+                logger.exception("Failed to fetch PDU %s", event_id)
+                return
+
+            if pdu and pdu.event_id == event_id:
+                pdus[event_id] = pdu
+
+        yield concurrently_execute(fetch, event_ids, MAX_CONCURRENT_PDU_FETCHES)
+
+        defer.returnValue(pdus)
+
     @defer.inlineCallbacks
     @log_function
     def get_state_for_room(self, destination, room_id, event_id):
@@ -419,47 +505,19 @@ class FederationClient(FederationBase):
             seen_events = yield self.store.have_seen_events(event_ids)
             signed_events = []
 
-        failed_to_fetch = set()
-
         missing_events = set(event_ids)
         for k in seen_events:
             missing_events.discard(k)
 
         if not missing_events:
-            defer.returnValue((signed_events, failed_to_fetch))
-
-        def random_server_list():
-            srvs = list(destinations)
-            random.shuffle(srvs)
-            return srvs
+            defer.returnValue((signed_events, set()))
 
         room_version = yield self.store.get_room_version(room_id)
 
-        batch_size = 20
-        missing_events = list(missing_events)
-        for i in range(0, len(missing_events), batch_size):
-            batch = set(missing_events[i:i + batch_size])
-
-            deferreds = [
-                run_in_background(
-                    self.get_pdu,
-                    destinations=random_server_list(),
-                    event_id=e_id,
-                    room_version=room_version,
-                )
-                for e_id in batch
-            ]
-
-            res = yield make_deferred_yieldable(
-                defer.DeferredList(deferreds, consumeErrors=True)
-            )
-            for success, result in res:
-                if success and result:
-                    signed_events.append(result)
-                    batch.discard(result.event_id)
+        fetched = yield self.get_pdus(destinations, missing_events, room_version)
+        signed_events.extend(fetched.values())
 
-            # We removed all events we successfully fetched from `batch`
-            failed_to_fetch.update(batch)
+        failed_to_fetch = missing_events - set(fetched)
 
         defer.returnValue((signed_events, failed_to_fetch))
 
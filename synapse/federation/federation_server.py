@@ -14,12 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
+from collections import deque
 
 import six
-from six import iteritems
+from six import iteritems, itervalues
 
 from canonicaljson import json
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 from twisted.internet.abstract import isIPAddress
@@ -35,11 +36,13 @@ from synapse.api.errors import (
     SynapseError,
 )
 from synapse.crypto.event_signing import compute_event_signature
-from synapse.events import room_version_to_event_format
+from synapse.events import event_type_from_format_version, room_version_to_event_format
 from synapse.federation.federation_base import FederationBase, event_from_pdu_json
 from synapse.federation.persistence import TransactionActions
 from synapse.federation.units import Edu, Transaction
 from synapse.http.endpoint import parse_server_name
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.replication.http.federation import (
     ReplicationFederationSendEduRestServlet,
     ReplicationGetQueryRestServlet,
@@ -48,13 +51,34 @@ from synapse.types import get_domain_from_id
 from synapse.util import glob_to_regex
 from synapse.util.async_helpers import Linearizer, concurrently_execute
 from synapse.util.caches.response_cache import ResponseCache
-from synapse.util.logcontext import nested_logging_context
+from synapse.util.logcontext import (
+    PreserveLoggingContext,
+    make_deferred_yieldable,
+    nested_logging_context,
+)
 from synapse.util.logutils import log_function
 
 # when processing incoming transactions, we try to handle multiple rooms in
 # parallel, up to this limit.
 TRANSACTION_CONCURRENCY_LIMIT = 10
 
+# the number of received PDUs which may be staged for a room before further
+# transactions with PDUs for the room have to wait for some to be processed.
+MAX_STAGED_PDUS_PER_ROOM = 100
+
+# the number of staged PDUs which we process at once, across all rooms
+STAGED_PDU_CONCURRENCY_LIMIT = 10
+
+# how often to check whether we have the full state of a room joined with
+# partial state, while there are PDUs staged for it
+STAGED_PDU_PARTIAL_STATE_CHECK_INTERVAL_SECS = 10
+
+# how long to wait before trying again to process a staged PDU, after an
+# unexpected error. The interval is doubled after each failure, up to the
+# maximum.
+STAGED_PDU_RETRY_INTERVAL_SECS = 10
+STAGED_PDU_MAX_RETRY_INTERVAL_SECS = 60 * 60
+
 logger = logging.getLogger(__name__)
 
 received_pdus_counter = Counter("synapse_federation_server_received_pdus", "")
@@ -65,6 +89,11 @@ received_queries_counter = Counter(
     "synapse_federation_server_received_queries", "", ["type"]
 )
 
+staged_pdu_delay = Histogram(
+    "synapse_federation_server_staged_pdu_delay_seconds",
+    "Time between receiving PDUs and processing them",
+)
+
 
 class FederationServer(FederationBase):
 
@@ -85,6 +114,43 @@ class FederationServer(FederationBase):
         # come in waves.
         self._state_resp_cache = ResponseCache(hs, "state_resp", timeout_ms=30000)
 
+        # Received PDUs are persisted in a staging area and acked straight
+        # away, and then processed in the background, one at a time per room.
+        # This process handles the PDUs it staged, so each process needs a
+        # unique name (which WorkerConfig makes sure of for the workers).
+        self._instance_name = hs.config.worker_name or "master"
+
+        # room_id -> deque of the received timestamps of the PDUs staged for
+        # the room, in the order they will be processed
+        self._staged_pdus = {}
+
+        # room_id -> whether more PDUs may have been staged since we last
+        # checked, for the rooms we are processing staged PDUs for
+        self._rooms_processing_staged_pdus = {}
+
+        # room_id -> list of Deferreds waiting for there to be space to stage
+        # more PDUs for the room
+        self._staging_waiters = {}
+
+        self._staged_pdu_limiter = Linearizer(
+            "fed_staged_pdus", max_count=STAGED_PDU_CONCURRENCY_LIMIT,
+        )
+
+        LaterGauge(
+            "synapse_federation_server_staged_pdus",
+            "Number of received PDUs waiting to be processed",
+            [],
+            lambda: sum(len(staged) for staged in itervalues(self._staged_pdus)),
+        )
+        LaterGauge(
+            "synapse_federation_server_oldest_staged_pdu_age_seconds",
+            "Time since the oldest PDU waiting to be processed was received",
+            [],
+            self._get_oldest_staged_pdu_age,
+        )
+
+        run_as_background_process("resume_staged_pdus", self._resume_staged_pdus)
+
     @defer.inlineCallbacks
     @log_function
     def on_backfill_request(self, origin, room_id, versions, limit):
@@ -207,13 +273,14 @@ class FederationServer(FederationBase):
 
         pdu_results = {}
 
-        # we can process different rooms in parallel (which is useful if they
-        # require callouts to other servers to fetch missing events), but
-        # impose a limit to avoid going too crazy with ram/cpu.
+        # we can validate different rooms in parallel (which is useful if they
+        # require callouts to other servers to fetch signing keys), but impose
+        # a limit to avoid going too crazy with ram/cpu. The PDUs are then
+        # staged, to be processed after we have responded.
 
         @defer.inlineCallbacks
         def process_pdus_for_room(room_id):
-            logger.debug("Processing PDUs for %s", room_id)
+            logger.debug("Validating PDUs for %s", room_id)
             try:
                 yield self.check_server_matches_acl(origin_host, room_id)
             except AuthError as e:
@@ -225,13 +292,16 @@ class FederationServer(FederationBase):
                     pdu_results[event_id] = e.error_dict()
                 return
 
+            to_stage = []
             for pdu in pdus_by_room[room_id]:
                 event_id = pdu.event_id
                 with nested_logging_context(event_id):
                     try:
-                        yield self._handle_received_pdu(
+                        pdu = yield self._validate_received_pdu(
                             origin, pdu
                         )
+                        if pdu is not None:
+                            to_stage.append(pdu)
                         pdu_results[event_id] = {}
                     except FederationError as e:
                         logger.warn("Error handling PDU %s: %s", event_id, e)
@@ -245,6 +315,11 @@ class FederationServer(FederationBase):
                             exc_info=(f.type, f.value, f.getTracebackObject()),
                         )
 
+            if to_stage:
+                yield self._stage_pdus_for_room(
+                    origin, room_id, to_stage, request_time,
+                )
+
         yield concurrently_execute(
             process_pdus_for_room, pdus_by_room.keys(),
             TRANSACTION_CONCURRENCY_LIMIT,
@@ -613,8 +688,9 @@ class FederationServer(FederationBase):
         )
 
     @defer.inlineCallbacks
-    def _handle_received_pdu(self, origin, pdu):
-        """ Process a PDU received in a federation /send/ transaction.
+    def _validate_received_pdu(self, origin, pdu):
+        """ Check a PDU received in a federation /send/ transaction, before
+        it is staged for processing.
 
         If the event is invalid, then this method throws a FederationError.
         (The error will then be logged and sent back to the sender (which
@@ -637,11 +713,12 @@ class FederationServer(FederationBase):
             origin (str): server which sent the pdu
             pdu (FrozenEvent): received pdu
 
-        Returns (Deferred): completes with None
+        Returns:
+            Deferred[FrozenEvent|None]: the pdu to process (which will have
+            been redacted if its hash didn't match), or None if it should be
+            discarded.
 
-        Raises: FederationError if the signatures / hash do not match, or
-            if the event was unacceptable for any other reason (eg, too large,
-            too many prev_events, couldn't find the prev_events)
+        Raises: FederationError if the signatures / hash do not match
         """
         # check that it's actually being sent from a valid destination to
         # workaround bug #1753 in 0.18.5 and 0.18.6
@@ -663,7 +740,7 @@ class FederationServer(FederationBase):
                     "Discarding PDU %s from invalid origin %s",
                     pdu.event_id, origin
                 )
-                return
+                defer.returnValue(None)
             else:
                 logger.info(
                     "Accepting join PDU %s from %s",
@@ -684,10 +761,193 @@ class FederationServer(FederationBase):
                 affected=pdu.event_id,
             )
 
-        yield self.handler.on_receive_pdu(
-            origin, pdu, sent_to_us_directly=True,
+        defer.returnValue(pdu)
+
+    @defer.inlineCallbacks
+    def _stage_pdus_for_room(self, origin, room_id, pdus, received_ts):
+        """Persist validated PDUs for a room, and make sure they get processed.
+
+        If there are already too many PDUs waiting to be processed for the
+        room, first waits for some of them to be processed, so that servers
+        which send PDUs faster than we can process them are slowed down.
+
+        Args:
+            origin (str): server which sent the pdus
+            room_id (str)
+            pdus (list[FrozenEvent])
+            received_ts (int): when we received the pdus
+        """
+        # PDUs for a room which we joined with partial state aren't processed
+        # until we have the rest of its state, which may take a while, so we
+        # don't hold up the sender until then.
+        is_partial_state = yield self.store.is_partial_state_room(room_id)
+        while (
+            not is_partial_state and
+            len(self._staged_pdus.get(room_id, ())) >= MAX_STAGED_PDUS_PER_ROOM
+        ):
+            d = defer.Deferred()
+            self._staging_waiters.setdefault(room_id, []).append(d)
+            yield make_deferred_yieldable(d)
+
+        staged = yield self.store.stage_received_events(
+            self._instance_name, origin, pdus, received_ts,
+        )
+        self._staged_pdus.setdefault(room_id, deque()).extend(
+            received_ts for _ in staged
+        )
+        self._start_processing_staged_pdus(room_id)
+
+    def _start_processing_staged_pdus(self, room_id):
+        if room_id in self._rooms_processing_staged_pdus:
+            self._rooms_processing_staged_pdus[room_id] = True
+            return
+
+        self._rooms_processing_staged_pdus[room_id] = False
+        run_as_background_process(
+            "process_staged_pdus", self._process_staged_pdus_for_room, room_id,
+        )
+
+    @defer.inlineCallbacks
+    def _process_staged_pdus_for_room(self, room_id):
+        retry_interval = STAGED_PDU_RETRY_INTERVAL_SECS
+        try:
+            while True:
+                # We can't check events against the state of a room which we
+                # joined with partial state (see FederationHandler.do_invite_join),
+                # so leave them staged until we have all of it.
+                is_partial_state = yield self.store.is_partial_state_room(room_id)
+                if is_partial_state:
+                    yield self._clock.sleep(
+                        STAGED_PDU_PARTIAL_STATE_CHECK_INTERVAL_SECS,
+                    )
+                    continue
+
+                self._rooms_processing_staged_pdus[room_id] = False
+                try:
+                    with (yield self._staged_pdu_limiter.queue(())):
+                        processed = yield self._process_next_staged_pdu(room_id)
+                except Exception:
+                    # the PDU is still staged, so we'll try it again later
+                    logger.exception(
+                        "Failed to process staged PDU for %s, retrying in %ds",
+                        room_id, retry_interval,
+                    )
+                    yield self._clock.sleep(retry_interval)
+                    retry_interval = min(
+                        retry_interval * 2, STAGED_PDU_MAX_RETRY_INTERVAL_SECS,
+                    )
+                    continue
+
+                retry_interval = STAGED_PDU_RETRY_INTERVAL_SECS
+
+                if not processed and not self._rooms_processing_staged_pdus[room_id]:
+                    # nothing was staged while we were checking, so we're done.
+                    self._staged_pdus.pop(room_id, None)
+                    return
+        finally:
+            del self._rooms_processing_staged_pdus[room_id]
+
+            # anyone waiting to stage PDUs can now check again
+            waiters = self._staging_waiters.pop(room_id, [])
+            with PreserveLoggingContext():
+                for d in waiters:
+                    d.callback(None)
+
+    @defer.inlineCallbacks
+    def _process_next_staged_pdu(self, room_id):
+        """Process the earliest staged PDU for a room.
+
+        The PDU is removed from the staging area once it has been processed, or
+        if it was rejected. If processing it fails unexpectedly, it is left
+        staged and the error is raised.
+
+        Returns:
+            Deferred[bool]: False if there were no PDUs staged for the room
+        """
+        row = yield self.store.get_next_staged_event_for_room(
+            self._instance_name, room_id,
+        )
+        if row is None:
+            defer.returnValue(False)
+
+        stream_id, origin, event_json, internal_metadata = row
+        event_id = event_json.get("event_id", "<Unknown>")
+
+        with nested_logging_context(event_id):
+            try:
+                room_version = yield self.store.get_room_version(room_id)
+                try:
+                    format_ver = room_version_to_event_format(room_version)
+                    pdu = event_type_from_format_version(format_ver)(
+                        event_json, internal_metadata_dict=internal_metadata,
+                    )
+                    event_id = pdu.event_id
+                except Exception as e:
+                    raise SynapseError(400, "Invalid PDU: %s" % (e,))
+
+                yield self.handler.on_receive_pdu(
+                    origin, pdu, sent_to_us_directly=True,
+                )
+            except Exception as e:
+                if not _is_pdu_rejection(e):
+                    raise
+                logger.warn("Error handling PDU %s: %s", event_id, e)
+
+        yield self.store.remove_received_event_from_staging(
+            self._instance_name, room_id, stream_id,
         )
 
+        staged = self._staged_pdus.get(room_id)
+        if staged:
+            received_ts = staged.popleft()
+            staged_pdu_delay.observe(
+                (self._clock.time_msec() - received_ts) / 1000.,
+            )
+
+        waiters = self._staging_waiters.pop(room_id, [])
+        with PreserveLoggingContext():
+            for d in waiters:
+                d.callback(None)
+
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _resume_staged_pdus(self):
+        """Start processing any PDUs we staged before we were restarted"""
+        rows = yield self.store.get_staged_events_received_ts(self._instance_name)
+        for room_id, received_ts in rows:
+            self._staged_pdus.setdefault(room_id, deque()).append(received_ts)
+
+        for room_id in list(self._staged_pdus):
+            self._start_processing_staged_pdus(room_id)
+
+        if self._instance_name == "master":
+            yield self._warn_about_other_staged_pdus()
+
+    @defer.inlineCallbacks
+    def _warn_about_other_staged_pdus(self):
+        """Warn about PDUs staged by federation_readers, as they will be lost
+        if the federation_reader which staged them has been renamed or removed.
+        """
+        now = self._clock.time_msec()
+        rows = yield self.store.get_staged_event_counts_by_instance()
+        for instance_name, count, oldest_received_ts in rows:
+            if instance_name == self._instance_name:
+                continue
+
+            logger.warning(
+                "%d received PDUs (the oldest received %ds ago) are waiting to be"
+                " processed by the federation_reader with worker_name %r. They"
+                " will only be processed if that worker is running.",
+                count, (now - oldest_received_ts) / 1000, instance_name,
+            )
+
+    def _get_oldest_staged_pdu_age(self):
+        oldest = [staged[0] for staged in itervalues(self._staged_pdus) if staged]
+        if not oldest:
+            return 0
+        return (self._clock.time_msec() - min(oldest)) / 1000.
+
     def __str__(self):
         return "<ReplicationLayer(%s)>" % self.server_name
 
@@ -798,6 +1058,15 @@ def _acl_entry_matches(server_name, acl_entry):
     return regex.match(server_name)
 
 
+def _is_pdu_rejection(e):
+    """Whether an error from processing a received PDU means that the PDU
+    was rejected, rather than that processing it failed and should be retried.
+    """
+    if isinstance(e, FederationError):
+        return True
+    return isinstance(e, SynapseError) and 400 <= e.code < 500
+
+
 class FederationHandlerRegistry(object):
     """Allows classes to register themselves as handlers for a given EDU or
     query type for incoming federation traffic.
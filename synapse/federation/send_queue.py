@@ -473,16 +473,27 @@ def process_rows_for_federation(transaction_queue, rows):
         parsed_row = RowType.from_data(row.data)
         parsed_row.add_to_buffer(buff)
 
+    # If there are several federation senders, each only handles the
+    # destinations in its shard. Presence is sent to whichever destinations
+    # are interested in it, so is filtered by the transaction queue instead.
+    is_shard_for_destination = transaction_queue.is_shard_for_destination
+
     if buff.presence:
         transaction_queue.send_presence(buff.presence)
 
     for destination, edu_map in iteritems(buff.keyed_edus):
+        if not is_shard_for_destination(destination):
+            continue
         for key, edu in edu_map.items():
             transaction_queue.send_edu(edu, key)
 
     for destination, edu_list in iteritems(buff.edus):
+        if not is_shard_for_destination(destination):
+            continue
         for edu in edu_list:
             transaction_queue.send_edu(edu, None)
 
     for destination in buff.device_destinations:
+        if not is_shard_for_destination(destination):
+            continue
         transaction_queue.send_device_messages(destination)
@@ -15,7 +15,7 @@
 
 import logging
 
-from six import itervalues
+from six import iteritems, itervalues
 
 from prometheus_client import Counter
 
@@ -33,11 +33,14 @@ from synapse.metrics import (
     events_processed_counter,
 )
 from synapse.metrics.background_process_metrics import run_as_background_process
-from synapse.util import logcontext
+from synapse.util import get_shard_for_key, logcontext
 from synapse.util.metrics import measure_func
 
 logger = logging.getLogger(__name__)
 
+# How often to check for destinations which need catching up on missed events
+CATCH_UP_WAKE_INTERVAL_MS = 60 * 1000
+
 sent_pdus_destination_dist_count = Counter(
     "synapse_federation_client_sent_pdu_destinations:count",
     "Number of PDUs queued for sending to one or more destinations",
@@ -56,10 +59,16 @@ class FederationSender(object):
 
         self.store = hs.get_datastore()
         self.state = hs.get_state_handler()
+        self.presence_audience = hs.get_presence_audience()
 
         self.clock = hs.get_clock()
         self.is_mine_id = hs.is_mine_id
 
+        # If there are several federation senders, we only send to the
+        # destinations in our shard.
+        self._shard_count = hs.config.worker_federation_sender_shard_count
+        self._shard_index = hs.config.worker_federation_sender_shard_index
+
         self._transaction_manager = TransactionManager(hs)
 
         # map from destination to PerDestinationQueue
@@ -96,6 +105,25 @@ class FederationSender(object):
                 d.pending_edu_count() for d in self._per_destination_queues.values()
             ),
         )
+        LaterGauge(
+            "synapse_federation_transaction_queue_destination_backlog",
+            "Number of PDUs and EDUs waiting to be sent, for destinations with any",
+            ["destination"],
+            lambda: {
+                (destination,): d.pending_pdu_count() + d.pending_edu_count()
+                for destination, d in iteritems(self._per_destination_queues)
+                if d.pending_pdu_count() or d.pending_edu_count()
+            },
+        )
+        LaterGauge(
+            "synapse_federation_transaction_queue_in_flight_transactions",
+            "Number of transactions sent without waiting for earlier ones",
+            [],
+            lambda: sum(
+                d.in_flight_transaction_count()
+                for d in self._per_destination_queues.values()
+            ),
+        )
 
         self._order = 1
 
@@ -104,6 +132,8 @@ class FederationSender(object):
 
         self._processing_pending_presence = False
 
+        self._waking_destinations = False
+
         # map from room_id to a set of PerDestinationQueues which we believe are
         # awaiting a call to flush_read_receipts_for_room. The presence of an entry
         # here for a given room means that we are rate-limiting RR flushes to that room,
@@ -115,6 +145,25 @@ class FederationSender(object):
             1000.0 / hs.get_config().federation_rr_transactions_per_room_per_second
         )
 
+        # Regularly wake up destinations which have missed events, in case they
+        # have come back but we have nothing new to send them.
+        self.clock.looping_call(
+            self._wake_destinations_needing_catch_up, CATCH_UP_WAKE_INTERVAL_MS,
+        )
+
+    def is_shard_for_destination(self, destination):
+        """Whether we are responsible for sending to the given destination.
+
+        Args:
+            destination (str)
+
+        Returns:
+            bool
+        """
+        return get_shard_for_key(
+            destination, self._shard_count,
+        ) == self._shard_index
+
     def _get_per_destination_queue(self, destination):
         """Get or create a PerDestinationQueue for the given destination
 
@@ -136,6 +185,9 @@ class FederationSender(object):
         """
         self._last_poked_id = max(current_id, self._last_poked_id)
 
+        # the new events may have changed who should get our users' presence
+        self.presence_audience.notify_new_event()
+
         if self._is_processing:
             return
 
@@ -150,7 +202,9 @@ class FederationSender(object):
         try:
             self._is_processing = True
             while True:
-                last_token = yield self.store.get_federation_out_pos("events")
+                last_token = yield self.store.get_federation_out_pos(
+                    "events", shard_index=self._shard_index,
+                )
                 next_token, events = yield self.store.get_all_new_events_stream(
                     last_token, self._last_poked_id, limit=100,
                 )
@@ -185,7 +239,9 @@ class FederationSender(object):
                         )
                         return
 
-                    destinations = set(destinations)
+                    destinations = set(
+                        d for d in destinations if self.is_shard_for_destination(d)
+                    )
 
                     if send_on_behalf_of is not None:
                         # If we are sending the event on behalf of another server
@@ -193,6 +249,16 @@ class FederationSender(object):
                         # send the event to it.
                         destinations.discard(send_on_behalf_of)
 
+                    destinations.discard(self.server_name)
+
+                    # Record the event as the latest one for the destinations in
+                    # this room, so that we can catch them up if it doesn't reach
+                    # them.
+                    yield self.store.store_destination_rooms_entries(
+                        destinations, event.room_id,
+                        event.internal_metadata.stream_ordering,
+                    )
+
                     logger.debug("Sending %s to %r", event, destinations)
 
                     self._send_pdu(event, destinations)
@@ -215,7 +281,7 @@ class FederationSender(object):
                 ))
 
                 yield self.store.update_federation_out_pos(
-                    "events", next_token
+                    "events", next_token, shard_index=self._shard_index,
                 )
 
                 if events:
@@ -305,7 +371,10 @@ class FederationSender(object):
 
         # Work out which remote servers should be poked and poke them.
         domains = yield self.state.get_current_hosts_in_room(room_id)
-        domains = [d for d in domains if d != self.server_name]
+        domains = [
+            d for d in domains
+            if d != self.server_name and self.is_shard_for_destination(d)
+        ]
         if not domains:
             return
 
@@ -411,12 +480,16 @@ class FederationSender(object):
         Args:
             states (list(UserPresenceState))
         """
-        hosts_and_states = yield get_interested_remotes(self.store, states, self.state)
+        hosts_and_states = yield get_interested_remotes(
+            self.store, states, self.presence_audience,
+        )
 
         for destinations, states in hosts_and_states:
             for destination in destinations:
                 if destination == self.server_name:
                     continue
+                if not self.is_shard_for_destination(destination):
+                    continue
                 self._get_per_destination_queue(destination).send_presence(states)
 
     def build_and_send_edu(self, destination, edu_type, content, key=None):
@@ -463,3 +536,36 @@ class FederationSender(object):
 
     def get_current_token(self):
         return 0
+
+    def _wake_destinations_needing_catch_up(self):
+        if self._waking_destinations:
+            return
+
+        @defer.inlineCallbacks
+        def wake():
+            try:
+                last_destination = None
+                while True:
+                    destinations = (
+                        yield self.store.get_catch_up_outstanding_destinations(
+                            last_destination,
+                        )
+                    )
+                    if not destinations:
+                        return
+
+                    for destination in destinations:
+                        if not self.is_shard_for_destination(destination):
+                            continue
+
+                        logger.info("Waking %s to catch up", destination)
+                        self._get_per_destination_queue(
+                            destination,
+                        ).attempt_new_transaction()
+
+                    last_destination = destinations[-1]
+            finally:
+                self._waking_destinations = False
+
+        self._waking_destinations = True
+        run_as_background_process("wake_destinations_needing_catch_up", wake)
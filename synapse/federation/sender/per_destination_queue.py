@@ -16,7 +16,7 @@
 import datetime
 import logging
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
@@ -31,6 +31,8 @@ from synapse.handlers.presence import format_user_presence_state
 from synapse.metrics import sent_transactions_counter
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage import UserPresenceState
+from synapse.util.async_helpers import ObservableDeferred
+from synapse.util.logcontext import make_deferred_yieldable, run_in_background
 from synapse.util.retryutils import NotRetryingDestination, get_retry_limiter
 
 logger = logging.getLogger(__name__)
@@ -41,12 +43,102 @@ sent_edus_counter = Counter(
     "Total number of EDUs successfully sent",
 )
 
+catch_up_pdus_counter = Counter(
+    "synapse_federation_client_catch_up_pdus",
+    "Number of PDUs sent to destinations to catch them up on missed events",
+)
+
 sent_edus_by_type = Counter(
     "synapse_federation_client_sent_edus_by_type",
     "Number of sent EDUs successfully sent, by event type",
     ["type"],
 )
 
+sent_pdus_by_destination = Counter(
+    "synapse_federation_client_sent_pdus_by_destination",
+    "Number of PDUs successfully sent, by destination",
+    ["destination"],
+)
+
+transaction_response_time = Histogram(
+    "synapse_federation_client_transaction_response_time_seconds",
+    "Time taken for remote servers to respond to transactions",
+)
+
+# The most PDUs and EDUs which can be sent in a single transaction
+MAX_PDUS_PER_TRANSACTION = 50
+MAX_EDUS_PER_TRANSACTION = 100
+
+# Destinations which respond to transactions within this many seconds get
+# bigger transactions, and may have several in flight at once.
+FAST_TRANSACTION_SECS = 2
+
+# Destinations which take longer than this to respond get smaller transactions
+SLOW_TRANSACTION_SECS = 20
+
+# How much of each new response time goes into the moving average
+RESPONSE_TIME_SMOOTHING = 0.25
+
+
+class TransactionPacer(object):
+    """Decides how many PDUs to put in each transaction to a destination, and
+    how many transactions can be in flight to it at once, based on how quickly
+    it has been responding.
+
+    Remote servers process the PDUs in a transaction before responding to it,
+    so big transactions to a struggling server take a long time, and may time
+    out without us making any progress. So the number of PDUs is halved when a
+    transaction is slow or fails, and grows back while the destination responds
+    quickly.
+
+    Args:
+        max_in_flight (int): the most transactions which may be in flight at
+            once to a destination which is responding quickly.
+    """
+    def __init__(self, max_in_flight):
+        self._max_in_flight = max_in_flight
+
+        self.pdu_limit = MAX_PDUS_PER_TRANSACTION
+
+        # moving average of the response time in seconds, or None if we don't
+        # know it
+        self.response_time = None
+
+    def allowed_in_flight(self):
+        """Get the number of transactions which may be in flight at once
+
+        Returns:
+            int
+        """
+        if self.response_time is not None and (
+            self.response_time < FAST_TRANSACTION_SECS
+        ):
+            return self._max_in_flight
+        return 1
+
+    def record_response(self, duration):
+        """Record that the destination responded to a transaction
+
+        Args:
+            duration (float): how long the response took, in seconds
+        """
+        if self.response_time is None:
+            self.response_time = duration
+        else:
+            self.response_time += (
+                (duration - self.response_time) * RESPONSE_TIME_SMOOTHING
+            )
+
+        if duration > SLOW_TRANSACTION_SECS:
+            self.pdu_limit = max(self.pdu_limit // 2, 1)
+        elif duration < FAST_TRANSACTION_SECS:
+            self.pdu_limit = min(self.pdu_limit + 5, MAX_PDUS_PER_TRANSACTION)
+
+    def record_failure(self):
+        """Record that a transaction to the destination failed"""
+        self.response_time = None
+        self.pdu_limit = max(self.pdu_limit // 2, 1)
+
 
 class PerDestinationQueue(object):
     """
@@ -67,6 +159,39 @@ class PerDestinationQueue(object):
         self._destination = destination
         self.transmission_loop_running = False
 
+        # Whether the destination may have missed some PDUs, which we need to
+        # catch it up on before we send it any new ones. While we are catching
+        # up, new PDUs aren't queued in memory; instead we rely on them having
+        # been recorded in the destination_rooms table.
+        #
+        # We don't know what happened before we started, so we start off by
+        # checking.
+        self._catching_up = True
+
+        # The stream ordering of the latest PDU we successfully sent to the
+        # destination, or None if we haven't checked yet or have never sent it
+        # one.
+        self._last_successful_stream_ordering = None
+
+        # The stream ordering of the latest PDU which we didn't queue because we
+        # were catching up.
+        self._catch_up_last_skipped = 0
+
+        self._pacer = TransactionPacer(hs.config.federation_transaction_max_in_flight)
+
+        # The transactions which we have sent without waiting for the response,
+        # as ObservableDeferreds which resolve when they are done.
+        self._in_flight_transactions = set()
+
+        # transaction key -> stream ordering of the earliest PDU in it, for the
+        # transactions we're waiting to be acked. Transactions which fail stay
+        # in here until we start catching up, since we've not sent their PDUs.
+        self._unacked_pdu_orderings = {}
+        self._next_transaction_key = 1
+
+        # The stream ordering of the latest PDU which has been acked
+        self._acked_stream_ordering = 0
+
         # a list of tuples of (pending pdu, order)
         self._pending_pdus = []    # type: list[tuple[EventBase, int]]
         self._pending_edus = []    # type: list[Edu]
@@ -104,6 +229,9 @@ class PerDestinationQueue(object):
             + len(self._pending_edus_keyed)
         )
 
+    def in_flight_transaction_count(self):
+        return sum(1 for d in self._in_flight_transactions if not d.has_called())
+
     def send_pdu(self, pdu, order):
         """Add a PDU to the queue, and start the transmission loop if neccessary
 
@@ -111,7 +239,13 @@ class PerDestinationQueue(object):
             pdu (EventBase): pdu to send
             order (int):
         """
-        self._pending_pdus.append((pdu, order))
+        if self._catching_up and self._last_successful_stream_ordering is not None:
+            # the catch up will pick it up
+            self._catch_up_last_skipped = max(
+                self._catch_up_last_skipped, pdu.internal_metadata.stream_ordering,
+            )
+        else:
+            self._pending_pdus.append((pdu, order))
         self.attempt_new_transaction()
 
     def send_presence(self, states):
@@ -194,8 +328,28 @@ class PerDestinationQueue(object):
             # hence why we throw the result away.
             yield get_retry_limiter(self._destination, self._clock, self._store)
 
+            # Wait for any transactions still in flight from the last time
+            # round, so that we know whether we need to catch up.
+            yield self._wait_for_in_flight_transactions(0)
+
+            if self._catching_up:
+                # the catch up covers the PDUs from any transactions which
+                # failed
+                self._unacked_pdu_orderings = {}
+
+                yield self._catch_up_transmission_loop()
+                if self._catching_up:
+                    # we didn't manage to catch up this time
+                    return
+
             pending_pdus = []
             while True:
+                allowed_in_flight = self._pacer.allowed_in_flight()
+                yield self._wait_for_in_flight_transactions(allowed_in_flight - 1)
+                if self._catching_up:
+                    # one of the transactions in flight failed
+                    return
+
                 device_message_edus, device_stream_id, dev_list_id = (
                     yield self._get_new_device_messages()
                 )
@@ -211,15 +365,21 @@ class PerDestinationQueue(object):
 
                 pending_pdus = self._pending_pdus
 
-                # We can only include at most 50 PDUs per transactions
-                pending_pdus, self._pending_pdus = pending_pdus[:50], pending_pdus[50:]
+                # We can only include at most 50 PDUs per transactions, and
+                # fewer if the destination is slow to respond.
+                pdu_limit = self._pacer.pdu_limit
+                pending_pdus, self._pending_pdus = (
+                    pending_pdus[:pdu_limit], pending_pdus[pdu_limit:]
+                )
 
                 pending_edus = []
 
                 pending_edus.extend(self._get_rr_edus(force_flush=False))
 
                 # We can only include at most 100 EDUs per transactions
-                pending_edus.extend(self._pop_pending_edus(100 - len(pending_edus)))
+                pending_edus.extend(
+                    self._pop_pending_edus(MAX_EDUS_PER_TRANSACTION - len(pending_edus))
+                )
 
                 pending_edus.extend(
                     self._pending_edus_keyed.values()
@@ -253,25 +413,37 @@ class PerDestinationQueue(object):
                                  self._destination, len(pending_pdus))
 
                 if not pending_pdus and not pending_edus:
+                    if self.in_flight_transaction_count():
+                        # more may be queued while we wait for them, or they
+                        # may fail.
+                        yield self._wait_for_in_flight_transactions(0)
+                        continue
+
                     logger.debug("TX [%s] Nothing to send", self._destination)
                     self._last_device_stream_id = device_stream_id
                     return
 
                 # if we've decided to send a transaction anyway, and we have room, we
                 # may as well send any pending RRs
-                if len(pending_edus) < 100:
+                if len(pending_edus) < MAX_EDUS_PER_TRANSACTION:
                     pending_edus.extend(self._get_rr_edus(force_flush=True))
 
                 # END CRITICAL SECTION
 
-                success = yield self._transaction_manager.send_new_transaction(
-                    self._destination, pending_pdus, pending_edus
-                )
+                if allowed_in_flight > 1 and not device_message_edus:
+                    # Send the transaction without waiting for the response.
+                    # We only do this if there are no device messages in it,
+                    # since we track which of those have been sent by stream
+                    # position.
+                    self._start_in_flight_transaction(pending_pdus, pending_edus)
+                    pending_pdus = []
+
+                    self._last_device_stream_id = device_stream_id
+                    self._last_device_list_stream_id = dev_list_id
+                    continue
+
+                success = yield self._send_transaction(pending_pdus, pending_edus)
                 if success:
-                    sent_transactions_counter.inc()
-                    sent_edus_counter.inc(len(pending_edus))
-                    for edu in pending_edus:
-                        sent_edus_by_type.labels(edu.edu_type).inc()
                     # Remove the acknowledged device messages from the database
                     # Only bother if we actually sent some device messages
                     if device_message_edus:
@@ -298,6 +470,7 @@ class PerDestinationQueue(object):
                     (e.retry_last_ts + e.retry_interval) / 1000.0
                 ),
             )
+            self._start_catching_up()
         except FederationDeniedError as e:
             logger.info(e)
         except HttpResponseException as e:
@@ -305,12 +478,14 @@ class PerDestinationQueue(object):
                 "TX [%s] Received %d response to transaction: %s",
                 self._destination, e.code, e,
             )
+            self._start_catching_up()
         except RequestSendFailed as e:
             logger.warning("TX [%s] Failed to send transaction: %s", self._destination, e)
 
             for p, _ in pending_pdus:
                 logger.info("Failed to send event %s to %s", p.event_id,
                             self._destination)
+            self._start_catching_up()
         except Exception:
             logger.exception(
                 "TX [%s] Failed to send transaction",
@@ -319,10 +494,208 @@ class PerDestinationQueue(object):
             for p, _ in pending_pdus:
                 logger.info("Failed to send event %s to %s", p.event_id,
                             self._destination)
+            self._start_catching_up()
         finally:
             # We want to be *very* sure we clear this after we stop processing
             self.transmission_loop_running = False
 
+    def _start_catching_up(self):
+        """Drop the queued PDUs, and instead catch the destination up on the
+        rooms it has missed events in next time we can reach it.
+        """
+        self._catching_up = True
+        self._pending_pdus = []
+
+    @defer.inlineCallbacks
+    def _send_transaction(self, pending_pdus, pending_edus):
+        """Send a transaction, and wait for the destination to respond.
+
+        Args:
+            pending_pdus (list[tuple[EventBase, int]]): PDUs and their order
+            pending_edus (list[Edu])
+
+        Returns:
+            Deferred[bool]: whether the destination accepted the transaction
+        """
+        key = self._next_transaction_key
+        self._next_transaction_key += 1
+        if pending_pdus:
+            self._unacked_pdu_orderings[key] = min(
+                p.internal_metadata.stream_ordering for p, _ in pending_pdus
+            )
+
+        start = self._clock.time()
+        try:
+            success = yield self._transaction_manager.send_new_transaction(
+                self._destination, pending_pdus, pending_edus
+            )
+        except Exception:
+            self._pacer.record_failure()
+            raise
+
+        duration = self._clock.time() - start
+        self._pacer.record_response(duration)
+        transaction_response_time.observe(duration)
+
+        # the PDUs have either been accepted or rejected, so we won't be
+        # trying to send them again.
+        self._unacked_pdu_orderings.pop(key, None)
+
+        if success:
+            sent_transactions_counter.inc()
+            sent_edus_counter.inc(len(pending_edus))
+            for edu in pending_edus:
+                sent_edus_by_type.labels(edu.edu_type).inc()
+
+            if pending_pdus:
+                sent_pdus_by_destination.labels(self._destination).inc(
+                    len(pending_pdus),
+                )
+                yield self._pdus_acked(max(
+                    p.internal_metadata.stream_ordering for p, _ in pending_pdus
+                ))
+
+        defer.returnValue(success)
+
+    def _start_in_flight_transaction(self, pending_pdus, pending_edus):
+        """Send a transaction in the background.
+
+        If it fails we start catching up, which the transmission loop will
+        notice the next time it waits for the transactions in flight.
+        """
+        @defer.inlineCallbacks
+        def send():
+            try:
+                yield self._send_transaction(pending_pdus, pending_edus)
+            except Exception as e:
+                logger.warning(
+                    "TX [%s] Failed to send transaction: %s", self._destination, e,
+                )
+                for p, _ in pending_pdus:
+                    logger.info("Failed to send event %s to %s", p.event_id,
+                                self._destination)
+                self._start_catching_up()
+
+        self._in_flight_transactions.add(ObservableDeferred(run_in_background(send)))
+
+    @defer.inlineCallbacks
+    def _wait_for_in_flight_transactions(self, limit):
+        """Wait until there are at most `limit` transactions in flight"""
+        while True:
+            self._in_flight_transactions = set(
+                d for d in self._in_flight_transactions if not d.has_called()
+            )
+            if len(self._in_flight_transactions) <= limit:
+                return
+
+            yield make_deferred_yieldable(defer.DeferredList(
+                [d.observe() for d in self._in_flight_transactions],
+                fireOnOneCallback=True,
+            ))
+
+    @defer.inlineCallbacks
+    def _pdus_acked(self, stream_ordering):
+        """Record that the destination has acked a transaction.
+
+        Transactions can be acked out of order when there are several in
+        flight, so we only update the last successful stream ordering up to the
+        earliest PDU which hasn't been acked.
+
+        Args:
+            stream_ordering (int): the stream ordering of the latest PDU in the
+                transaction.
+        """
+        self._acked_stream_ordering = max(
+            self._acked_stream_ordering, stream_ordering,
+        )
+
+        # the PDUs are sent in stream order, so everything before the earliest
+        # unacked PDU has been acked.
+        stream_ordering = self._acked_stream_ordering
+        if self._unacked_pdu_orderings:
+            stream_ordering = min(
+                stream_ordering, min(self._unacked_pdu_orderings.values()) - 1,
+            )
+
+        yield self._set_last_successful_stream_ordering(stream_ordering)
+
+    @defer.inlineCallbacks
+    def _catch_up_transmission_loop(self):
+        """Send the destination the latest event in each room which it has
+        missed events in, rather than everything it has missed. It can then
+        fetch any others it needs itself.
+        """
+        first_check = self._last_successful_stream_ordering is None
+        if first_check:
+            self._last_successful_stream_ordering = (
+                yield self._store.get_destination_last_successful_stream_ordering(
+                    self._destination,
+                )
+            )
+
+        if self._last_successful_stream_ordering is None:
+            # we've never successfully sent the destination anything, so we
+            # don't know what it might have missed.
+            self._catching_up = False
+            return
+
+        while True:
+            last_skipped = self._catch_up_last_skipped
+            rows = yield self._store.get_catch_up_room_events(
+                self._destination, self._last_successful_stream_ordering,
+                limit=self._pacer.pdu_limit,
+            )
+
+            if not rows:
+                if self._catch_up_last_skipped != last_skipped:
+                    # a PDU was skipped while we were checking, and may not have
+                    # been recorded in time for us to see it, so check again.
+                    continue
+
+                logger.info("TX [%s] Caught up", self._destination)
+                self._catching_up = False
+                return
+
+            if first_check:
+                # there is something to catch up on, so anything we queued
+                # before we knew that will be covered by the catch up.
+                self._start_catching_up()
+                first_check = False
+
+            events = yield self._store.get_events([event_id for event_id, _ in rows])
+            catch_up_pdus = [
+                (events[event_id], stream_ordering)
+                for event_id, stream_ordering in rows
+                if event_id in events
+            ]
+
+            logger.info(
+                "TX [%s] Catching up on %d rooms", self._destination, len(rows),
+            )
+
+            if catch_up_pdus:
+                success = yield self._send_transaction(catch_up_pdus, [])
+                if not success:
+                    return
+
+                catch_up_pdus_counter.inc(len(catch_up_pdus))
+
+            # the rows are in stream order
+            yield self._set_last_successful_stream_ordering(rows[-1][1])
+
+    @defer.inlineCallbacks
+    def _set_last_successful_stream_ordering(self, stream_ordering):
+        if (
+            self._last_successful_stream_ordering is not None and
+            stream_ordering <= self._last_successful_stream_ordering
+        ):
+            return
+
+        self._last_successful_stream_ordering = stream_ordering
+        yield self._store.set_destination_last_successful_stream_ordering(
+            self._destination, stream_ordering,
+        )
+
     def _get_rr_edus(self, force_flush):
         if not self._pending_rrs:
             return
@@ -304,6 +304,8 @@ class DeviceHandler(DeviceWorkerHandler):
             user_id=user_id, device_id=device_id
         )
 
+        yield self.store.delete_lazy_loaded_members_for_device(user_id, device_id)
+
         yield self.notify_device_update(user_id, [device_id])
 
     @defer.inlineCallbacks
@@ -354,6 +356,9 @@ class DeviceHandler(DeviceWorkerHandler):
             yield self.store.delete_e2e_keys_by_device(
                 user_id=user_id, device_id=device_id
             )
+            yield self.store.delete_lazy_loaded_members_for_device(
+                user_id, device_id,
+            )
 
         yield self.notify_device_update(user_id, device_ids)
 
@@ -39,6 +39,7 @@ from synapse.api.constants import (
 from synapse.api.errors import (
     AuthError,
     CodeMessageException,
+    Codes,
     FederationDeniedError,
     FederationError,
     StoreError,
@@ -47,15 +48,16 @@ from synapse.api.errors import (
 from synapse.crypto.event_signing import compute_event_signature
 from synapse.event_auth import auth_types_for_event
 from synapse.events.validator import EventValidator
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.replication.http.federation import (
     ReplicationCleanRoomRestServlet,
     ReplicationFederationSendEventsRestServlet,
 )
 from synapse.replication.http.membership import ReplicationUserJoinedLeftRoomRestServlet
 from synapse.state import StateResolutionStore, resolve_events_with_store
-from synapse.types import UserID, get_domain_from_id
-from synapse.util import logcontext, unwrapFirstError
-from synapse.util.async_helpers import Linearizer
+from synapse.types import UserID, create_requester, get_domain_from_id
+from synapse.util import batch_iter, logcontext, unwrapFirstError
+from synapse.util.async_helpers import Linearizer, concurrently_execute
 from synapse.util.distributor import user_joined_room
 from synapse.util.logutils import log_function
 from synapse.util.retryutils import NotRetryingDestination
@@ -65,6 +67,47 @@ from ._base import BaseHandler
 
 logger = logging.getLogger(__name__)
 
+# The state which is persisted before a join completes, when joining a room
+# with partial state: the state that clients need to display the room. The
+# membership of the joining user is included too.
+PARTIAL_JOIN_STATE_TYPES = (
+    EventTypes.Create,
+    EventTypes.PowerLevels,
+    EventTypes.JoinRules,
+    EventTypes.RoomHistoryVisibility,
+    EventTypes.GuestAccess,
+    EventTypes.Name,
+    EventTypes.Topic,
+    EventTypes.RoomAvatar,
+    EventTypes.CanonicalAlias,
+    EventTypes.RoomEncryption,
+    EventTypes.ServerACL,
+    EventTypes.Tombstone,
+)
+
+# The number of events to persist at a time when persisting the rest of the
+# state of a room joined with partial state
+PARTIAL_STATE_PERSIST_BATCH_SIZE = 500
+
+# How long to wait before trying again to fetch the state of a room joined
+# with partial state, after failing to. The interval is doubled after each
+# failure, up to the maximum.
+PARTIAL_STATE_RETRY_INTERVAL_SECS = 60
+PARTIAL_STATE_MAX_RETRY_INTERVAL_SECS = 60 * 60
+
+# How long after joining a room with partial state we give up trying to fetch
+# the rest of its state, and leave the room instead.
+PARTIAL_STATE_MAX_RESYNC_TIME_SECS = 24 * 60 * 60
+
+# The maximum number of missing prev_events to request the state at at once
+MAX_CONCURRENT_STATE_FETCHES = 5
+
+# The maximum number of servers to ask for the state at a missing prev_event
+MAX_STATE_FETCH_DESTINATIONS = 5
+
+# How long to wait for each server to give us a missing prev_event, in ms
+PREV_EVENT_FETCH_TIMEOUT_MS = 10000
+
 
 def shortstr(iterable, maxitems=5):
     """If iterable has maxitems or fewer, return the stringification of a list
@@ -87,6 +130,48 @@ def shortstr(iterable, maxitems=5):
     return u"[" + u", ".join(repr(r) for r in items[:maxitems]) + u", ...]"
 
 
+def _dedupe_events(events):
+    """Yields the given events, skipping any which have already been seen
+
+    Args:
+        events (iterable[EventBase])
+
+    Returns:
+        iterable[EventBase]
+    """
+    seen_ids = set()
+    for event in events:
+        if event.event_id not in seen_ids:
+            seen_ids.add(event.event_id)
+            yield event
+
+
+def _get_auth_chain_ids(events, event_map):
+    """Gets the IDs of the given events and of the events in their auth
+    chains, as far as they can be found in event_map.
+
+    Args:
+        events (iterable[EventBase])
+        event_map (dict[str, EventBase]): the events to search for auth events
+
+    Returns:
+        set[str]
+    """
+    result = set()
+    to_visit = [event.event_id for event in events]
+    while to_visit:
+        event_id = to_visit.pop()
+        if event_id in result:
+            continue
+        result.add(event_id)
+
+        event = event_map.get(event_id)
+        if event is not None:
+            to_visit.extend(event.auth_event_ids())
+
+    return result
+
+
 class FederationHandler(BaseHandler):
     """Handles events that originated from federation.
         Responsible for:
@@ -131,6 +216,13 @@ class FederationHandler(BaseHandler):
         self.room_queues = {}
         self._room_pdu_linearizer = Linearizer("fed_room_pdu")
 
+        self._partial_state_joins = hs.config.partial_state_joins
+
+        if not hs.config.worker_app:
+            run_as_background_process(
+                "resume_partial_state_joins", self._resume_partial_state_joins,
+            )
+
     @defer.inlineCallbacks
     def on_receive_pdu(
             self, origin, pdu, sent_to_us_directly=False,
@@ -200,6 +292,18 @@ class FederationHandler(BaseHandler):
             self.room_queues[room_id].append((pdu, origin))
             return
 
+        # We can't check events against the state of the room until we have
+        # all of it. FederationServer leaves received PDUs staged until then,
+        # so this shouldn't happen, but if it does we drop the event and it
+        # will be fetched as a missing prev_event later on.
+        is_partial_state = yield self.store.is_partial_state_room(room_id)
+        if is_partial_state:
+            logger.info(
+                "[%s %s] Ignoring PDU from %s as we only have partial state",
+                room_id, event_id, origin,
+            )
+            return
+
         # If we're not in the room just ditch the event entirely. This is
         # probably an old server that has come back and thinks we're still in
         # the room (or we've been rejoined to the room by a state reset).
@@ -332,30 +436,53 @@ class FederationHandler(BaseHandler):
                     # we don't need this any more, let's delete it.
                     del ours
 
+                    room_version = yield self.store.get_room_version(room_id)
+
+                    # if the origin can't give us the state at a missing
+                    # prev_event, try (a few of) the other servers in the room.
+                    other_hosts = yield self.store.get_hosts_in_room(room_id)
+                    destinations = [origin] + [
+                        h for h in other_hosts
+                        if h != origin and h != self.server_name
+                    ]
+                    destinations = destinations[:MAX_STATE_FETCH_DESTINATIONS]
+
                     # Ask the remote server for the states we don't
                     # know about
-                    for p in prevs - seen:
+                    @defer.inlineCallbacks
+                    def fetch_state(p):
                         logger.info(
                             "[%s %s] Requesting state at missing prev_event %s",
                             room_id, event_id, p,
                         )
 
-                        room_version = yield self.store.get_room_version(room_id)
-
                         with logcontext.nested_logging_context(p):
                             # note that if any of the missing prevs share missing state or
                             # auth events, the requests to fetch those events are deduped
-                            # by the get_pdu_cache in federation_client.
-                            remote_state, got_auth_chain = (
-                                yield self.federation_client.get_state_for_room(
-                                    origin, room_id, p,
+                            # by federation_client.get_pdu.
+                            for destination in destinations:
+                                try:
+                                    remote_state, got_auth_chain = (
+                                        yield self.federation_client.get_state_for_room(
+                                            destination, room_id, p,
+                                        )
+                                    )
+                                    break
+                                except Exception as e:
+                                    logger.warn(
+                                        "[%s %s] Failed to get state at %s from %s: %s",
+                                        room_id, event_id, p, destination, e,
+                                    )
+                            else:
+                                raise Exception(
+                                    "Unable to get state at missing prev_event %s" % (p, )
                                 )
-                            )
 
                             # we want the state *after* p; get_state_for_room returns the
                             # state *before* p.
                             remote_event = yield self.federation_client.get_pdu(
-                                [origin], p, room_version, outlier=True,
+                                destinations, p, room_version, outlier=True,
+                                timeout=PREV_EVENT_FETCH_TIMEOUT_MS,
                             )
 
                             if remote_event is None:
@@ -379,6 +506,10 @@ class FederationHandler(BaseHandler):
                             for x in remote_state:
                                 event_map[x.event_id] = x
 
+                    yield concurrently_execute(
+                        fetch_state, prevs - seen, MAX_CONCURRENT_STATE_FETCHES,
+                    )
+
                     state_map = yield resolve_events_with_store(
                         room_version, state_maps, event_map,
                         state_res_store=StateResolutionStore(self.store),
@@ -1133,6 +1264,14 @@ class FederationHandler(BaseHandler):
 
         We suspend processing of any received events from this room until we
         have finished processing the join.
+
+        If `partial_state_joins` is enabled, the join completes once the state
+        which clients need to display the room has been persisted, and the rest
+        of the state is persisted in the background. Received events stay
+        suspended, and local users can't send events to the room other than to
+        leave it, until that has finished. If we can't get the rest of the
+        state within PARTIAL_STATE_MAX_RESYNC_TIME_SECS, the local users leave
+        the room again.
         """
         logger.debug("Joining %s to %s", joinee, room_id)
 
@@ -1158,6 +1297,9 @@ class FederationHandler(BaseHandler):
 
         handled_events = set()
 
+        partial_state = self._partial_state_joins
+        joined_with_partial_state = False
+
         try:
             # Try the host we successfully got a response to /make_join/
             # request first.
@@ -1194,25 +1336,224 @@ class FederationHandler(BaseHandler):
                 # FIXME
                 pass
 
-            yield self._persist_auth_tree(
-                origin, auth_chain, state, event
-            )
+            if partial_state:
+                # Mark the room before persisting anything, so that if we get
+                # restarted we know to fetch the rest of the state.
+                yield self.store.store_partial_state_room(
+                    room_id, event.event_id, target_hosts,
+                )
+
+            try:
+                remaining_events = yield self._persist_auth_tree(
+                    origin, auth_chain, state, event, partial_state=partial_state,
+                )
+            except Exception:
+                if partial_state:
+                    yield self.store.clear_partial_state_room(room_id)
+                raise
+
+            joined_with_partial_state = partial_state
 
             logger.debug("Finished joining %s to %s", joinee, room_id)
         finally:
-            room_queue = self.room_queues[room_id]
-            del self.room_queues[room_id]
+            if joined_with_partial_state:
+                # keep queuing events for the room until we have its full state
+                run_as_background_process(
+                    "sync_partial_state_room", self._sync_partial_state_room,
+                    room_id, event, target_hosts, state, remaining_events,
+                )
+            else:
+                room_queue = self.room_queues[room_id]
+                del self.room_queues[room_id]
 
-            # we don't need to wait for the queued events to be processed -
-            # it's just a best-effort thing at this point. We do want to do
-            # them roughly in order, though, otherwise we'll end up making
-            # lots of requests for missing prev_events which we do actually
-            # have. Hence we fire off the deferred, but don't wait for it.
+                # we don't need to wait for the queued events to be processed -
+                # it's just a best-effort thing at this point. We do want to do
+                # them roughly in order, though, otherwise we'll end up making
+                # lots of requests for missing prev_events which we do actually
+                # have. Hence we fire off the deferred, but don't wait for it.
 
-            logcontext.run_in_background(self._handle_queued_pdus, room_queue)
+                logcontext.run_in_background(self._handle_queued_pdus, room_queue)
 
         defer.returnValue(True)
 
+    @defer.inlineCallbacks
+    def _sync_partial_state_room(self, room_id, event, servers, state=None,
+                                 events_and_contexts=None):
+        """Persists the rest of the state of a room which we joined with
+        partial state, then processes the events which were queued in the
+        meantime.
+
+        Args:
+            room_id (str)
+            event (EventBase): the join event, which was persisted with partial
+                state.
+            servers (list[str]): servers which we can fetch the state from, if
+                we don't already have it.
+            state (list[EventBase]|None): the full state before the join event,
+                if we already have it.
+            events_and_contexts (list[(EventBase, EventContext)]|None): the
+                state and auth chain events which still need persisting, if we
+                already have the state.
+        """
+        self.room_queues.setdefault(room_id, [])
+        try:
+            if state is not None:
+                try:
+                    yield self._complete_partial_state_join(
+                        room_id, event, state, events_and_contexts,
+                    )
+                    return
+                except Exception:
+                    logger.exception(
+                        "Failed to persist the rest of the state of %s", room_id,
+                    )
+
+            yield self._resync_partial_state_room(room_id, event, servers)
+        finally:
+            room_queue = self.room_queues.pop(room_id, [])
+            yield self._handle_queued_pdus(room_queue)
+
+    @defer.inlineCallbacks
+    def _resync_partial_state_room(self, room_id, event, servers):
+        """Fetches the state at a join which was persisted with partial state
+        from one of the given servers, and persists the rest of it. Keeps
+        retrying until it succeeds, or until PARTIAL_STATE_MAX_RESYNC_TIME_SECS
+        after the join, at which point the local users leave the room.
+        """
+        # We count from the join rather than from when we started trying, so
+        # that restarts don't extend the deadline.
+        give_up_ts = event.origin_server_ts + PARTIAL_STATE_MAX_RESYNC_TIME_SECS * 1000
+
+        retry_interval = PARTIAL_STATE_RETRY_INTERVAL_SECS
+        while True:
+            for server in servers:
+                if server == self.server_name:
+                    continue
+
+                try:
+                    state, auth_chain = yield self.federation_client.get_state_for_room(
+                        server, room_id, event.event_id,
+                    )
+                    events_to_context = yield self._check_auth_tree(
+                        server, auth_chain, state, event,
+                    )
+                    seen_ids = yield self.store.have_seen_events(
+                        list(events_to_context),
+                    )
+                    events_and_contexts = [
+                        (e, events_to_context[e.event_id])
+                        for e in _dedupe_events(itertools.chain(auth_chain, state))
+                        if e.event_id not in seen_ids
+                    ]
+
+                    yield self._complete_partial_state_join(
+                        room_id, event, state, events_and_contexts,
+                    )
+                    return
+                except Exception as e:
+                    logger.warn(
+                        "Failed to fetch the state of %s from %s: %s",
+                        room_id, server, e,
+                    )
+
+            if self.clock.time_msec() >= give_up_ts:
+                logger.warn(
+                    "Giving up on fetching the state of %s; leaving the room",
+                    room_id,
+                )
+                yield self._leave_partial_state_room(room_id)
+                return
+
+            # The events we have queued will be fetched again as missing
+            # prev_events once we have the state, so don't hang on to them.
+            logger.info(
+                "Failed to fetch the state of %s; retrying in %ss",
+                room_id, retry_interval,
+            )
+            self.room_queues[room_id] = []
+
+            yield self.clock.sleep(retry_interval)
+            retry_interval = min(
+                retry_interval * 2, PARTIAL_STATE_MAX_RETRY_INTERVAL_SECS,
+            )
+
+    @defer.inlineCallbacks
+    def _leave_partial_state_room(self, room_id):
+        """Makes the local users leave a room which we joined with partial
+        state, and whose full state we have given up on fetching, and then
+        stops treating it as a partial state room.
+        """
+        member_handler = self.hs.get_room_member_handler()
+
+        user_ids = yield self.store.get_users_in_room(room_id)
+        for user_id in user_ids:
+            if not self.is_mine_id(user_id):
+                continue
+
+            try:
+                yield member_handler.update_membership(
+                    create_requester(user_id), UserID.from_string(user_id),
+                    room_id, Membership.LEAVE,
+                )
+            except Exception:
+                logger.exception("Failed to make %s leave %s", user_id, room_id)
+
+        yield self.store.clear_partial_state_room(room_id)
+
+    @defer.inlineCallbacks
+    def _complete_partial_state_join(self, room_id, event, state,
+                                     events_and_contexts):
+        """Persists the given state and auth chain events, and then replaces
+        the partial state at the join event with the full state.
+
+        Args:
+            room_id (str)
+            event (EventBase): the join event
+            state (list[EventBase]): the full state before the join event
+            events_and_contexts (list[(EventBase, EventContext)]): the events
+                which still need persisting.
+        """
+        logger.info(
+            "Persisting the remaining %i state and auth events of %s",
+            len(events_and_contexts), room_id,
+        )
+        for batch in batch_iter(events_and_contexts, PARTIAL_STATE_PERSIST_BATCH_SIZE):
+            yield self.persist_events_and_notify(list(batch))
+
+        state_ids = {(e.type, e.state_key): e.event_id for e in state}
+        state_ids[(event.type, event.state_key)] = event.event_id
+
+        yield self.store.complete_partial_state_join(
+            room_id, event.event_id, state_ids,
+        )
+
+        # Wake up anyone syncing the room, so they get sent the full state.
+        # (See SyncHandler._get_rooms_changed.)
+        self.notifier.on_new_event(
+            "room_key", self.store.get_room_max_stream_ordering(), rooms=[room_id],
+        )
+        self.notifier.on_new_replication_data()
+
+        logger.info("Finished persisting the state of %s", room_id)
+
+    @defer.inlineCallbacks
+    def _resume_partial_state_joins(self):
+        """Starts fetching the state of any rooms which we were in the middle
+        of joining with partial state when we were restarted.
+        """
+        rooms = yield self.store.get_partial_state_rooms()
+        for room_id, (join_event_id, servers) in iteritems(rooms):
+            event = yield self.store.get_event(join_event_id, allow_none=True)
+            if event is None:
+                # We were restarted before the join was persisted
+                yield self.store.clear_partial_state_room(room_id)
+                continue
+
+            run_as_background_process(
+                "sync_partial_state_room", self._sync_partial_state_room,
+                room_id, event, servers,
+            )
+
     @defer.inlineCallbacks
     def _handle_queued_pdus(self, room_queue):
         """Process PDUs which got queued up while we were busy send_joining.
@@ -1239,6 +1580,8 @@ class FederationHandler(BaseHandler):
         join event for the room and return that. We do *not* persist or
         process it until the other server has signed it and sent it back.
         """
+        yield self._check_has_full_state(room_id)
+
         event_content = {"membership": Membership.JOIN}
 
         room_version = yield self.store.get_room_version(room_id)
@@ -1500,10 +1843,23 @@ class FederationHandler(BaseHandler):
 
         defer.returnValue(None)
 
+    @defer.inlineCallbacks
+    def _check_has_full_state(self, room_id):
+        """Raises if we have only persisted part of the state of the room, so
+        can't tell other servers about it yet.
+        """
+        is_partial_state = yield self.store.is_partial_state_room(room_id)
+        if is_partial_state:
+            raise SynapseError(
+                404, "Still fetching the state of room %s" % (room_id,),
+                Codes.NOT_FOUND,
+            )
+
     @defer.inlineCallbacks
     def get_state_for_pdu(self, room_id, event_id):
         """Returns the state at the event. i.e. not including said event.
         """
+        yield self._check_has_full_state(room_id)
 
         event = yield self.store.get_event(
             event_id, allow_none=False, check_room_id=room_id,
@@ -1538,6 +1894,8 @@ class FederationHandler(BaseHandler):
     def get_state_ids_for_pdu(self, room_id, event_id):
         """Returns the state at the event. i.e. not including said event.
         """
+        yield self._check_has_full_state(room_id)
+
         event = yield self.store.get_event(
             event_id, allow_none=False, check_room_id=room_id,
         )
@@ -1694,7 +2052,8 @@ class FederationHandler(BaseHandler):
         )
 
     @defer.inlineCallbacks
-    def _persist_auth_tree(self, origin, auth_events, state, event):
+    def _persist_auth_tree(self, origin, auth_events, state, event,
+                           partial_state=False):
         """Checks the auth chain is valid (and passes auth checks) for the
         state and event. Then persists the auth chain and state atomically.
         Persists the event separately. Notifies about the persisted events
@@ -1707,9 +2066,79 @@ class FederationHandler(BaseHandler):
             auth_events (list)
             state (list)
             event (Event)
+            partial_state (bool): if True, only the state which clients need
+                (see PARTIAL_JOIN_STATE_TYPES) and its auth chain are persisted
+                before the event, and the rest are left for the caller.
 
         Returns:
-            Deferred
+            Deferred[list[(EventBase, EventContext)]]: the auth chain and state
+                events which weren't persisted, if partial_state.
+        """
+        events_to_context = yield self._check_auth_tree(
+            origin, auth_events, state, event,
+        )
+
+        events_and_contexts = [
+            (e, events_to_context[e.event_id])
+            for e in itertools.chain(auth_events, state)
+        ]
+
+        remaining_events_and_contexts = []
+        if partial_state:
+            all_events = list(_dedupe_events(itertools.chain(auth_events, state)))
+
+            state = [
+                e for e in state
+                if (e.type in PARTIAL_JOIN_STATE_TYPES and e.state_key == "")
+                or (e.type == EventTypes.Member and e.state_key == event.state_key)
+            ]
+
+            needed_ids = _get_auth_chain_ids(
+                itertools.chain(state, [event]),
+                {e.event_id: e for e in all_events},
+            )
+
+            events_and_contexts = []
+            for e in all_events:
+                if e.event_id in needed_ids:
+                    events_and_contexts.append((e, events_to_context[e.event_id]))
+                else:
+                    remaining_events_and_contexts.append(
+                        (e, events_to_context[e.event_id]),
+                    )
+
+        yield self.persist_events_and_notify(events_and_contexts)
+
+        new_event_context = yield self.state_handler.compute_event_context(
+            event, old_state=state
+        )
+
+        yield self.persist_events_and_notify(
+            [(event, new_event_context)],
+        )
+
+        defer.returnValue(remaining_events_and_contexts)
+
+    @defer.inlineCallbacks
+    def _check_auth_tree(self, origin, auth_events, state, event):
+        """Computes contexts for the auth chain and state for an event, and
+        checks that they (and the event) pass auth checks. Events which don't
+        are marked as rejected in their context.
+
+        Will attempt to fetch missing auth events.
+
+        Args:
+            origin (str): Where the events came from
+            auth_events (list)
+            state (list)
+            event (Event)
+
+        Returns:
+            Deferred[dict[str, EventContext]]: map from event_id to context,
+                for the auth_events and state.
+
+        Raises:
+            SynapseError if `event` fails the auth checks.
         """
         events_to_context = {}
         for e in itertools.chain(auth_events, state):
@@ -1741,18 +2170,17 @@ class FederationHandler(BaseHandler):
                 if e_id not in event_map:
                     missing_auth_events.add(e_id)
 
-        for e_id in missing_auth_events:
-            m_ev = yield self.federation_client.get_pdu(
-                [origin],
-                e_id,
-                room_version=room_version,
-                outlier=True,
-                timeout=10000,
-            )
-            if m_ev and m_ev.event_id == e_id:
-                event_map[e_id] = m_ev
-            else:
-                logger.info("Failed to find auth event %r", e_id)
+        fetched = yield self.federation_client.get_pdus(
+            [origin],
+            missing_auth_events,
+            room_version=room_version,
+            outlier=True,
+            timeout=10000,
+        )
+        event_map.update(fetched)
+
+        for e_id in missing_auth_events - set(fetched):
+            logger.info("Failed to find auth event %r", e_id)
 
         for e in itertools.chain(auth_events, state, [event]):
             auth_for_e = {
@@ -1781,20 +2209,7 @@ class FederationHandler(BaseHandler):
                     raise
                 events_to_context[e.event_id].rejected = RejectedReason.AUTH_ERROR
 
-        yield self.persist_events_and_notify(
-            [
-                (e, events_to_context[e.event_id])
-                for e in itertools.chain(auth_events, state)
-            ],
-        )
-
-        new_event_context = yield self.state_handler.compute_event_context(
-            event, old_state=state
-        )
-
-        yield self.persist_events_and_notify(
-            [(event, new_event_context)],
-        )
+        defer.returnValue(events_to_context)
 
     @defer.inlineCallbacks
     def _prep_event(self, origin, event, state, auth_events, backfilled):
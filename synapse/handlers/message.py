@@ -295,6 +295,24 @@ class EventCreationHandler(object):
             except NotFoundError:
                 raise AuthError(403, "Unknown room")
 
+            # We can't create events until we have the whole state of the
+            # room, except for users leaving it, which only need their own
+            # membership to be authorised. See FederationHandler.do_invite_join.
+            is_partial_state = yield self.store.is_partial_state_room(
+                event_dict["room_id"],
+            )
+            is_leave = (
+                event_dict["type"] == EventTypes.Member and
+                event_dict.get("state_key") == event_dict["sender"] and
+                event_dict["content"].get("membership") == Membership.LEAVE
+            )
+            if is_partial_state and not is_leave:
+                raise SynapseError(
+                    503,
+                    "Still joining this room; try again later",
+                    Codes.UNKNOWN,
+                )
+
         builder = self.event_builder_factory.new(room_version, event_dict)
 
         self.validator.validate_builder(builder)
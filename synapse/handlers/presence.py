@@ -23,6 +23,7 @@ The methods that define policy are:
 """
 
 import logging
+from array import array
 from contextlib import contextmanager
 
 from six import iteritems, itervalues
@@ -150,6 +151,13 @@ class PresenceHandler(object):
             lambda: len(self.user_to_current_state)
         )
 
+        # The fields of the states in user_to_current_state which are needed to
+        # check for timeouts, kept in columns so that they can be checked in
+        # bulk. This must be updated whenever user_to_current_state is.
+        self.state_columns = PresenceStateColumns(self.is_mine_id)
+        for state in active_presence:
+            self.state_columns.update(state)
+
         now = self.clock.time_msec()
         for state in active_presence:
             self.wheel_timer.insert(
@@ -317,6 +325,7 @@ class PresenceHandler(object):
                 )
 
                 self.user_to_current_state[user_id] = new_state
+                self.state_columns.update(new_state)
 
                 if should_notify:
                     to_notify[user_id] = new_state
@@ -366,23 +375,29 @@ class PresenceHandler(object):
                 ]
                 for process_id in expired_process_ids:
                     users_to_check.update(
-                        self.external_process_last_updated_ms.pop(process_id, ())
+                        self.external_process_to_current_syncs.pop(process_id, ())
                     )
-                    self.external_process_last_update.pop(process_id)
+                    self.external_process_last_updated_ms.pop(process_id)
 
-                states = [
-                    self.user_to_current_state.get(
-                        user_id, UserPresenceState.default(user_id)
-                    )
-                    for user_id in users_to_check
-                ]
+                timers_fired_counter.inc(len(users_to_check))
+
+                syncing_user_ids = self.get_currently_syncing_users()
 
-                timers_fired_counter.inc(len(states))
+                # Work out which users' states will change from the columns,
+                # so that we only need to look at the state objects (and build
+                # new ones) for those users. (Users without a current state are
+                # offline, and so don't have any timeouts.)
+                timed_out_user_ids = self.state_columns.get_timed_out_users(
+                    users_to_check, syncing_user_ids, now,
+                )
 
                 changes = handle_timeouts(
-                    states,
+                    [
+                        self.user_to_current_state[user_id]
+                        for user_id in timed_out_user_ids
+                    ],
                     is_mine_fn=self.is_mine_id,
-                    syncing_user_ids=self.get_currently_syncing_users(),
+                    syncing_user_ids=syncing_user_ids,
                     now=now,
                 )
 
@@ -1106,6 +1121,123 @@ class PresenceEventSource(object):
         defer.returnValue(users_interested_in)
 
 
+# The values of PresenceStateColumns' state column
+_STATE_OFFLINE = 0
+_STATE_ONLINE = 1
+_STATE_OTHER = 2
+
+_STATE_CODES = {
+    PresenceState.OFFLINE: _STATE_OFFLINE,
+    PresenceState.ONLINE: _STATE_ONLINE,
+}
+
+
+class PresenceStateColumns(object):
+    """Stores the fields of users' presence states which `handle_timeout`
+    looks at, as columns indexed by a per-user index, so that a batch of users
+    can be checked for timeouts without looking up and unpacking their
+    UserPresenceState objects.
+
+    Users without an entry are treated as offline.
+    """
+
+    def __init__(self, is_mine_fn):
+        """
+        Args:
+            is_mine_fn (fn): Function that returns if a user_id is ours
+        """
+        self._is_mine_fn = is_mine_fn
+
+        # user_id -> index into the columns
+        self._index_by_user = {}
+
+        # The columns. We use doubles for the timestamps as they can hold
+        # millisecond timestamps exactly, and 'q' isn't available on python 2.
+        self._state = array("b")
+        self._is_mine = array("b")
+        self._last_active_ts = array("d")
+        self._last_user_sync_ts = array("d")
+        self._last_federation_update_ts = array("d")
+
+    def __len__(self):
+        return len(self._index_by_user)
+
+    def update(self, state):
+        """Update the columns with the user's new presence state.
+
+        Args:
+            state (UserPresenceState)
+        """
+        index = self._index_by_user.get(state.user_id)
+        if index is None:
+            index = len(self._index_by_user)
+            self._index_by_user[state.user_id] = index
+
+            self._state.append(_STATE_OFFLINE)
+            self._is_mine.append(bool(self._is_mine_fn(state.user_id)))
+            self._last_active_ts.append(0)
+            self._last_user_sync_ts.append(0)
+            self._last_federation_update_ts.append(0)
+
+        self._state[index] = _STATE_CODES.get(state.state, _STATE_OTHER)
+        self._last_active_ts[index] = state.last_active_ts
+        self._last_user_sync_ts[index] = state.last_user_sync_ts
+        self._last_federation_update_ts[index] = state.last_federation_update_ts
+
+    def get_timed_out_users(self, user_ids, syncing_user_ids, now):
+        """Find which of the given users have a presence state which
+        `handle_timeout` will change.
+
+        Args:
+            user_ids (Iterable[str]): the users to check
+            syncing_user_ids (set): Set of user_ids with active syncs.
+            now (int): Current time in ms.
+
+        Returns:
+            list[str]: the users whose states will change
+        """
+        index_by_user = self._index_by_user
+        state_col = self._state
+        is_mine_col = self._is_mine
+        last_active_col = self._last_active_ts
+        last_sync_col = self._last_user_sync_ts
+        last_federation_col = self._last_federation_update_ts
+
+        # We compare the timestamps against these, rather than subtracting
+        # them from now. (We don't need to check the idle timer separately, as
+        # it is longer than LAST_ACTIVE_GRANULARITY.)
+        active_before = now - LAST_ACTIVE_GRANULARITY
+        ping_before = now - FEDERATION_PING_INTERVAL
+        sync_before = now - SYNC_ONLINE_TIMEOUT
+        federation_before = now - FEDERATION_TIMEOUT
+
+        timed_out = []
+        for user_id in user_ids:
+            index = index_by_user.get(user_id)
+            if index is None:
+                continue
+
+            state = state_col[index]
+            if state == _STATE_OFFLINE:
+                continue
+
+            if is_mine_col[index]:
+                last_active_ts = last_active_col[index]
+                if (
+                    (state == _STATE_ONLINE and last_active_ts < active_before) or
+                    last_federation_col[index] < ping_before or
+                    (
+                        user_id not in syncing_user_ids and
+                        max(last_sync_col[index], last_active_ts) < sync_before
+                    )
+                ):
+                    timed_out.append(user_id)
+            elif last_federation_col[index] < federation_before:
+                timed_out.append(user_id)
+
+        return timed_out
+
+
 def handle_timeouts(user_states, is_mine_fn, syncing_user_ids, now):
     """Checks the presence of users that have timed out and updates as
     appropriate.
@@ -1305,7 +1437,7 @@ def get_interested_parties(store, states):
 
 
 @defer.inlineCallbacks
-def get_interested_remotes(store, states, state_handler):
+def get_interested_remotes(store, states, presence_audience):
     """Given a list of presence states figure out which remote servers
     should be sent which.
 
@@ -1314,6 +1446,7 @@ def get_interested_remotes(store, states, state_handler):
     Args:
         store (DataStore)
         states (list(UserPresenceState))
+        presence_audience (PresenceAudience)
 
     Returns:
         Deferred list of ([destinations], [UserPresenceState]), where for
@@ -1322,17 +1455,16 @@ def get_interested_remotes(store, states, state_handler):
     """
     hosts_and_states = []
 
-    # First we look up the rooms each user is in (as well as any explicit
-    # subscriptions), then for each distinct room we look up the remote
-    # hosts in those rooms.
-    room_ids_to_states, users_to_states = yield get_interested_parties(store, states)
+    for state in states:
+        # The servers which share a room with the user, which are tracked as
+        # memberships change rather than looked up room by room...
+        hosts = yield presence_audience.get_remote_hosts(state.user_id)
 
-    for room_id, states in iteritems(room_ids_to_states):
-        hosts = yield state_handler.get_current_hosts_in_room(room_id)
-        hosts_and_states.append((hosts, states))
+        # ... plus those with users who have explicitly subscribed.
+        plist = yield store.get_presence_list_observers_accepted(state.user_id)
+        hosts.update(get_domain_from_id(u) for u in plist)
 
-    for user_id, states in iteritems(users_to_states):
-        host = get_domain_from_id(user_id)
-        hosts_and_states.append(([host], states))
+        if hosts:
+            hosts_and_states.append((hosts, [state]))
 
     defer.returnValue(hosts_and_states)
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.types import get_domain_from_id
+from synapse.util.async_helpers import Linearizer
+from synapse.util.metrics import Measure
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceAudience(object):
+    """Tracks the "presence audience" of local users, i.e. the remote servers
+    which share a room with them and so should be sent their presence.
+
+    Looking the audience up from scratch means fetching the hosts in every
+    room the user is in, which gets expensive for users in lots of rooms. So
+    instead a user's audience is calculated the first time it is asked for,
+    and then kept up to date by applying the membership changes from the
+    current state delta stream. Only the rooms which a tracked user is in are
+    tracked.
+
+    On the main process the deltas are read from the database when
+    `notify_new_event` is called; on workers they must be fed in from the
+    replication stream with `process_replication_rows`.
+    """
+
+    def __init__(self, hs):
+        self.store = hs.get_datastore()
+        self.clock = hs.get_clock()
+        self.server_name = hs.hostname
+
+        # Whether we read deltas from the database, rather than being sent them
+        # over replication
+        self._poll_database = not hs.config.worker_app
+
+        # The position in the current state delta stream we are up to. We
+        # don't track anything to start with, so can start from the current
+        # position when we're first asked for it.
+        self._pos = None
+
+        # Serialises the processing of deltas and the loading of new users and
+        # rooms, so that they see a consistent view of the index.
+        self._linearizer = Linearizer(name="presence_audience")
+
+        # Guard to ensure we only poll for deltas once at a time
+        self._is_processing = False
+
+        # room_id -> set of joined user_ids, for the rooms being tracked
+        self._members_by_room = {}
+
+        # room_id -> dict of host -> number of joined members from that host
+        self._hosts_by_room = {}
+
+        # room_id -> set of the tracked users in the room
+        self._tracked_users_by_room = {}
+
+        # user_id -> set of room_ids, for the users being tracked
+        self._rooms_by_user = {}
+
+        # user_id -> dict of host -> number of rooms the user shares with it
+        self._hosts_by_user = {}
+
+        # The users whose audience has been fully calculated. A user is added
+        # to _rooms_by_user and _hosts_by_user as soon as we start tracking
+        # them, so get_remote_hosts checks this before reading their audience
+        # without taking the linearizer.
+        self._fully_tracked_users = set()
+
+        LaterGauge(
+            "synapse_handlers_presence_audience_tracked_users",
+            "Number of users whose presence audience is being tracked",
+            [],
+            lambda: len(self._rooms_by_user),
+        )
+        LaterGauge(
+            "synapse_handlers_presence_audience_tracked_rooms",
+            "Number of rooms tracked for presence audiences",
+            [],
+            lambda: len(self._members_by_room),
+        )
+
+    def get_current_token(self):
+        if self._pos is None:
+            self._pos = self.store.get_room_max_stream_ordering()
+        return self._pos
+
+    @defer.inlineCallbacks
+    def get_remote_hosts(self, user_id):
+        """Get the remote servers which share a room with the given local user.
+
+        Args:
+            user_id (str)
+
+        Returns:
+            Deferred[set[str]]
+        """
+        if user_id not in self._fully_tracked_users:
+            with (yield self._linearizer.queue(())):
+                if user_id not in self._fully_tracked_users:
+                    yield self._track_user(user_id)
+        hosts = self._hosts_by_user[user_id]
+
+        defer.returnValue(set(h for h in hosts if h != self.server_name))
+
+    def notify_new_event(self):
+        """Called when there may be new deltas in the database to process
+        """
+        if not self._poll_database or self._is_processing:
+            return
+
+        @defer.inlineCallbacks
+        def process():
+            try:
+                yield self._unsafe_process()
+            finally:
+                self._is_processing = False
+
+        self._is_processing = True
+        run_as_background_process("presence_audience.notify_new_event", process)
+
+    @defer.inlineCallbacks
+    def _unsafe_process(self):
+        # Loop round handling deltas until we're up to date
+        while True:
+            deltas = yield self.store.get_current_state_deltas(
+                self.get_current_token(),
+            )
+            if not deltas:
+                return
+
+            yield self._handle_deltas([
+                (d["room_id"], d["type"], d["state_key"], d["event_id"])
+                for d in deltas
+            ])
+
+            self._pos = deltas[-1]["stream_id"]
+
+    def process_replication_rows(self, token, rows):
+        """Handle new rows from the current state delta replication stream.
+
+        Args:
+            token (int): the stream position of the rows
+            rows (list[synapse.replication.tcp.streams.CurrentStateDeltaStreamRow])
+        """
+        self._pos = token
+
+        deltas = [(r.room_id, r.type, r.state_key, r.event_id) for r in rows]
+        run_as_background_process(
+            "presence_audience.process_replication_rows", self._handle_deltas, deltas,
+        )
+
+    @defer.inlineCallbacks
+    def _handle_deltas(self, deltas):
+        """
+        Args:
+            deltas (list[tuple[str, str, str, str|None]]): list of room_id, type,
+                state_key and event_id of the new current state. The event_id
+                is None if the state was removed.
+        """
+        with (yield self._linearizer.queue(())):
+            with Measure(self.clock, "presence_audience_deltas"):
+                for room_id, typ, state_key, event_id in deltas:
+                    if typ != EventTypes.Member:
+                        continue
+
+                    room_tracked = room_id in self._members_by_room
+                    user_tracked = state_key in self._rooms_by_user
+                    if not room_tracked and not user_tracked:
+                        continue
+
+                    joined = False
+                    if event_id:
+                        event = yield self.store.get_event(event_id, allow_none=True)
+                        joined = bool(event and event.membership == Membership.JOIN)
+
+                    if room_tracked:
+                        self._update_member(room_id, state_key, joined)
+
+                    if user_tracked:
+                        if joined:
+                            yield self._add_tracked_user_to_room(state_key, room_id)
+                        else:
+                            self._remove_tracked_user_from_room(state_key, room_id)
+
+    @defer.inlineCallbacks
+    def _track_user(self, user_id):
+        self._rooms_by_user[user_id] = set()
+        self._hosts_by_user[user_id] = {}
+
+        try:
+            room_ids = yield self.store.get_rooms_for_user(user_id)
+            for room_id in room_ids:
+                yield self._add_tracked_user_to_room(user_id, room_id)
+        except Exception:
+            # forget the partially calculated audience, so that we start again
+            # next time.
+            for room_id in list(self._rooms_by_user[user_id]):
+                self._remove_tracked_user_from_room(user_id, room_id)
+            del self._rooms_by_user[user_id]
+            del self._hosts_by_user[user_id]
+            raise
+
+        self._fully_tracked_users.add(user_id)
+
+    @defer.inlineCallbacks
+    def _add_tracked_user_to_room(self, user_id, room_id):
+        rooms = self._rooms_by_user[user_id]
+        if room_id in rooms:
+            return
+
+        if room_id not in self._members_by_room:
+            user_ids = yield self.store.get_users_in_room(room_id)
+
+            # we may have started tracking the room while we were waiting
+            if room_id not in self._members_by_room:
+                self._members_by_room[room_id] = set()
+                self._hosts_by_room[room_id] = {}
+                self._tracked_users_by_room[room_id] = set()
+                for member in user_ids:
+                    self._update_member(room_id, member, True)
+
+        rooms.add(room_id)
+        self._tracked_users_by_room[room_id].add(user_id)
+
+        hosts = self._hosts_by_user[user_id]
+        for host in self._hosts_by_room[room_id]:
+            hosts[host] = hosts.get(host, 0) + 1
+
+    def _remove_tracked_user_from_room(self, user_id, room_id):
+        rooms = self._rooms_by_user[user_id]
+        if room_id not in rooms:
+            return
+
+        rooms.discard(room_id)
+
+        hosts = self._hosts_by_user[user_id]
+        for host in self._hosts_by_room[room_id]:
+            _decrement(hosts, host)
+
+        tracked_users = self._tracked_users_by_room[room_id]
+        tracked_users.discard(user_id)
+        if not tracked_users:
+            # nobody we care about is in the room any more
+            del self._members_by_room[room_id]
+            del self._hosts_by_room[room_id]
+            del self._tracked_users_by_room[room_id]
+
+    def _update_member(self, room_id, user_id, joined):
+        """Update the membership of a user in a tracked room, and the audiences
+        of the tracked users in the room if a server joins or leaves it.
+        """
+        members = self._members_by_room[room_id]
+        if joined == (user_id in members):
+            return
+
+        host = get_domain_from_id(user_id)
+        hosts_in_room = self._hosts_by_room[room_id]
+
+        if joined:
+            members.add(user_id)
+            hosts_in_room[host] = hosts_in_room.get(host, 0) + 1
+            if hosts_in_room[host] == 1:
+                for tracked_user_id in self._tracked_users_by_room[room_id]:
+                    hosts = self._hosts_by_user[tracked_user_id]
+                    hosts[host] = hosts.get(host, 0) + 1
+        else:
+            members.discard(user_id)
+            _decrement(hosts_in_room, host)
+            if host not in hosts_in_room:
+                for tracked_user_id in self._tracked_users_by_room[room_id]:
+                    _decrement(self._hosts_by_user[tracked_user_id], host)
+
+
+def _decrement(counts, key):
+    """Decrement a count in a dict of counts, removing it if it hits zero"""
+    count = counts[key] - 1
+    if count:
+        counts[key] = count
+    else:
+        del counts[key]
@@ -15,12 +15,14 @@
 # limitations under the License.
 
 import collections
+import hashlib
 import itertools
 import logging
 
 from six import iteritems, itervalues
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
+from unpaddedbase64 import encode_base64
 
 from twisted.internet import defer
 
@@ -31,7 +33,6 @@ from synapse.storage.state import StateFilter
 from synapse.types import RoomStreamToken
 from synapse.util.async_helpers import concurrently_execute
 from synapse.util.caches.expiringcache import ExpiringCache
-from synapse.util.caches.lrucache import LruCache
 from synapse.util.caches.response_cache import ResponseCache
 from synapse.util.logcontext import LoggingContext
 from synapse.util.metrics import Measure, measure_func
@@ -55,14 +56,60 @@ non_empty_sync_counter = Counter(
     ["type", "lazy_loaded"],
 )
 
+# The phases of a sync, as named by the `Measure` blocks wrapping them, which
+# we report metrics for. Each phase may run many times (e.g. once per room) in
+# a single sync, in which case its usage is summed.
+SYNC_PHASES = (
+    "_generate_sync_entry_for_account_data",
+    "_generate_sync_entry_for_rooms",
+    "ephemeral_by_room",
+    "preload_recents_for_rooms",
+    "load_filtered_recents",
+    "compute_state_delta",
+    "compute_summary",
+    "unread_notifs_for_rooms",
+    "_generate_sync_entry_for_presence",
+    "_generate_sync_entry_for_to_device",
+    "_generate_sync_entry_for_device_list",
+    "_generate_sync_entry_for_groups",
+)
+
+# Tracks the time, number of database transactions and number of events
+# fetched from the database by each phase of each sync. `type` is one of
+# "initial_sync", "full_state_sync" or "incremental_sync".
+sync_phase_time = Histogram(
+    "synapse_handlers_sync_phase_time_seconds",
+    "Wallclock time spent in each phase of a sync",
+    ["phase", "type"],
+)
+
+sync_phase_db_txn_count = Histogram(
+    "synapse_handlers_sync_phase_db_txn_count",
+    "Number of database transactions done in each phase of a sync",
+    ["phase", "type"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000),
+)
+
+sync_phase_evt_fetch_count = Histogram(
+    "synapse_handlers_sync_phase_evt_db_fetch_count",
+    "Number of events fetched from the database in each phase of a sync",
+    ["phase", "type"],
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000),
+)
+
 # Store the cache that tracks which lazy-loaded members have been sent to a given
 # client for no more than 30 minutes.
 LAZY_LOADED_MEMBERS_CACHE_MAX_AGE = 30 * 60 * 1000
 
-# Remember the last 100 members we sent to a client for the purposes of
-# avoiding redundantly sending the same lazy-loaded members to the client
+# Remember the last 100 members we sent to a client (across all rooms) for the
+# purposes of avoiding redundantly sending the same lazy-loaded members to the
+# client
 LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE = 100
 
+# The number of recent sync tokens for which we know our copy of the lazy-loaded
+# members sent to a client is up to date
+LAZY_LOADED_MEMBERS_CACHE_MAX_TOKENS = 10
+
 
 SyncConfig = collections.namedtuple("SyncConfig", [
     "user",
@@ -215,7 +262,7 @@ class SyncHandler(object):
         self.state = hs.get_state_handler()
         self.auth = hs.get_auth()
 
-        # ExpiringCache((User, Device)) -> LruCache(state_key => event_id)
+        # ExpiringCache((User, Device)) -> LazyLoadedMembersCache
         self.lazy_loaded_members_cache = ExpiringCache(
             "lazy_loaded_members_cache", self.clock,
             max_len=0, expiry_ms=LAZY_LOADED_MEMBERS_CACHE_MAX_AGE,
@@ -279,6 +326,9 @@ class SyncHandler(object):
                 lazy_loaded = "false"
             non_empty_sync_counter.labels(sync_type, lazy_loaded).inc()
 
+        if context:
+            _record_sync_phase_metrics(context, sync_type)
+
         defer.returnValue(result)
 
     def current_sync_for_user(self, sync_config, since_token=None,
@@ -361,8 +411,15 @@ class SyncHandler(object):
 
     @defer.inlineCallbacks
     def _load_filtered_recents(self, room_id, sync_config, now_token,
-                               since_token=None, recents=None, newly_joined_room=False):
+                               since_token=None, recents=None, newly_joined_room=False,
+                               preloaded_recents=None):
         """
+        Args:
+            preloaded_recents (tuple[list[FrozenEvent], str]|None): the result
+                of `get_recent_events_for_rooms` for this room, if it has
+                already been fetched as part of a batch by
+                `_preload_recents_for_rooms`.
+
         Returns:
             a Deferred TimelineBatch
         """
@@ -402,8 +459,7 @@ class SyncHandler(object):
                     limited=False
                 ))
 
-            filtering_factor = 2
-            load_limit = max(timeline_limit * filtering_factor, 10)
+            load_limit = _get_timeline_load_limit(timeline_limit)
             max_repeat = 5  # Only try a few times per room, otherwise
             room_key = now_token.room_key
             end_key = room_key
@@ -425,6 +481,10 @@ class SyncHandler(object):
                         from_key=since_key,
                         to_key=end_key,
                     )
+                elif preloaded_recents is not None:
+                    # We've already fetched the first page as part of a batch.
+                    events, end_key = preloaded_recents
+                    preloaded_recents = None
                 else:
                     events, end_key = yield self.store.get_recent_events_for_room(
                         room_id,
@@ -525,6 +585,7 @@ class SyncHandler(object):
             state = {}
         defer.returnValue(state)
 
+    @measure_func("compute_summary")
     @defer.inlineCallbacks
     def compute_summary(self, room_id, sync_config, batch, state, now_token):
         """ Works out a room summary block for this room, summarising the number
@@ -663,7 +724,7 @@ class SyncHandler(object):
             member_ids[hero_id]
             for hero_id in summary['m.heroes']
             if (
-                cache.get(hero_id) != member_ids[hero_id] and
+                not cache.has_sent(room_id, hero_id, member_ids[hero_id]) and
                 hero_id not in existing_members
             )
         ]
@@ -672,7 +733,7 @@ class SyncHandler(object):
         missing_hero_state = missing_hero_state.values()
 
         for s in missing_hero_state:
-            cache.set(s.state_key, s.event_id)
+            cache.mark_sent(room_id, s.state_key, s.event_id)
             state[(EventTypes.Member, s.state_key)] = s
 
         defer.returnValue(summary)
@@ -680,13 +741,81 @@ class SyncHandler(object):
     def get_lazy_loaded_members_cache(self, cache_key):
         cache = self.lazy_loaded_members_cache.get(cache_key)
         if cache is None:
-            logger.debug("creating LruCache for %r", cache_key)
-            cache = LruCache(LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE)
+            logger.debug("creating LazyLoadedMembersCache for %r", cache_key)
+            cache = LazyLoadedMembersCache()
             self.lazy_loaded_members_cache[cache_key] = cache
         else:
-            logger.debug("found LruCache for %r", cache_key)
+            logger.debug("found LazyLoadedMembersCache for %r", cache_key)
         return cache
 
+    @defer.inlineCallbacks
+    def _load_lazy_loaded_members_cache(self, sync_config, since_token):
+        """Make sure that our cache of the lazy-loaded members sent to the
+        syncing device is up to date, before we start calculating a sync.
+
+        If another synchrotron may have served the device's previous syncs
+        (or we have restarted since) then the cache is reloaded from the
+        database.
+
+        Args:
+            sync_config (SyncConfig)
+            since_token (StreamToken|None)
+
+        Returns:
+            Deferred
+        """
+        cache_key = (sync_config.user.to_string(), sync_config.device_id)
+
+        if since_token is None:
+            # it's a new sync sequence, so assume the client has had amnesia
+            # and doesn't want any recent lazy-loaded members de-duplicated.
+            logger.debug("clearing LazyLoadedMembersCache for %r", cache_key)
+            self.get_lazy_loaded_members_cache(cache_key).clear()
+            return
+
+        if sync_config.device_id is None:
+            # we can only persist the cache for devices
+            return
+
+        cache = self.lazy_loaded_members_cache.get(cache_key)
+        if cache is not None and cache.is_valid_for(since_token.to_string()):
+            return
+
+        logger.debug("loading LazyLoadedMembersCache for %r", cache_key)
+        members_by_room = yield self.store.get_lazy_loaded_members(
+            sync_config.user.to_string(), sync_config.device_id,
+        )
+        self.lazy_loaded_members_cache[cache_key] = LazyLoadedMembersCache(
+            members_by_room,
+        )
+
+    @defer.inlineCallbacks
+    def _persist_lazy_loaded_members_cache(self, sync_config, now_token):
+        """Persist any changes made to the cache of lazy-loaded members sent
+        to the syncing device while calculating a sync.
+
+        Args:
+            sync_config (SyncConfig)
+            now_token (StreamToken): the token we are about to return to the
+                client as `next_batch`.
+
+        Returns:
+            Deferred
+        """
+        cache_key = (sync_config.user.to_string(), sync_config.device_id)
+        cache = self.lazy_loaded_members_cache.get(cache_key)
+        if cache is None:
+            return
+
+        if sync_config.device_id is not None and cache.has_changes():
+            yield self.store.update_lazy_loaded_members(
+                sync_config.user.to_string(), sync_config.device_id,
+                cache.get_changed_rooms(),
+                clear=cache.cleared,
+            )
+
+        cache.mark_persisted(now_token.to_string())
+
     @defer.inlineCallbacks
     def compute_state_delta(self, room_id, batch, sync_config, since_token, now_token,
                             full_state):
@@ -831,31 +960,28 @@ class SyncHandler(object):
                 cache_key = (sync_config.user.to_string(), sync_config.device_id)
                 cache = self.get_lazy_loaded_members_cache(cache_key)
 
-                # if it's a new sync sequence, then assume the client has had
-                # amnesia and doesn't want any recent lazy-loaded members
-                # de-duplicated.
-                if since_token is None:
-                    logger.debug("clearing LruCache for %r", cache_key)
-                    cache.clear()
-                else:
-                    # only send members which aren't in our LruCache (either
+                # if it's a new sync sequence, then the client has had amnesia
+                # and the cache will have been cleared in
+                # _load_lazy_loaded_members_cache, so we send all the members.
+                if since_token is not None:
+                    # only send members which aren't in our cache (either
                     # because they're new to this client or have been pushed out
                     # of the cache)
                     logger.debug("filtering state from %r...", state_ids)
                     state_ids = {
                         t: event_id
                         for t, event_id in iteritems(state_ids)
-                        if cache.get(t[1]) != event_id
+                        if not cache.has_sent(room_id, t[1], event_id)
                     }
                     logger.debug("...to %r", state_ids)
 
-                # add any member IDs we are about to send into our LruCache
+                # add any member IDs we are about to send into our cache
                 for t, event_id in itertools.chain(
                     state_ids.items(),
                     timeline_state.items(),
                 ):
                     if t[0] == EventTypes.Member:
-                        cache.set(t[1], event_id)
+                        cache.mark_sent(room_id, t[1], event_id)
 
         state = {}
         if state_ids:
@@ -867,24 +993,26 @@ class SyncHandler(object):
         })
 
     @defer.inlineCallbacks
-    def unread_notifs_for_room_id(self, room_id, sync_config):
-        with Measure(self.clock, "unread_notifs_for_room_id"):
-            last_unread_event_id = yield self.store.get_last_receipt_event_id_for_user(
-                user_id=sync_config.user.to_string(),
-                room_id=room_id,
-                receipt_type="m.read"
-            )
+    def unread_notifs_for_rooms(self, room_ids, sync_config):
+        """Get the unread notification counts for the syncing user in the
+        given rooms.
 
-            notifs = []
-            if last_unread_event_id:
-                notifs = yield self.store.get_unread_event_push_actions_by_room_for_user(
-                    room_id, sync_config.user.to_string(), last_unread_event_id
-                )
-                defer.returnValue(notifs)
+        Args:
+            room_ids (Iterable[str])
+            sync_config (SyncConfig)
 
-        # There is no new information in this period, so your notification
-        # count is whatever it was last time.
-        defer.returnValue(None)
+        Returns:
+            Deferred[dict[str, dict]]: map from room ID to a dict with
+            "notify_count" and "highlight_count" keys. Rooms in which the user
+            has no read receipt are omitted: there is no new information for
+            them, so the client's notification count is whatever it was last
+            time.
+        """
+        with Measure(self.clock, "unread_notifs_for_rooms"):
+            notifs = yield self.store.get_unread_event_push_actions_by_rooms_for_user(
+                room_ids, sync_config.user.to_string(),
+            )
+        defer.returnValue(notifs)
 
     @defer.inlineCallbacks
     def generate_sync_result(self, sync_config, since_token=None, full_state=False):
@@ -927,6 +1055,10 @@ class SyncHandler(object):
             joined_room_ids=joined_room_ids,
         )
 
+        lazy_load_members = sync_config.filter_collection.lazy_load_members()
+        if lazy_load_members:
+            yield self._load_lazy_loaded_members_cache(sync_config, since_token)
+
         account_data_by_room = yield self._generate_sync_entry_for_account_data(
             sync_result_builder
         )
@@ -965,6 +1097,11 @@ class SyncHandler(object):
 
         yield self._generate_sync_entry_for_groups(sync_result_builder)
 
+        if lazy_load_members:
+            yield self._persist_lazy_loaded_members_cache(
+                sync_config, sync_result_builder.now_token,
+            )
+
         # debug for https://github.com/matrix-org/synapse/issues/4422
         for joined_room in sync_result_builder.joined:
             room_id = joined_room.room_id
@@ -1080,6 +1217,7 @@ class SyncHandler(object):
                 left=[],
             ))
 
+    @measure_func("_generate_sync_entry_for_to_device")
     @defer.inlineCallbacks
     def _generate_sync_entry_for_to_device(self, sync_result_builder):
         """Generates the portion of the sync response. Populates
@@ -1123,6 +1261,7 @@ class SyncHandler(object):
         else:
             sync_result_builder.to_device = []
 
+    @measure_func("_generate_sync_entry_for_account_data")
     @defer.inlineCallbacks
     def _generate_sync_entry_for_account_data(self, sync_result_builder):
         """Generates the account data portion of the sync response. Populates
@@ -1174,6 +1313,7 @@ class SyncHandler(object):
 
         defer.returnValue(account_data_by_room)
 
+    @measure_func("_generate_sync_entry_for_presence")
     @defer.inlineCallbacks
     def _generate_sync_entry_for_presence(self, sync_result_builder, newly_joined_rooms,
                                           newly_joined_users):
@@ -1232,6 +1372,7 @@ class SyncHandler(object):
 
         sync_result_builder.presence = presence
 
+    @measure_func("_generate_sync_entry_for_rooms")
     @defer.inlineCallbacks
     def _generate_sync_entry_for_rooms(self, sync_result_builder, account_data_by_room):
         """Generates the rooms portion of the sync response. Populates the
@@ -1299,6 +1440,10 @@ class SyncHandler(object):
 
             tags_by_room = yield self.store.get_tags_for_user(user_id)
 
+        preloaded_recents_by_room = yield self._preload_recents_for_rooms(
+            sync_result_builder, room_entries,
+        )
+
         def handle_room_entries(room_entry):
             return self._generate_room_entry(
                 sync_result_builder,
@@ -1308,10 +1453,27 @@ class SyncHandler(object):
                 tags=tags_by_room.get(room_entry.room_id),
                 account_data=account_data_by_room.get(room_entry.room_id, {}),
                 always_include=sync_result_builder.full_state,
+                preloaded_recents=preloaded_recents_by_room.get(room_entry.room_id),
             )
 
         yield concurrently_execute(handle_room_entries, room_entries, 10)
 
+        # Now that we know which joined rooms are in the response, fetch their
+        # unread notification counts in one go.
+        notifs_by_room = yield self.unread_notifs_for_rooms(
+            [room_sync.room_id for room_sync in sync_result_builder.joined],
+            sync_result_builder.sync_config,
+        )
+        for room_sync in sync_result_builder.joined:
+            notifs = notifs_by_room.get(room_sync.room_id)
+            if notifs is not None:
+                room_sync.unread_notifications["notification_count"] = (
+                    notifs["notify_count"]
+                )
+                room_sync.unread_notifications["highlight_count"] = (
+                    notifs["highlight_count"]
+                )
+
         sync_result_builder.invited.extend(invited)
 
         # Now we want to get any newly joined users
@@ -1341,6 +1503,56 @@ class SyncHandler(object):
             newly_left_users,
         ))
 
+    @defer.inlineCallbacks
+    def _preload_recents_for_rooms(self, sync_result_builder, room_entries):
+        """Fetches the most recent events for those rooms whose timelines
+        `_load_filtered_recents` would otherwise have to load from scratch
+        (e.g. on an initial sync, or for newly joined rooms), in as few
+        queries as possible.
+
+        Args:
+            sync_result_builder(SyncResultBuilder)
+            room_entries(list[RoomSyncResultBuilder])
+
+        Returns:
+            Deferred[dict[str, tuple[list[FrozenEvent], str]]]: map from room
+            id to the result of `get_recent_events_for_rooms` for that room.
+        """
+        filter_collection = sync_result_builder.sync_config.filter_collection
+        if filter_collection.blocks_all_room_timeline():
+            defer.returnValue({})
+
+        timeline_limit = filter_collection.timeline_limit()
+        load_limit = _get_timeline_load_limit(timeline_limit)
+
+        # Rooms we need to load are grouped by the token we're loading up to,
+        # as all rooms in a query share the same upper bound.
+        room_ids_by_end_key = {}
+        for room_entry in room_entries:
+            if room_entry.since_token and not room_entry.newly_joined:
+                # _load_filtered_recents will stream the events since the
+                # previous sync instead.
+                continue
+
+            if room_entry.events is not None and not room_entry.newly_joined:
+                continue
+
+            end_key = room_entry.upto_token.room_key
+            room_ids_by_end_key.setdefault(end_key, []).append(room_entry.room_id)
+
+        results = {}
+        with Measure(self.clock, "preload_recents_for_rooms"):
+            for end_key, room_ids in iteritems(room_ids_by_end_key):
+                res = yield self.store.get_recent_events_for_rooms(
+                    room_ids,
+                    limit=load_limit + 1,
+                    end_token=end_key,
+                    event_filter=filter_collection.room_timeline_filter(),
+                )
+                results.update(res)
+
+        defer.returnValue(results)
+
     @defer.inlineCallbacks
     def _have_rooms_changed(self, sync_result_builder):
         """Returns whether there may be any new events that should be sent down
@@ -1527,6 +1739,21 @@ class SyncHandler(object):
                     upto_token=leave_token,
                 ))
 
+        # Rooms which we joined with partial state, and have got the rest of
+        # the state of since the last sync, are sent down with their full state
+        # as if the user had just joined them, as the state we sent before was
+        # incomplete.
+        since_stream = RoomStreamToken.parse(since_token.room_key).stream
+        now_stream = RoomStreamToken.parse(now_token.room_key).stream
+        partial_state_completions = yield self.store.get_partial_state_completions(
+            sync_result_builder.joined_room_ids,
+        )
+        for room_id, stream_ordering in iteritems(partial_state_completions):
+            if stream_ordering is None or room_id in newly_joined_rooms:
+                continue
+            if since_stream < stream_ordering <= now_stream:
+                newly_joined_rooms.append(room_id)
+
         timeline_limit = sync_config.filter_collection.timeline_limit()
 
         # Get all events for rooms we're currently joined to.
@@ -1652,7 +1879,7 @@ class SyncHandler(object):
     @defer.inlineCallbacks
     def _generate_room_entry(self, sync_result_builder, ignored_users,
                              room_builder, ephemeral, tags, account_data,
-                             always_include=False):
+                             always_include=False, preloaded_recents=None):
         """Populates the `joined` and `archived` section of `sync_result_builder`
         based on the `room_builder`.
 
@@ -1666,6 +1893,9 @@ class SyncHandler(object):
             account_data(list): List of new account data for room
             always_include(bool): Always include this room in the sync response,
                 even if empty.
+            preloaded_recents(tuple[list[FrozenEvent], str]|None): Recent
+                events for the room, if already fetched by
+                `_preload_recents_for_rooms`.
         """
         newly_joined = room_builder.newly_joined
         full_state = (
@@ -1693,6 +1923,7 @@ class SyncHandler(object):
             since_token=since_token,
             recents=events,
             newly_joined_room=newly_joined,
+            preloaded_recents=preloaded_recents,
         )
 
         if newly_joined:
@@ -1773,26 +2004,19 @@ class SyncHandler(object):
             )
 
         if room_builder.rtype == "joined":
-            unread_notifications = {}
+            # unread_notifications gets filled in by
+            # _generate_sync_entry_for_rooms once all the rooms are done.
             room_sync = JoinedSyncResult(
                 room_id=room_id,
                 timeline=batch,
                 state=state,
                 ephemeral=ephemeral,
                 account_data=account_data_events,
-                unread_notifications=unread_notifications,
+                unread_notifications={},
                 summary=summary,
             )
 
             if room_sync or always_include:
-                notifs = yield self.unread_notifs_for_room_id(
-                    room_id, sync_config
-                )
-
-                if notifs is not None:
-                    unread_notifications["notification_count"] = notifs["notify_count"]
-                    unread_notifications["highlight_count"] = notifs["highlight_count"]
-
                 sync_result_builder.joined.append(room_sync)
 
             if batch.limited and since_token:
@@ -1865,6 +2089,38 @@ class SyncHandler(object):
         defer.returnValue(joined_room_ids)
 
 
+def _record_sync_phase_metrics(context, sync_type):
+    """Reports the resources used by each phase of a sync, as recorded in its
+    logcontext, to prometheus.
+
+    Args:
+        context (LoggingContext): the logcontext of the sync request
+        sync_type (str): the type of the sync, used as a metric label
+    """
+    phase_usage = context.get_phase_usage()
+    for phase in SYNC_PHASES:
+        usage = phase_usage.get(phase)
+        if usage is None:
+            continue
+
+        sync_phase_time.labels(phase, sync_type).observe(usage.real_time_sec)
+        sync_phase_db_txn_count.labels(phase, sync_type).observe(
+            usage.resource_usage.db_txn_count,
+        )
+        sync_phase_evt_fetch_count.labels(phase, sync_type).observe(
+            usage.resource_usage.evt_db_fetch_count,
+        )
+
+
+def _get_timeline_load_limit(timeline_limit):
+    """Returns how many events to load from the database when building a
+    timeline of `timeline_limit` events, allowing for some of them being
+    filtered out.
+    """
+    filtering_factor = 2
+    return max(timeline_limit * filtering_factor, 10)
+
+
 def _action_has_highlight(actions):
     for action in actions:
         try:
@@ -1932,6 +2188,178 @@ def _calculate_state(
     }
 
 
+def _hash_for_lazy_loaded_members(value):
+    """Returns a short hash of a user ID or event ID, for tracking which
+    members have been sent to a client.
+
+    Args:
+        value (str)
+
+    Returns:
+        str: an unpadded base64 string, of length
+        _LAZY_LOADED_MEMBERS_HASH_LENGTH.
+    """
+    return encode_base64(hashlib.sha256(value.encode("utf-8")).digest()[:8])
+
+
+# The length of the hashes returned by _hash_for_lazy_loaded_members
+_LAZY_LOADED_MEMBERS_HASH_LENGTH = 11
+
+
+class LazyLoadedMembersCache(object):
+    """Tracks which membership events have been sent to a device when
+    lazy-loading members, so that we can avoid sending them again.
+
+    We remember the last LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE members we sent
+    across all rooms as short hashes of the member's user ID and of the event
+    ID of their membership event, so that the cache can be cheaply persisted.
+    The persisted form of a room's members is the concatenation of the pairs
+    of hashes, oldest first.
+
+    Attributes:
+        cleared (bool): whether the device has started a new sync sequence
+            since the cache was last persisted.
+    """
+
+    def __init__(self, members_by_room=None):
+        """
+        Args:
+            members_by_room (dict[str, str]|None): map from room ID to the
+                persisted form of the members sent in that room.
+        """
+        if members_by_room is None:
+            members_by_room = {}
+
+        self.cleared = False
+
+        # room_id -> OrderedDict(user ID hash -> event ID hash)
+        self._rooms = {}
+
+        # (room_id, user ID hash) for every member in the cache, oldest first,
+        # so that we can bound the total size of the cache.
+        self._entries = collections.OrderedDict()
+
+        # The rooms which have changed since the cache was last persisted
+        self._changed_rooms = set()
+
+        step = 2 * _LAZY_LOADED_MEMBERS_HASH_LENGTH
+        for room_id, members in iteritems(members_by_room):
+            room_members = self._rooms[room_id] = collections.OrderedDict()
+            for i in range(0, len(members), step):
+                entry = members[i:i + step]
+                user_hash = entry[:_LAZY_LOADED_MEMBERS_HASH_LENGTH]
+                room_members[user_hash] = entry[_LAZY_LOADED_MEMBERS_HASH_LENGTH:]
+                self._entries[(room_id, user_hash)] = None
+
+        # we don't know how the persisted rooms were ordered relative to each
+        # other, so this may not evict the globally oldest members, but that's
+        # fine.
+        self._evict()
+
+        # The most recent sync tokens we returned to the device for which the
+        # cache is known to be up to date.
+        self._valid_tokens = collections.deque(
+            maxlen=LAZY_LOADED_MEMBERS_CACHE_MAX_TOKENS,
+        )
+
+    def has_sent(self, room_id, user_id, event_id):
+        """Returns whether the given membership event is the latest one we
+        have sent for the member in the room.
+        """
+        room_members = self._rooms.get(room_id)
+        if not room_members:
+            return False
+
+        user_hash = _hash_for_lazy_loaded_members(user_id)
+        return room_members.get(user_hash) == _hash_for_lazy_loaded_members(event_id)
+
+    def mark_sent(self, room_id, user_id, event_id):
+        """Record that we have sent the given membership event to the device.
+        """
+        room_members = self._rooms.setdefault(room_id, collections.OrderedDict())
+
+        user_hash = _hash_for_lazy_loaded_members(user_id)
+        event_hash = _hash_for_lazy_loaded_members(event_id)
+        if room_members.get(user_hash) == event_hash:
+            return
+
+        room_members.pop(user_hash, None)
+        room_members[user_hash] = event_hash
+        self._entries.pop((room_id, user_hash), None)
+        self._entries[(room_id, user_hash)] = None
+        self._changed_rooms.add(room_id)
+
+        self._evict()
+
+    def _evict(self):
+        """Forget the oldest members until the cache is within its size
+        limit.
+        """
+        while len(self._entries) > LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE:
+            (room_id, user_hash), _ = self._entries.popitem(last=False)
+            room_members = self._rooms[room_id]
+            room_members.pop(user_hash)
+            if not room_members:
+                del self._rooms[room_id]
+            self._changed_rooms.add(room_id)
+
+    def clear(self):
+        """Forget all the members sent to the device."""
+        self._rooms.clear()
+        self._entries.clear()
+        self._changed_rooms.clear()
+        self._valid_tokens.clear()
+        self.cleared = True
+
+    def has_changes(self):
+        """Returns whether the cache has changed since it was last persisted.
+        """
+        return self.cleared or bool(self._changed_rooms)
+
+    def get_changed_rooms(self):
+        """Get the persisted form of the rooms which have changed since the
+        cache was last persisted.
+
+        Returns:
+            dict[str, str]: map from room ID to persisted form. The persisted
+            form is empty for rooms which no longer have any members in the
+            cache.
+        """
+        return {
+            room_id: "".join(
+                user_hash + event_hash
+                for user_hash, event_hash in iteritems(self._rooms.get(room_id, {}))
+            )
+            for room_id in self._changed_rooms
+        }
+
+    def mark_persisted(self, token):
+        """Record that the cache has been persisted, and is up to date as of
+        the given sync token.
+
+        Args:
+            token (str): the sync token which will be returned to the client.
+        """
+        if self.has_changes():
+            self._valid_tokens.clear()
+        self._valid_tokens.append(token)
+        self._changed_rooms.clear()
+        self.cleared = False
+
+    def is_valid_for(self, token):
+        """Returns whether the cache reflects what has been sent to a client
+        syncing from the given token, i.e. whether no other synchrotron may have
+        served the device since we returned that token.
+
+        Args:
+            token (str)
+
+        Returns:
+            bool
+        """
+        return token in self._valid_tokens
+
+
 class SyncResultBuilder(object):
     """Used to help build up a new SyncResult for a user
 
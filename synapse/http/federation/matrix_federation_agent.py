@@ -19,6 +19,7 @@ import time
 
 import attr
 from netaddr import IPAddress
+from prometheus_client import Counter, Histogram
 from zope.interface import implementer
 
 from twisted.internet import defer
@@ -30,6 +31,8 @@ from twisted.web.http_headers import Headers
 from twisted.web.iweb import IAgent
 
 from synapse.http.federation.srv_resolver import SrvResolver, pick_server_from_list
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.util import Clock
 from synapse.util.caches.ttlcache import TTLCache
 from synapse.util.logcontext import make_deferred_yieldable
@@ -47,9 +50,45 @@ WELL_KNOWN_INVALID_CACHE_PERIOD = 1 * 3600
 # cap for .well-known cache period
 WELL_KNOWN_MAX_CACHE_PERIOD = 48 * 3600
 
+# how long we keep using .well-known results after they expire, while they are
+# being refreshed
+WELL_KNOWN_MAX_STALE_PERIOD = 24 * 3600
+
+# how long to wait before trying again to refresh a stale .well-known result,
+# after failing to reach the server
+WELL_KNOWN_REFRESH_RETRY_PERIOD = 5 * 60
+
+# default maximum number of idle connections to keep open to each server
+DEFAULT_MAX_IDLE_CONNECTIONS_PER_HOST = 5
+
+# default period to keep idle connections open for
+DEFAULT_IDLE_CONNECTION_TIMEOUT_MS = 2 * 60 * 1000
+
 logger = logging.getLogger(__name__)
 well_known_cache = TTLCache('well-known')
 
+well_known_lookups_counter = Counter(
+    "synapse_http_federation_well_known_lookups",
+    "Number of .well-known lookups, by whether they were answered from the cache "
+    "(fresh or stale) or had to wait for the .well-known to be fetched (miss)",
+    ["result"],
+)
+
+connections_opened_counter = Counter(
+    "synapse_http_federation_connections_opened",
+    "Number of new connections opened to remote servers",
+)
+
+connections_reused_counter = Counter(
+    "synapse_http_federation_connections_reused",
+    "Number of requests sent over an existing connection to a remote server",
+)
+
+connection_setup_latency = Histogram(
+    "synapse_http_federation_connection_setup_seconds",
+    "Time taken to open new connections to remote servers",
+)
+
 
 @implementer(IAgent)
 class MatrixFederationAgent(object):
@@ -64,6 +103,12 @@ class MatrixFederationAgent(object):
         tls_client_options_factory (ClientTLSOptionsFactory|None):
             factory to use for fetching client tls options, or none to disable TLS.
 
+        max_idle_connections_per_host (int): the maximum number of idle
+            connections to keep open to each server, for reuse by later requests.
+
+        idle_connection_timeout_ms (int): how long to keep idle connections open
+            for.
+
         _well_known_tls_policy (IPolicyForHTTPS|None):
             TLS policy to use for fetching .well-known files. None to use a default
             (browser-like) implementation.
@@ -75,26 +120,34 @@ class MatrixFederationAgent(object):
         _well_known_cache (TTLCache|None):
             TTLCache impl for storing cached well-known lookups. None to use a default
             implementation.
+
+        store (synapse.storage.DataStore|None): store to persist the results
+            of SRV and .well-known lookups in, so that they survive restarts.
+            None to not persist them.
     """
 
     def __init__(
         self, reactor, tls_client_options_factory,
+        max_idle_connections_per_host=DEFAULT_MAX_IDLE_CONNECTIONS_PER_HOST,
+        idle_connection_timeout_ms=DEFAULT_IDLE_CONNECTION_TIMEOUT_MS,
         _well_known_tls_policy=None,
         _srv_resolver=None,
         _well_known_cache=well_known_cache,
+        store=None,
     ):
         self._reactor = reactor
         self._clock = Clock(reactor)
+        self._store = store
 
         self._tls_client_options_factory = tls_client_options_factory
         if _srv_resolver is None:
-            _srv_resolver = SrvResolver()
+            _srv_resolver = SrvResolver(store=store)
         self._srv_resolver = _srv_resolver
 
-        self._pool = HTTPConnectionPool(reactor)
+        self._pool = InstrumentedConnectionPool(reactor)
         self._pool.retryAutomatically = False
-        self._pool.maxPersistentPerHost = 5
-        self._pool.cachedConnectionTimeout = 2 * 60
+        self._pool.maxPersistentPerHost = max_idle_connections_per_host
+        self._pool.cachedConnectionTimeout = idle_connection_timeout_ms / 1000.
 
         agent_args = {}
         if _well_known_tls_policy is not None:
@@ -110,8 +163,23 @@ class MatrixFederationAgent(object):
         # to delegated name. The values can be:
         #   `bytes`:     a valid server-name
         #   `None`:      there is no (valid) .well-known here
+        #
+        # Entries are kept for WELL_KNOWN_MAX_STALE_PERIOD beyond their cache
+        # period, during which they are stale.
         self._well_known_cache = _well_known_cache
 
+        # server names whose .well-known is being refreshed in the background
+        self._refreshing_well_known = set()
+
+        # server name -> when we can next try to refresh its stale .well-known
+        # result, for servers which we failed to reach last time we tried.
+        self._well_known_refresh_retry_ts = {}
+
+        if store is not None:
+            run_as_background_process(
+                "load_well_known_cache", self._load_well_known_cache,
+            )
+
     @defer.inlineCallbacks
     def request(self, method, uri, headers=None, bodyProducer=None):
         """
@@ -292,18 +360,113 @@ class MatrixFederationAgent(object):
                 None if there was no .well-known file.
         """
         try:
-            result = self._well_known_cache[server_name]
+            result, expiry = self._well_known_cache.get_with_expiry(server_name)
         except KeyError:
             # TODO: should we linearise so that we don't end up doing two .well-known
             # requests for the same server in parallel?
-            with Measure(self._clock, "get_well_known"):
+            well_known_lookups_counter.labels("miss").inc()
+            result = yield self._fetch_well_known(server_name)
+            defer.returnValue(result)
+
+        if expiry - WELL_KNOWN_MAX_STALE_PERIOD > self._clock.time():
+            well_known_lookups_counter.labels("fresh").inc()
+        else:
+            well_known_lookups_counter.labels("stale").inc()
+            self._refresh_well_known_in_background(server_name)
+
+        defer.returnValue(result)
+
+    def _refresh_well_known_in_background(self, server_name):
+        if server_name in self._refreshing_well_known:
+            return
+
+        retry_ts = self._well_known_refresh_retry_ts.get(server_name)
+        if retry_ts is not None and retry_ts > self._clock.time():
+            return
+
+        self._refreshing_well_known.add(server_name)
+
+        @defer.inlineCallbacks
+        def refresh():
+            try:
+                yield self._fetch_well_known(server_name)
+            except _FetchWellKnownFailure:
+                # we keep using the stale result until we can reach the server
+                self._well_known_refresh_retry_ts[server_name] = (
+                    self._clock.time() + WELL_KNOWN_REFRESH_RETRY_PERIOD
+                )
+            finally:
+                self._refreshing_well_known.discard(server_name)
+
+        run_as_background_process("refresh_well_known", refresh)
+
+    @defer.inlineCallbacks
+    def _fetch_well_known(self, server_name):
+        """Fetch a .well-known file, and update the cache with the result
+
+        Args:
+            server_name (bytes): name of the server, from the requested url
+
+        Returns:
+            Deferred[bytes|None]: either the new server name, from the .well-known, or
+                None if there was no .well-known file.
+
+        Raises:
+            _FetchWellKnownFailure: if we couldn't reach the server and have a
+                stale result for it, which is left in the cache.
+        """
+        with Measure(self._clock, "get_well_known"):
+            try:
                 result, cache_period = yield self._do_get_well_known(server_name)
+            except _FetchWellKnownFailure:
+                try:
+                    self._well_known_cache.get_with_expiry(server_name)
+                except KeyError:
+                    # we have nothing better, so treat it like an invalid
+                    # .well-known.
+                    result, cache_period = None, _well_known_invalid_cache_period()
+                else:
+                    raise
+
+        self._well_known_refresh_retry_ts.pop(server_name, None)
 
-            if cache_period > 0:
-                self._well_known_cache.set(server_name, result, cache_period)
+        if cache_period > 0:
+            self._well_known_cache.set(
+                server_name, result, cache_period + WELL_KNOWN_MAX_STALE_PERIOD,
+            )
+
+            if self._store is not None:
+                run_as_background_process(
+                    "store_well_known", self._store.store_server_resolution,
+                    "well_known", server_name.decode("ascii"),
+                    result.decode("ascii") if result is not None else None,
+                    int((self._clock.time() + cache_period) * 1000),
+                )
 
         defer.returnValue(result)
 
+    @defer.inlineCallbacks
+    def _load_well_known_cache(self):
+        """Populate the .well-known cache from the results stored in the database
+        """
+        now = self._clock.time()
+        rows = yield self._store.get_server_resolutions(
+            "well_known", int((now - WELL_KNOWN_MAX_STALE_PERIOD) * 1000),
+        )
+        for server_name, result, expires_ts in rows:
+            server_name = server_name.encode("ascii")
+            if server_name in self._well_known_cache:
+                # we've looked it up since starting
+                continue
+
+            if result is not None:
+                result = result.encode("ascii")
+
+            self._well_known_cache.set(
+                server_name, result,
+                expires_ts / 1000. + WELL_KNOWN_MAX_STALE_PERIOD - now,
+            )
+
     @defer.inlineCallbacks
     def _do_get_well_known(self, server_name):
         """Actually fetch and parse a .well-known, without checking the cache
@@ -317,6 +480,10 @@ class MatrixFederationAgent(object):
                  - the new server name from the .well-known (as a `bytes`)
                  - None if there was no .well-known file.
                  - INVALID_WELL_KNOWN if the .well-known was invalid
+
+        Raises:
+            _FetchWellKnownFailure: if we couldn't reach the server, or it
+                returned a server error.
         """
         uri = b"https://%s/.well-known/matrix/server" % (server_name, )
         uri_str = uri.decode("ascii")
@@ -326,6 +493,15 @@ class MatrixFederationAgent(object):
                 self._well_known_agent.request(b"GET", uri),
             )
             body = yield make_deferred_yieldable(readBody(response))
+        except Exception as e:
+            logger.info("Error fetching %s: %s", uri_str, e)
+            raise _FetchWellKnownFailure()
+
+        if 500 <= response.code < 600:
+            logger.info("Error fetching %s: %s response", uri_str, response.code)
+            raise _FetchWellKnownFailure()
+
+        try:
             if response.code != 200:
                 raise Exception("Non-200 response %s" % (response.code, ))
 
@@ -337,12 +513,7 @@ class MatrixFederationAgent(object):
                 raise Exception("Missing key 'm.server'")
         except Exception as e:
             logger.info("Error fetching %s: %s", uri_str, e)
-
-            # add some randomness to the TTL to avoid a stampeding herd every hour
-            # after startup
-            cache_period = WELL_KNOWN_INVALID_CACHE_PERIOD
-            cache_period += random.uniform(0, WELL_KNOWN_DEFAULT_CACHE_PERIOD_JITTER)
-            defer.returnValue((None, cache_period))
+            defer.returnValue((None, _well_known_invalid_cache_period()))
 
         result = parsed_body["m.server"].encode("ascii")
 
@@ -374,6 +545,61 @@ class LoggingHostnameEndpoint(object):
         return self.ep.connect(protocol_factory)
 
 
+class InstrumentedConnectionPool(HTTPConnectionPool):
+    """An HTTPConnectionPool which keeps metrics on how many connections are
+    opened and reused, and how long new connections take to set up.
+    """
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self._clock = Clock(reactor)
+
+        # whether the last call to getConnection opened a new connection
+        self._opened_connection = False
+
+        LaterGauge(
+            "synapse_http_federation_idle_connections",
+            "Number of idle connections to remote servers kept open for reuse",
+            [],
+            lambda: sum(len(c) for c in self._connections.values()),
+        )
+
+    def getConnection(self, key, endpoint):
+        self._opened_connection = False
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if not self._opened_connection:
+            connections_reused_counter.inc()
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self._opened_connection = True
+        connections_opened_counter.inc()
+
+        start = self._clock.time()
+
+        def record_latency(r):
+            connection_setup_latency.observe(self._clock.time() - start)
+            return r
+
+        d = HTTPConnectionPool._newConnection(self, key, endpoint)
+        d.addCallback(record_latency)
+        return d
+
+
+class _FetchWellKnownFailure(Exception):
+    """We couldn't reach a server to fetch its .well-known, so don't know
+    whether it has one.
+    """
+
+
+def _well_known_invalid_cache_period():
+    """Get the period to cache the lack of a valid .well-known for."""
+    # add some randomness to the TTL to avoid a stampeding herd every hour
+    # after startup
+    cache_period = WELL_KNOWN_INVALID_CACHE_PERIOD
+    cache_period += random.uniform(0, WELL_KNOWN_DEFAULT_CACHE_PERIOD_JITTER)
+    return cache_period
+
+
 def _cache_period_from_headers(headers, time_now=time.time):
     cache_controls = _parse_cache_control(headers)
 
@@ -19,18 +19,34 @@ import random
 import time
 
 import attr
+from prometheus_client import Counter
 
 from twisted.internet import defer
 from twisted.internet.error import ConnectError
 from twisted.names import client, dns
 from twisted.names.error import DNSNameError, DomainError
 
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.util.logcontext import make_deferred_yieldable
 
+# how long we keep using SRV records after they expire, while they are being
+# refreshed
+SRV_MAX_STALE_PERIOD = 24 * 3600
+
+# how long to cache the absence of a SRV record for
+SRV_NEGATIVE_CACHE_PERIOD = 10 * 60
+
 logger = logging.getLogger(__name__)
 
 SERVER_CACHE = {}
 
+srv_lookups_counter = Counter(
+    "synapse_http_federation_srv_lookups",
+    "Number of SRV lookups, by whether they were answered from the cache "
+    "(fresh or stale) or had to wait for DNS (miss)",
+    ["result"],
+)
+
 
 @attr.s
 class Server(object):
@@ -90,15 +106,59 @@ class SrvResolver(object):
     The default resolver in twisted.names doesn't do any caching (it has a CacheResolver,
     but the cache never gets populated), so we add our own caching layer here.
 
+    Once a record has expired, it is still returned for up to SRV_MAX_STALE_PERIOD
+    while it is refreshed in the background, so that lookups for servers we have
+    seen before don't wait for DNS.
+
     Args:
         dns_client (twisted.internet.interfaces.IResolver): twisted resolver impl
         cache (dict): cache object
         get_time (callable): clock implementation. Should return seconds since the epoch
+        store (synapse.storage.DataStore|None): store to persist the results in,
+            so that they survive restarts. None to not persist them.
     """
-    def __init__(self, dns_client=client, cache=SERVER_CACHE, get_time=time.time):
+    def __init__(self, dns_client=client, cache=SERVER_CACHE, get_time=time.time,
+                 store=None):
         self._dns_client = dns_client
         self._cache = cache
         self._get_time = get_time
+        self._store = store
+
+        # service name -> expiry time, for services which have no SRV record
+        self._negative_cache = {}
+
+        # service names which are being refreshed in the background
+        self._refreshing = set()
+
+        if store is not None:
+            run_as_background_process("load_srv_cache", self._load_cache)
+
+    @defer.inlineCallbacks
+    def _load_cache(self):
+        """Populate the cache from the results stored in the database"""
+        now = int(self._get_time())
+        rows = yield self._store.get_server_resolutions(
+            "srv", (now - SRV_MAX_STALE_PERIOD) * 1000,
+        )
+        for service_name, servers, expires_ts in rows:
+            service_name = service_name.encode("ascii")
+            expires = expires_ts // 1000
+
+            if service_name in self._cache or service_name in self._negative_cache:
+                # we've looked it up since starting
+                continue
+
+            if not servers:
+                self._negative_cache[service_name] = expires
+                continue
+
+            self._cache[service_name] = [
+                Server(
+                    host=host.encode("ascii"), port=port, priority=priority,
+                    weight=weight, expires=expires,
+                )
+                for host, port, priority, weight in servers
+            ]
 
     @defer.inlineCallbacks
     def resolve_service(self, service_name):
@@ -118,17 +178,62 @@ class SrvResolver(object):
 
         cache_entry = self._cache.get(service_name, None)
         if cache_entry:
-            if all(s.expires > now for s in cache_entry):
-                servers = list(cache_entry)
-                defer.returnValue(servers)
+            expires = min(s.expires for s in cache_entry)
+        else:
+            cache_entry = []
+            expires = self._negative_cache.get(service_name)
+
+        if expires is not None:
+            if expires > now:
+                srv_lookups_counter.labels("fresh").inc()
+                defer.returnValue(list(cache_entry))
+
+            if expires + SRV_MAX_STALE_PERIOD > now:
+                srv_lookups_counter.labels("stale").inc()
+                self._refresh_in_background(service_name)
+                defer.returnValue(list(cache_entry))
+
+        srv_lookups_counter.labels("miss").inc()
+        servers = yield self._lookup_service(service_name)
+        defer.returnValue(servers)
+
+    def _refresh_in_background(self, service_name):
+        if service_name in self._refreshing:
+            return
+        self._refreshing.add(service_name)
+
+        @defer.inlineCallbacks
+        def refresh():
+            try:
+                yield self._lookup_service(service_name)
+            except Exception as e:
+                logger.info("Failed to refresh SRV record %r: %s", service_name, e)
+            finally:
+                self._refreshing.discard(service_name)
+
+        run_as_background_process("refresh_srv_record", refresh)
+
+    @defer.inlineCallbacks
+    def _lookup_service(self, service_name):
+        """Look up a SRV record in DNS, and update the cache with the result
+
+        Args:
+            service_name (bytes): record to look up
+
+        Returns:
+            Deferred[list[Server]]:
+                a list of the SRV records, or an empty list if none found
+        """
+        now = int(self._get_time())
 
         try:
             answers, _, _ = yield make_deferred_yieldable(
                 self._dns_client.lookupService(service_name),
             )
         except DNSNameError:
-            # TODO: cache this. We can get the SOA out of the exception, and use
-            # the negative-TTL value.
+            # TODO: We can get the SOA out of the exception, and use the
+            # negative-TTL value for the cache period.
+            self._cache_no_srv_record(service_name, now)
             defer.returnValue([])
         except DomainError as e:
             # We failed to resolve the name (other than a NameError)
@@ -165,5 +270,31 @@ class SrvResolver(object):
                 expires=now + answer.ttl,
             ))
 
+        if not servers:
+            self._cache_no_srv_record(service_name, now)
+            defer.returnValue(servers)
+
         self._cache[service_name] = list(servers)
+        self._negative_cache.pop(service_name, None)
+        self._persist(service_name, servers, min(s.expires for s in servers))
         defer.returnValue(servers)
+
+    def _cache_no_srv_record(self, service_name, now):
+        expires = now + SRV_NEGATIVE_CACHE_PERIOD
+        self._cache.pop(service_name, None)
+        self._negative_cache[service_name] = expires
+        self._persist(service_name, [], expires)
+
+    def _persist(self, service_name, servers, expires):
+        if self._store is None:
+            return
+
+        run_as_background_process(
+            "store_srv_record", self._store.store_server_resolution,
+            "srv", service_name.decode("ascii"),
+            [
+                (s.host.decode("ascii"), s.port, s.priority, s.weight)
+                for s in servers
+            ],
+            expires * 1000,
+        )
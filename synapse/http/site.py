@@ -302,11 +302,45 @@ class SynapseRequest(Request):
             usage.evt_db_fetch_count,
         )
 
+        if self.site.log_phase_breakdown:
+            self._log_phase_breakdown(authenticated_entity)
+
         try:
             self.request_metrics.stop(self.finish_time, self.code, self.sentLength)
         except Exception as e:
             logger.warn("Failed to stop metrics: %r", e)
 
+    def _log_phase_breakdown(self, authenticated_entity):
+        """Log the time and database activity of each named phase of the
+        request (see `LoggingContext.record_phase`).
+        """
+        phase_usage = self.logcontext.get_phase_usage()
+        if not phase_usage:
+            return
+
+        breakdown = ", ".join(
+            "%s=%.3fsec/%dtxns/%ddbevts/x%d" % (
+                name,
+                usage.real_time_sec,
+                int(usage.resource_usage.db_txn_count),
+                usage.resource_usage.evt_db_fetch_count,
+                usage.count,
+            )
+            for name, usage in sorted(
+                phase_usage.items(), key=lambda item: -item[1].real_time_sec,
+            )
+        )
+
+        self.site.access_logger.info(
+            "%s - %s - {%s} Phase breakdown for \"%s %s\": %s",
+            self.getClientIP(),
+            self.site.site_tag,
+            authenticated_entity,
+            self.get_method(),
+            self.get_redacted_uri(),
+            breakdown,
+        )
+
 
 class XForwardedForRequest(SynapseRequest):
     def __init__(self, *args, **kw):
@@ -352,6 +386,7 @@ class SynapseSite(Site):
         proxied = config.get("x_forwarded", False)
         self.requestFactory = SynapseRequestFactory(self, proxied)
         self.access_logger = logging.getLogger(logger_name)
+        self.log_phase_breakdown = config.get("log_phase_breakdown", False)
         self.server_version_string = server_version_string.encode('ascii')
 
     def log(self, request):
@@ -14,9 +14,9 @@
 # limitations under the License.
 
 import logging
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
@@ -39,6 +39,23 @@ notified_events_counter = Counter("synapse_notifier_notified_events", "")
 users_woken_by_stream_counter = Counter(
     "synapse_notifier_users_woken_by_stream", "", ["stream"])
 
+# The number of user streams to be woken up by each new event
+wakeups_per_event_histogram = Histogram(
+    "synapse_notifier_wakeups_per_event", "",
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000),
+)
+
+# The number of notifications which didn't cause an extra wakeup because the
+# user stream was already waiting to be woken up
+coalesced_wakeups_counter = Counter(
+    "synapse_notifier_coalesced_wakeups", "",
+)
+
+# How long we spent waking up a batch of user streams in one reactor tick
+wakeup_tick_duration_histogram = Histogram(
+    "synapse_notifier_wakeup_tick_duration_seconds", "",
+)
+
 
 # TODO(paul): Should be shared somewhere
 def count(func, l):
@@ -90,6 +107,19 @@ class _NotifierUserStream(object):
     def notify(self, stream_key, stream_id, time_now_ms):
         """Notify any listeners for this user of a new event from an
         event source.
+        Args:
+            stream_key(str): The stream the event came from.
+            stream_id(str): The new id for the stream the event came from.
+            time_now_ms(int): The current time in milliseconds.
+        """
+        self.advance(stream_key, stream_id, time_now_ms)
+        self.wake_listeners()
+
+    def advance(self, stream_key, stream_id, time_now_ms):
+        """Record a new event from an event source, without waking up any
+        listeners which are already waiting. New listeners will still see
+        the new token.
+
         Args:
             stream_key(str): The stream the event came from.
             stream_id(str): The new id for the stream the event came from.
@@ -100,10 +130,13 @@ class _NotifierUserStream(object):
         )
         self.last_notified_token = self.current_token
         self.last_notified_ms = time_now_ms
-        noify_deferred = self.notify_deferred
 
         users_woken_by_stream_counter.labels(stream_key).inc()
 
+    def wake_listeners(self):
+        """Wake up any listeners waiting for the current token."""
+        noify_deferred = self.notify_deferred
+
         with PreserveLoggingContext():
             self.notify_deferred = ObservableDeferred(defer.Deferred())
             noify_deferred.callback(self.current_token)
@@ -174,6 +207,18 @@ class Notifier(object):
 
         self.state_handler = hs.get_state_handler()
 
+        # If set, we coalesce wakeups of user streams, waking each at most
+        # once per window, and spread them over multiple reactor ticks.
+        self._wakeup_coalesce_ms = hs.config.notifier_wakeup_coalesce_ms
+        self._wakeup_batch_size = hs.config.notifier_wakeup_batch_size
+
+        # The user streams which have been notified of new events but not yet
+        # woken up, when coalescing wakeups.
+        self._pending_wakeups = OrderedDict()
+
+        # Whether we have scheduled a call to _wake_pending_streams
+        self._wakeup_scheduled = False
+
         self.clock.looping_call(
             self.remove_expired_streams, self.UNUSED_STREAM_EXPIRY_MS
         )
@@ -200,6 +245,10 @@ class Notifier(object):
             "synapse_notifier_users", "", [],
             lambda: len(self.user_to_user_stream),
         )
+        LaterGauge(
+            "synapse_notifier_pending_wakeups", "", [],
+            lambda: len(self._pending_wakeups),
+        )
 
     def add_replication_callback(self, cb):
         """Add a callback that will be called when some new data is available.
@@ -290,15 +339,66 @@ class Notifier(object):
                 for room in rooms:
                     user_streams |= self.room_to_user_streams.get(room, set())
 
+                wakeups_per_event_histogram.observe(len(user_streams))
+
                 time_now_ms = self.clock.time_msec()
-                for user_stream in user_streams:
-                    try:
-                        user_stream.notify(stream_key, new_token, time_now_ms)
-                    except Exception:
-                        logger.exception("Failed to notify listener")
+                if self._wakeup_coalesce_ms:
+                    self._queue_wakeups(
+                        user_streams, stream_key, new_token, time_now_ms,
+                    )
+                else:
+                    for user_stream in user_streams:
+                        try:
+                            user_stream.notify(stream_key, new_token, time_now_ms)
+                        except Exception:
+                            logger.exception("Failed to notify listener")
 
                 self.notify_replication()
 
+    def _queue_wakeups(self, user_streams, stream_key, new_token, time_now_ms):
+        """Advance the tokens of the given user streams, and queue them up to
+        be woken up once the current coalescing window has passed.
+        """
+        for user_stream in user_streams:
+            try:
+                user_stream.advance(stream_key, new_token, time_now_ms)
+            except Exception:
+                logger.exception("Failed to notify listener")
+                continue
+
+            if user_stream in self._pending_wakeups:
+                coalesced_wakeups_counter.inc()
+            else:
+                self._pending_wakeups[user_stream] = None
+
+        if self._pending_wakeups and not self._wakeup_scheduled:
+            self._wakeup_scheduled = True
+            self.clock.call_later(
+                self._wakeup_coalesce_ms / 1000., self._wake_pending_streams,
+            )
+
+    def _wake_pending_streams(self):
+        """Wake up a batch of the pending user streams, and reschedule
+        ourselves for the next reactor tick if any are left.
+        """
+        start = self.clock.time()
+
+        woken = 0
+        while self._pending_wakeups and woken < self._wakeup_batch_size:
+            user_stream, _ = self._pending_wakeups.popitem(last=False)
+            woken += 1
+            try:
+                user_stream.wake_listeners()
+            except Exception:
+                logger.exception("Failed to notify listener")
+
+        wakeup_tick_duration_histogram.observe(self.clock.time() - start)
+
+        if self._pending_wakeups:
+            self.clock.call_later(0, self._wake_pending_streams)
+        else:
+            self._wakeup_scheduled = False
+
     def on_new_replication_data(self):
         """Used to inform replication listeners that something has happend
         without waking up any of the normal user event streams"""
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import logging
+
+from six import iteritems
+
+from prometheus_client import Counter
+
+from twisted.internet import defer
+
+from synapse.metrics import LaterGauge
+
+logger = logging.getLogger(__name__)
+
+# How often we recalculate a user's unread rooms from scratch, to pick up any
+# changes we don't track incrementally (such as push actions being removed
+# when an event is redacted).
+RECALCULATE_INTERVAL_MS = 60 * 60 * 1000
+
+badge_count_recalculations_counter = Counter(
+    "synapse_push_badge_count_recalculations", "",
+)
+
+
+class _UnreadRooms(object):
+    __slots__ = ["room_ids", "calculated_ts"]
+
+    def __init__(self, room_ids, calculated_ts):
+        self.room_ids = room_ids
+        self.calculated_ts = calculated_ts
+
+
+class BadgeCounter(object):
+    """Maintains the set of rooms with unread notifications for each user with
+    a pusher, so that the badge count sent with each push doesn't need a query
+    per joined room.
+
+    The sets are calculated in bulk on first use, and then kept up to date by
+    `on_new_notifications` and `on_new_receipts`, which are called by the
+    PusherPool before the pushers themselves are poked.
+    """
+
+    def __init__(self, hs):
+        self.store = hs.get_datastore()
+        self.clock = hs.get_clock()
+
+        # user_id -> _UnreadRooms
+        self._unread_rooms_by_user = {}
+
+        # user_id -> generation, for the users we are tracking or calculating
+        # the unread rooms of. A user's generation changes whenever we see an
+        # update for them, and a calculation is only cached if the generation
+        # hasn't changed since it started, as otherwise it may be stale.
+        # Generations are never reused, so a user being forgotten and tracked
+        # again can't make a stale calculation look current.
+        self._generations = {}
+        self._generation_counter = itertools.count()
+
+        LaterGauge(
+            "synapse_push_badge_counter_users", "", [],
+            lambda: len(self._unread_rooms_by_user),
+        )
+
+    @defer.inlineCallbacks
+    def get_badge_count(self, user_id):
+        """Get the badge count for the user: the number of rooms they are
+        invited to plus the number of joined rooms with unread notifications.
+
+        Args:
+            user_id (str)
+
+        Returns:
+            Deferred[int]
+        """
+        invites = yield self.store.get_invited_rooms_for_user(user_id)
+        joins = yield self.store.get_rooms_for_user(user_id)
+
+        unread_room_ids = yield self._get_unread_room_ids(user_id, joins)
+
+        # return one badge count per conversation, as count per
+        # message is so noisy as to be almost useless
+        badge = len(invites) + sum(
+            1 for room_id in unread_room_ids if room_id in joins
+        )
+        defer.returnValue(badge)
+
+    @defer.inlineCallbacks
+    def _get_unread_room_ids(self, user_id, joins):
+        now = self.clock.time_msec()
+
+        unread_rooms = self._unread_rooms_by_user.get(user_id)
+        if (
+            unread_rooms is not None and
+            now - unread_rooms.calculated_ts < RECALCULATE_INTERVAL_MS
+        ):
+            defer.returnValue(unread_rooms.room_ids)
+
+        badge_count_recalculations_counter.inc()
+
+        generation = self._generations.get(user_id)
+        if generation is None:
+            generation = next(self._generation_counter)
+            self._generations[user_id] = generation
+
+        notifs_by_room = yield (
+            self.store.get_unread_event_push_actions_by_rooms_for_user(
+                joins, user_id,
+            )
+        )
+
+        room_ids = set(
+            room_id for room_id, notifs in iteritems(notifs_by_room)
+            if notifs["notify_count"]
+        )
+
+        if self._generations.get(user_id) == generation:
+            self._unread_rooms_by_user[user_id] = _UnreadRooms(room_ids, now)
+
+        defer.returnValue(room_ids)
+
+    def on_new_notifications(self, user_and_room_ids):
+        """Called when there are new push actions.
+
+        Args:
+            user_and_room_ids (Iterable[tuple[str, str]]): the users who have
+                new push actions, and the rooms they are in.
+        """
+        for user_id, room_id in user_and_room_ids:
+            self._bump_generation(user_id)
+
+            unread_rooms = self._unread_rooms_by_user.get(user_id)
+            if unread_rooms is not None:
+                unread_rooms.room_ids.add(room_id)
+
+    @defer.inlineCallbacks
+    def on_new_receipts(self, receipts):
+        """Called when read receipts have moved.
+
+        Args:
+            receipts (Iterable[tuple[str, str, str, str]]): the new receipts,
+                as (room_id, receipt_type, user_id, event_id), in stream order.
+
+        Returns:
+            Deferred
+        """
+        for room_id, receipt_type, user_id, event_id in receipts:
+            if receipt_type != "m.read":
+                continue
+
+            self._bump_generation(user_id)
+
+            if user_id not in self._unread_rooms_by_user:
+                continue
+
+            generation = self._generations.get(user_id)
+
+            notifs = yield self.store.get_unread_event_push_actions_by_room_for_user(
+                room_id, user_id, event_id,
+            )
+
+            # we may have forgotten the user while we were waiting
+            unread_rooms = self._unread_rooms_by_user.get(user_id)
+            if unread_rooms is None:
+                continue
+
+            if self._generations.get(user_id) != generation:
+                # there were more updates for the user while we were waiting,
+                # which our result may not reflect, so recalculate their unread
+                # rooms from scratch next time.
+                del self._unread_rooms_by_user[user_id]
+                continue
+
+            if notifs["notify_count"]:
+                unread_rooms.room_ids.add(room_id)
+            else:
+                unread_rooms.room_ids.discard(room_id)
+
+    def _bump_generation(self, user_id):
+        """Record that the given user's unread rooms may have changed, so that
+        any calculations of them in progress don't get cached.
+        """
+        if user_id in self._generations:
+            self._generations[user_id] = next(self._generation_counter)
+
+    def forget_user(self, user_id):
+        """Stop tracking the given user's unread rooms, e.g. because they no
+        longer have any pushers.
+        """
+        self._unread_rooms_by_user.pop(user_id, None)
+        self._generations.pop(user_id, None)
@@ -30,7 +30,11 @@ from synapse.util.async_helpers import Linearizer
 from synapse.util.caches import register_cache
 from synapse.util.caches.descriptors import cached
 
-from .push_rule_evaluator import PushRuleEvaluatorForEvent
+from .push_rule_evaluator import (
+    DisplayNameMatcher,
+    PushRuleEvaluatorForEvent,
+    compile_push_rules,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +47,13 @@ push_rules_invalidation_counter = Counter(
 push_rules_state_size_counter = Counter(
     "synapse_push_bulk_push_rule_evaluator_push_rules_state_size_counter", "")
 
+# The number of users and the number of distinct rule sets that we evaluate
+# push rules for
+push_rules_users_evaluated_counter = Counter(
+    "synapse_push_bulk_push_rule_evaluator_users_evaluated", "")
+push_rules_rule_sets_evaluated_counter = Counter(
+    "synapse_push_bulk_push_rule_evaluator_rule_sets_evaluated", "")
+
 # Measures whether we use the fast path of using state deltas, or if we have to
 # recalculate from scratch
 push_rules_delta_state_cache_metric = register_cache(
@@ -74,7 +85,7 @@ class BulkPushRuleEvaluator(object):
         as well as the push rules for the invitee if the event is an invite.
 
         Returns:
-            dict of user_id -> push_rules
+            dict of user_id -> CompiledPushRules
         """
         room_id = event.room_id
         rules_for_room = self._get_rules_for_room(room_id)
@@ -89,9 +100,8 @@ class BulkPushRuleEvaluator(object):
                 has_pusher = yield self.store.user_has_pusher(invited)
                 if has_pusher:
                     rules_by_user = dict(rules_by_user)
-                    rules_by_user[invited] = yield self.store.get_push_rules_for_user(
-                        invited
-                    )
+                    invited_rules = yield self.store.get_push_rules_for_user(invited)
+                    rules_by_user[invited] = compile_push_rules(invited_rules)
 
         defer.returnValue(rules_by_user)
 
@@ -153,11 +163,23 @@ class BulkPushRuleEvaluator(object):
             yield self._get_power_levels_and_sender_level(event, context)
         )
 
+        # The RulesForRoom maintains a matcher for the display names of the
+        # users we're calculating push for. (If it has been invalidated since
+        # we got the rules then the matcher will be empty, and we'll just check
+        # each display name separately.)
+        display_name_matcher = self._get_rules_for_room(
+            event.room_id,
+        ).display_name_matcher
+
         evaluator = PushRuleEvaluatorForEvent(
             event, len(room_members), sender_power_level, power_levels,
+            display_name_matcher=display_name_matcher,
         )
 
-        condition_cache = {}
+        # Group the users by their (compiled) rules, so that we only evaluate
+        # each distinct set of rules once.
+        user_ids_by_rules = {}
+        display_names = {}
 
         for uid, rules in iteritems(rules_by_user):
             if event.sender == uid:
@@ -179,19 +201,19 @@ class BulkPushRuleEvaluator(object):
                 if event.type == EventTypes.Member and event.state_key == uid:
                     display_name = event.content.get("displayname", None)
 
-            for rule in rules:
-                if 'enabled' in rule and not rule['enabled']:
-                    continue
+            display_names[uid] = display_name
+            user_ids_by_rules.setdefault(rules, []).append(uid)
 
-                matches = _condition_checker(
-                    evaluator, rule['conditions'], uid, display_name, condition_cache
-                )
-                if matches:
-                    actions = [x for x in rule['actions'] if x != 'dont_notify']
-                    if actions and 'notify' in actions:
-                        # Push rules say we should notify the user of this event
-                        actions_by_user[uid] = actions
-                    break
+        push_rules_users_evaluated_counter.inc(len(display_names))
+        push_rules_rule_sets_evaluated_counter.inc(len(user_ids_by_rules))
+
+        # The outcomes of the conditions which don't depend on the user
+        condition_cache = {}
+
+        for rules, user_ids in iteritems(user_ids_by_rules):
+            actions_by_user.update(rules.actions_for_users(
+                evaluator, user_ids, display_names, condition_cache,
+            ))
 
         # Mark in the DB staging area the push actions for users who should be
         # notified for this event. (This will then get handled when we persist
@@ -201,26 +223,6 @@ class BulkPushRuleEvaluator(object):
         )
 
 
-def _condition_checker(evaluator, conditions, uid, display_name, cache):
-    for cond in conditions:
-        _id = cond.get("_id", None)
-        if _id:
-            res = cache.get(_id, None)
-            if res is False:
-                return False
-            elif res is True:
-                continue
-
-        res = evaluator.matches(cond, uid, display_name)
-        if _id:
-            cache[_id] = bool(res)
-
-        if not res:
-            return False
-
-    return True
-
-
 class RulesForRoom(object):
     """Caches push rules for users in a room.
 
@@ -245,7 +247,12 @@ class RulesForRoom(object):
         self.linearizer = Linearizer(name="rules_for_room")
 
         self.member_map = {}  # event_id -> (user_id, state)
-        self.rules_by_user = {}  # user_id -> rules
+        self.rules_by_user = {}  # user_id -> CompiledPushRules
+        self.display_names = {}  # user_id -> display name, for users in rules_by_user
+
+        # Used to find which of the display names in `display_names` are
+        # mentioned in an event. Updated from the changes to `display_names`.
+        self.display_name_matcher = DisplayNameMatcher()
 
         # The last state group we updated the caches for. If the state_group of
         # a new event comes along, we know that we can just return the cached
@@ -296,11 +303,13 @@ class RulesForRoom(object):
             self.room_push_rule_cache_metrics.inc_misses()
 
             ret_rules_by_user = {}
+            ret_display_names = {}
             missing_member_event_ids = {}
             if state_group and self.state_group == context.prev_group:
                 # If we have a simple delta then we can reuse most of the previous
                 # results.
                 ret_rules_by_user = self.rules_by_user
+                ret_display_names = dict(self.display_names)
                 current_state_ids = context.delta_ids
 
                 push_rules_delta_state_cache_metric.inc_hits()
@@ -341,11 +350,15 @@ class RulesForRoom(object):
                         rules = self.rules_by_user.get(user_id, None)
                         if rules:
                             ret_rules_by_user[user_id] = rules
+                            ret_display_names[user_id] = self.display_names.get(
+                                user_id,
+                            )
                     continue
 
                 # If a user has left a room we remove their push rule. If they
                 # joined then we readd it later in _update_rules_with_member_event_ids
                 ret_rules_by_user.pop(user_id, None)
+                ret_display_names.pop(user_id, None)
                 missing_member_event_ids[user_id] = event_id
 
             if missing_member_event_ids:
@@ -353,7 +366,8 @@ class RulesForRoom(object):
                 # and fetch push rules for them if appropriate.
                 logger.debug("Found new member events %r", missing_member_event_ids)
                 yield self._update_rules_with_member_event_ids(
-                    ret_rules_by_user, missing_member_event_ids, state_group, event
+                    ret_rules_by_user, ret_display_names, missing_member_event_ids,
+                    state_group, event,
                 )
             else:
                 # The push rules didn't change but lets update the cache anyway
@@ -361,7 +375,8 @@ class RulesForRoom(object):
                     self.sequence,
                     members={},  # There were no membership changes
                     rules_by_user=ret_rules_by_user,
-                    state_group=state_group
+                    state_group=state_group,
+                    display_names=ret_display_names,
                 )
 
         if logger.isEnabledFor(logging.DEBUG):
@@ -372,14 +387,17 @@ class RulesForRoom(object):
         defer.returnValue(ret_rules_by_user)
 
     @defer.inlineCallbacks
-    def _update_rules_with_member_event_ids(self, ret_rules_by_user, member_event_ids,
-                                            state_group, event):
+    def _update_rules_with_member_event_ids(self, ret_rules_by_user, ret_display_names,
+                                            member_event_ids, state_group, event):
         """Update the partially filled rules_by_user dict by fetching rules for
         any newly joined users in the `member_event_ids` list.
 
         Args:
             ret_rules_by_user (dict): Partiallly filled dict of push rules. Gets
                 updated with any new rules.
+            ret_display_names (dict): Partially filled dict of the display names
+                of the users in ret_rules_by_user. Gets updated with the display
+                names of any newly joined users.
             member_event_ids (list): List of event ids for membership events that
                 have happened since the last time we filled rules_by_user
             state_group: The state group we are currently computing push rules
@@ -391,7 +409,7 @@ class RulesForRoom(object):
             table="room_memberships",
             column="event_id",
             iterable=member_event_ids.values(),
-            retcols=('user_id', 'membership', 'event_id'),
+            retcols=('user_id', 'membership', 'event_id', 'display_name'),
             keyvalues={},
             batch_size=500,
             desc="_get_rules_for_member_event_ids",
@@ -402,12 +420,21 @@ class RulesForRoom(object):
             for row in rows
         }
 
+        display_names = {
+            row["user_id"]: row["display_name"]
+            for row in rows
+            if row["membership"] == Membership.JOIN
+        }
+
         # If the event is a join event then it will be in current state evnts
         # map but not in the DB, so we have to explicitly insert it.
         if event.type == EventTypes.Member:
             for event_id in itervalues(member_event_ids):
                 if event_id == event.event_id:
                     members[event_id] = (event.state_key, event.membership)
+                    display_names[event.state_key] = event.content.get(
+                        "displayname", None,
+                    )
 
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Found members %r: %r", self.room_id, members.values())
@@ -446,10 +473,17 @@ class RulesForRoom(object):
         )
 
         ret_rules_by_user.update(
-            item for item in iteritems(rules_by_user) if item[0] is not None
+            (uid, compile_push_rules(rules))
+            for uid, rules in iteritems(rules_by_user) if uid is not None
+        )
+        ret_display_names.update(
+            (uid, display_names.get(uid))
+            for uid in rules_by_user if uid is not None
         )
 
-        self.update_cache(sequence, members, ret_rules_by_user, state_group)
+        self.update_cache(
+            sequence, members, ret_rules_by_user, state_group, ret_display_names,
+        )
 
     def invalidate_all(self):
         # Note: Don't hand this function directly to an invalidation callback
@@ -461,13 +495,34 @@ class RulesForRoom(object):
         self.state_group = object()
         self.member_map = {}
         self.rules_by_user = {}
+        self.display_names = {}
+        self.display_name_matcher = DisplayNameMatcher()
         push_rules_invalidation_counter.inc()
 
-    def update_cache(self, sequence, members, rules_by_user, state_group):
+    def update_cache(self, sequence, members, rules_by_user, state_group,
+                     display_names):
         if sequence == self.sequence:
             self.member_map.update(members)
             self.rules_by_user = rules_by_user
             self.state_group = state_group
+            self._update_display_names(display_names)
+
+    def _update_display_names(self, display_names):
+        """Replace `display_names`, applying the differences to the
+        display_name_matcher.
+        """
+        old_display_names = self.display_names
+        matcher = self.display_name_matcher
+
+        for user_id, display_name in iteritems(old_display_names):
+            if display_names.get(user_id) != display_name:
+                matcher.remove(display_name)
+
+        for user_id, display_name in iteritems(display_names):
+            if old_display_names.get(user_id) != display_name:
+                matcher.add(display_name)
+
+        self.display_names = display_names
 
 
 class _Invalidation(namedtuple("_Invalidation", ("cache", "room_id"))):
@@ -107,7 +107,7 @@ class HttpPusher(object):
                 "'url' required in data for HTTP pusher"
             )
         self.url = self.data['url']
-        self.http_client = hs.get_simple_http_client()
+        self.push_gateway_client = hs.get_pusherpool().push_gateway_client
         self.data_minus_url = {}
         self.data_minus_url.update(self.data)
         del self.data_minus_url['url']
@@ -128,7 +128,9 @@ class HttpPusher(object):
 
     @defer.inlineCallbacks
     def _update_badge(self):
-        badge = yield push_tools.get_badge_count(self.hs.get_datastore(), self.user_id)
+        badge = yield self.hs.get_pusherpool().badge_counter.get_badge_count(
+            self.user_id,
+        )
         yield self._send_badge(badge)
 
     def on_timer(self):
@@ -254,7 +256,9 @@ class HttpPusher(object):
             defer.returnValue(True)
 
         tweaks = push_rule_evaluator.tweaks_for_actions(push_action['actions'])
-        badge = yield push_tools.get_badge_count(self.hs.get_datastore(), self.user_id)
+        badge = yield self.hs.get_pusherpool().badge_counter.get_badge_count(
+            self.user_id,
+        )
 
         event = yield self.store.get_event(push_action['event_id'], allow_none=True)
         if event is None:
@@ -353,16 +357,15 @@ class HttpPusher(object):
         if not notification_dict:
             defer.returnValue([])
         try:
-            resp = yield self.http_client.post_json_get_json(self.url, notification_dict)
+            rejected = yield self.push_gateway_client.send_notification(
+                self.url, notification_dict,
+            )
         except Exception as e:
             logger.warning(
                 "Failed to push event %s to %s: %s %s",
                 event.event_id, self.name, type(e), e,
             )
             defer.returnValue(False)
-        rejected = []
-        if 'rejected' in resp:
-            rejected = resp['rejected']
         defer.returnValue(rejected)
 
     @defer.inlineCallbacks
@@ -391,7 +394,7 @@ class HttpPusher(object):
             }
         }
         try:
-            yield self.http_client.post_json_get_json(self.url, d)
+            yield self.push_gateway_client.send_notification(self.url, d)
             http_badges_processed_counter.inc()
         except Exception as e:
             logger.warning(
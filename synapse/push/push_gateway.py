@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from canonicaljson import encode_canonical_json
+from prometheus_client import Counter, Histogram
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.util.async_helpers import Linearizer
+from synapse.util.logcontext import PreserveLoggingContext, make_deferred_yieldable
+
+logger = logging.getLogger(__name__)
+
+# Push gateway URLs are supplied by users when they set up pushers, so the
+# metrics aren't labelled by gateway.
+
+push_gateway_request_latency = Histogram(
+    "synapse_push_gateway_request_latency_seconds",
+    "Time taken for push gateways to respond to requests",
+)
+
+push_gateway_requests_counter = Counter(
+    "synapse_push_gateway_requests",
+    "Number of requests made to push gateways",
+)
+
+push_gateway_notifications_counter = Counter(
+    "synapse_push_gateway_notifications",
+    "Number of per-device notifications sent to push gateways",
+)
+
+
+class _PendingBatch(object):
+    """Notifications for the same gateway, which are identical apart from the
+    devices they are for, and which are waiting to be sent in one request.
+    """
+    __slots__ = ["notification", "waiters"]
+
+    def __init__(self, notification):
+        # The notification, minus its devices
+        self.notification = notification
+
+        # list of (devices, Deferred) for each of the notifications in the
+        # batch. The deferred is resolved with the rejected pushkeys of the
+        # devices.
+        self.waiters = []
+
+
+class PushGatewayClient(object):
+    """Sends notifications to push gateways on behalf of the HTTP pushers.
+
+    The number of concurrent requests to each gateway is limited, so that a
+    spike in notifications queues up rather than opening ever more connections,
+    and a slow gateway doesn't hold up the others.
+
+    If `push.gateway_batch_window_ms` is set, notifications for the same
+    gateway which only differ in their devices (e.g. the same event pushed to
+    several of a user's devices) are coalesced into a single request if they
+    are sent within that window of each other.
+    """
+
+    def __init__(self, hs):
+        self.clock = hs.get_clock()
+        self.http_client = hs.get_simple_http_client()
+
+        self._batch_window_ms = hs.config.push_gateway_batch_window_ms
+
+        self._limiter = Linearizer(
+            name="push_gateway",
+            max_count=hs.config.push_gateway_max_concurrent_requests,
+            clock=self.clock,
+        )
+
+        # (url, batch key) -> _PendingBatch
+        self._pending_batches = {}
+
+        # number of notifications waiting to be sent to push gateways
+        self._queued_count = 0
+
+        LaterGauge(
+            "synapse_push_gateway_queued_notifications",
+            "Number of notifications waiting to be sent to push gateways",
+            [],
+            lambda: self._queued_count,
+        )
+
+    @defer.inlineCallbacks
+    def send_notification(self, url, notification):
+        """Send a notification to a push gateway.
+
+        Args:
+            url (str): the push gateway's notify URL
+            notification (dict): the body of the request, as defined by the
+                push gateway API.
+
+        Returns:
+            Deferred[list[str]]: the pushkeys of the notification's devices
+            which the gateway rejected.
+
+        Raises:
+            if the request to the gateway failed.
+        """
+        if not self._batch_window_ms:
+            rejected = yield self._post(url, notification, 1)
+            defer.returnValue(rejected)
+
+        devices = notification["notification"]["devices"]
+        notification_minus_devices = dict(notification)
+        notification_minus_devices["notification"] = dict(
+            notification["notification"],
+        )
+        del notification_minus_devices["notification"]["devices"]
+
+        key = (url, encode_canonical_json(notification_minus_devices))
+
+        batch = self._pending_batches.get(key)
+        if batch is None:
+            batch = _PendingBatch(notification_minus_devices)
+            self._pending_batches[key] = batch
+            self.clock.call_later(
+                self._batch_window_ms / 1000., self._send_batch, key,
+            )
+
+        d = defer.Deferred()
+        batch.waiters.append((devices, d))
+        self._queued_count += 1
+
+        rejected = yield make_deferred_yieldable(d)
+        defer.returnValue(rejected)
+
+    def _send_batch(self, key):
+        batch = self._pending_batches.pop(key)
+        run_as_background_process(
+            "push_gateway_send_batch", self._do_send_batch, key[0], batch,
+        )
+
+    @defer.inlineCallbacks
+    def _do_send_batch(self, url, batch):
+        notification = dict(batch.notification)
+        notification["notification"] = dict(notification["notification"])
+        notification["notification"]["devices"] = [
+            device for devices, _ in batch.waiters for device in devices
+        ]
+
+        # the notifications are already counted as queued
+        self._queued_count -= len(batch.waiters)
+
+        try:
+            rejected = yield self._post(url, notification, len(batch.waiters))
+        except Exception:
+            f = Failure()
+            with PreserveLoggingContext():
+                for _, d in batch.waiters:
+                    d.errback(f)
+            return
+
+        rejected = set(rejected)
+        with PreserveLoggingContext():
+            for devices, d in batch.waiters:
+                d.callback([
+                    device["pushkey"] for device in devices
+                    if device["pushkey"] in rejected
+                ])
+
+    @defer.inlineCallbacks
+    def _post(self, url, notification, notification_count):
+        """Make a request to the gateway, waiting until we are below the
+        concurrency limit for it.
+
+        Args:
+            url (str)
+            notification (dict)
+            notification_count (int): the number of notifications being sent in
+                the request, for metrics.
+
+        Returns:
+            Deferred[list[str]]: the rejected pushkeys
+        """
+        self._queued_count += notification_count
+        try:
+            with (yield self._limiter.queue(url)):
+                self._queued_count -= notification_count
+                notification_count = 0
+
+                push_gateway_requests_counter.inc()
+                push_gateway_notifications_counter.inc(
+                    len(notification["notification"]["devices"]),
+                )
+
+                start = self.clock.time()
+                try:
+                    resp = yield self.http_client.post_json_get_json(
+                        url, notification,
+                    )
+                finally:
+                    push_gateway_request_latency.observe(
+                        self.clock.time() - start,
+                    )
+        finally:
+            # if we failed before getting to the front of the queue
+            self._queued_count -= notification_count
+
+        defer.returnValue(resp.get("rejected", []))
@@ -19,6 +19,8 @@ import re
 
 from six import string_types
 
+from canonicaljson import json
+
 from synapse.types import UserID
 from synapse.util.caches import CACHE_SIZE_FACTOR, register_cache
 from synapse.util.caches.lrucache import LruCache
@@ -30,6 +32,33 @@ GLOB_REGEX = re.compile(r'\\\[(\\\!|)(.*)\\\]')
 IS_GLOB = re.compile(r'[\?\*\[\]]')
 INEQUALITY_EXPR = re.compile("^([=<>]*)([0-9]*)$")
 
+# Matches the words in a message body. This must use the same definition of a
+# word character as _re_word_boundary.
+WORD_REGEX = re.compile(r"\w+")
+
+# Characters which a case-insensitive regex treats as equal to a different
+# lowercase character, mapped to that character. This mirrors the extra
+# equivalences in the re module, so that _fold_case agrees with re.IGNORECASE.
+_CASE_EQUIVALENCES = {
+    0x131: u"i",  # LATIN SMALL LETTER DOTLESS I
+    0x17f: u"s",  # LATIN SMALL LETTER LONG S
+    0xb5: u"\u03bc",  # MICRO SIGN
+    0x345: u"\u03b9",  # COMBINING GREEK YPOGEGRAMMENI
+    0x1fbe: u"\u03b9",  # GREEK PROSGEGRAMMENI
+    0x1fd3: u"\u0390",
+    0x1fe3: u"\u03b0",
+    0x3d0: u"\u03b2",  # GREEK BETA SYMBOL
+    0x3f5: u"\u03b5",  # GREEK LUNATE EPSILON SYMBOL
+    0x3d1: u"\u03b8",  # GREEK THETA SYMBOL
+    0x3f0: u"\u03ba",  # GREEK KAPPA SYMBOL
+    0x3d6: u"\u03c0",  # GREEK PI SYMBOL
+    0x3f1: u"\u03c1",  # GREEK RHO SYMBOL
+    0x3c2: u"\u03c3",  # GREEK SMALL LETTER FINAL SIGMA
+    0x3d5: u"\u03c6",  # GREEK PHI SYMBOL
+    0x1e9b: u"\u1e61",
+    0xfb06: u"\ufb05",
+}
+
 
 def _room_member_count(ev, condition, room_member_count):
     return _test_ineq_condition(condition, room_member_count)
@@ -82,12 +111,296 @@ def tweaks_for_actions(actions):
     return tweaks
 
 
+def _is_per_user_condition(condition):
+    """Whether the outcome of the given condition depends on the user whose
+    rule it is, rather than just on the event.
+    """
+    kind = condition.get('kind')
+    if kind == 'contains_display_name':
+        return True
+    if kind == 'event_match' and not condition.get('pattern', None):
+        # the pattern comes from the user's ID (see `pattern_type`)
+        return True
+    return False
+
+
+class _CompiledRule(object):
+    __slots__ = ["shared_conditions", "per_user_conditions", "actions"]
+
+    def __init__(self, shared_conditions, per_user_conditions, actions):
+        self.shared_conditions = shared_conditions
+        self.per_user_conditions = per_user_conditions
+        self.actions = actions
+
+
+class CompiledPushRules(object):
+    """A user's list of push rules, compiled so that they can be evaluated for
+    an event once for all the users who have identical rules.
+
+    Disabled rules are dropped, and the conditions of each rule are split into
+    those whose outcome only depends on the event, which are evaluated once per
+    event (and shared between rule sets), and those which depend on the user
+    (their display name or user ID), which are evaluated per user.
+
+    Use `compile_push_rules` to get an instance, so that identical rule sets
+    share a single CompiledPushRules.
+    """
+    __slots__ = ["rules"]
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules (list[dict]): the user's push rules, in priority order.
+        """
+        self.rules = []
+        for rule in rules:
+            if 'enabled' in rule and not rule['enabled']:
+                continue
+
+            shared_conditions = []
+            per_user_conditions = []
+            for condition in rule['conditions']:
+                if _is_per_user_condition(condition):
+                    per_user_conditions.append(condition)
+                else:
+                    # the key under which we cache the outcome of the condition
+                    # for an event
+                    key = json.dumps(condition, sort_keys=True)
+                    shared_conditions.append((key, condition))
+
+            self.rules.append(_CompiledRule(
+                shared_conditions=shared_conditions,
+                per_user_conditions=per_user_conditions,
+                actions=[x for x in rule['actions'] if x != 'dont_notify'],
+            ))
+
+    def actions_for_users(self, evaluator, user_ids, display_names, condition_cache):
+        """Evaluate the rules for an event for each of the given users, who must
+        all have these rules.
+
+        Args:
+            evaluator (PushRuleEvaluatorForEvent)
+            user_ids (Iterable[str])
+            display_names (dict[str, str|None]): the display names of the users
+            condition_cache (dict[str, bool]): the outcomes of the conditions
+                which don't depend on the user, shared between all the rule sets
+                evaluated for the event.
+
+        Returns:
+            dict[str, list]: the actions for each user who should be notified
+            of the event.
+        """
+        actions_by_user = {}
+
+        # The users for whom we haven't yet found a matching rule
+        remaining = list(user_ids)
+
+        for rule in self.rules:
+            if not remaining:
+                break
+
+            if not _shared_conditions_match(
+                evaluator, rule.shared_conditions, condition_cache,
+            ):
+                continue
+
+            if rule.per_user_conditions:
+                matched = []
+                unmatched = []
+                for uid in remaining:
+                    display_name = display_names.get(uid)
+                    if all(
+                        evaluator.matches(condition, uid, display_name)
+                        for condition in rule.per_user_conditions
+                    ):
+                        matched.append(uid)
+                    else:
+                        unmatched.append(uid)
+                remaining = unmatched
+            else:
+                matched = remaining
+                remaining = []
+
+            if rule.actions and 'notify' in rule.actions:
+                # Push rules say we should notify these users of this event
+                for uid in matched:
+                    actions_by_user[uid] = rule.actions
+
+        return actions_by_user
+
+
+def _shared_conditions_match(evaluator, conditions, condition_cache):
+    for key, condition in conditions:
+        res = condition_cache.get(key, None)
+        if res is None:
+            # the user ID and display name aren't used by these conditions
+            res = bool(evaluator.matches(condition, None, None))
+            condition_cache[key] = res
+
+        if not res:
+            return False
+
+    return True
+
+
+# Interns CompiledPushRules by the JSON of the rules they were compiled from, so
+# that users with identical rules share an instance. See compile_push_rules.
+compiled_push_rules_cache = LruCache(10000 * CACHE_SIZE_FACTOR)
+register_cache("cache", "compiled_push_rules_cache", compiled_push_rules_cache)
+
+
+def compile_push_rules(rules):
+    """Get the CompiledPushRules for the given list of push rules.
+
+    Args:
+        rules (list[dict]): the user's push rules, in priority order.
+
+    Returns:
+        CompiledPushRules: an instance which is shared with any other users
+        whose rules are identical (as long as it stays in the cache).
+    """
+    key = json.dumps(rules, sort_keys=True)
+    compiled = compiled_push_rules_cache.get(key, None)
+    if compiled is None:
+        compiled = CompiledPushRules(rules)
+        compiled_push_rules_cache[key] = compiled
+    return compiled
+
+
+class DisplayNameMatcher(object):
+    """Finds which of a set of display names are mentioned in a message body in
+    a single pass over the body, rather than running a regex per name.
+
+    Names are indexed by their first word, case folded: a name can only be
+    mentioned (in the sense of `_contains_display_name`) if that word appears
+    as a whole word in the body. Only the names whose first word appears are
+    then checked with their regex. Names which don't start with a word, or
+    which would be interpreted as globs, are always checked with their regex.
+
+    The set of names is maintained incrementally with `add` and `remove`, which
+    are reference counted as several users may share a display name.
+    """
+
+    def __init__(self):
+        # name -> number of times it has been added
+        self._name_counts = {}
+
+        # case folded first word -> set of names starting with it
+        self._names_by_first_word = {}
+
+        # names which we can't index by their first word
+        self._unindexed_names = set()
+
+    def __len__(self):
+        return len(self._name_counts)
+
+    def __contains__(self, name):
+        return name in self._name_counts
+
+    def add(self, name):
+        if not name:
+            return
+
+        count = self._name_counts.get(name, 0)
+        self._name_counts[name] = count + 1
+        if count:
+            return
+
+        first_word = _first_word(name)
+        if first_word is None:
+            self._unindexed_names.add(name)
+        else:
+            self._names_by_first_word.setdefault(first_word, set()).add(name)
+
+    def remove(self, name):
+        count = self._name_counts.get(name)
+        if not count:
+            return
+
+        if count > 1:
+            self._name_counts[name] = count - 1
+            return
+
+        del self._name_counts[name]
+
+        first_word = _first_word(name)
+        if first_word is None:
+            self._unindexed_names.discard(name)
+        else:
+            names = self._names_by_first_word.get(first_word)
+            names.discard(name)
+            if not names:
+                del self._names_by_first_word[first_word]
+
+    def find_mentions(self, body):
+        """Find which of the names are mentioned in the body.
+
+        Args:
+            body (str)
+
+        Returns:
+            set[str]: the mentioned names
+        """
+        candidates = set(self._unindexed_names)
+        for word in set(WORD_REGEX.findall(body)):
+            names = self._names_by_first_word.get(_fold_case(word))
+            if names:
+                candidates.update(names)
+
+        return set(
+            name for name in candidates
+            if _glob_matches(name, body, word_boundary=True)
+        )
+
+
+def _first_word(name):
+    """Get the key to index the display name under in a DisplayNameMatcher, or
+    None if it can't be indexed.
+    """
+    if IS_GLOB.search(name):
+        return None
+
+    match = WORD_REGEX.match(name)
+    if not match:
+        return None
+
+    return _fold_case(match.group(0))
+
+
+def _fold_case(word):
+    """Fold the case of a word, such that two words get the same result if
+    and only if they match each other as case-insensitive regexes.
+    """
+    folded = word.lower()
+    if len(folded) != len(word):
+        # Some characters (namely U+0130) lowercase to several characters,
+        # whereas the re module compares single characters.
+        folded = u"".join(c.lower()[0] for c in word)
+    return folded.translate(_CASE_EQUIVALENCES)
+
+
 class PushRuleEvaluatorForEvent(object):
-    def __init__(self, event, room_member_count, sender_power_level, power_levels):
+    def __init__(self, event, room_member_count, sender_power_level, power_levels,
+                 display_name_matcher=None):
+        """
+        Args:
+            event (FrozenEvent)
+            room_member_count (int)
+            sender_power_level (int)
+            power_levels (dict)
+            display_name_matcher (DisplayNameMatcher|None): if given, used to
+                find all the mentioned display names at once. Display names
+                which it doesn't know about are checked individually.
+        """
         self._event = event
         self._room_member_count = room_member_count
         self._sender_power_level = sender_power_level
         self._power_levels = power_levels
+        self._display_name_matcher = display_name_matcher
+
+        # The display names mentioned in the body, according to the
+        # display_name_matcher. Calculated on first use.
+        self._mentioned_names = None
 
         # Maps strings of e.g. 'content.body' -> event["content"]["body"]
         self._value_cache = _flatten_dict(event)
@@ -144,6 +457,16 @@ class PushRuleEvaluatorForEvent(object):
         if not body:
             return False
 
+        matcher = self._display_name_matcher
+        if (
+            matcher is not None and
+            display_name in matcher and
+            isinstance(body, string_types)
+        ):
+            if self._mentioned_names is None:
+                self._mentioned_names = matcher.find_mentions(body)
+            return display_name in self._mentioned_names
+
         return _glob_matches(display_name, body, word_boundary=True)
 
     def _get_value(self, dotted_key):
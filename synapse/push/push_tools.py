@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from six import itervalues
+
 from twisted.internet import defer
 
 from synapse.push.presentable_names import calculate_room_name, name_from_member_event
@@ -23,24 +25,16 @@ def get_badge_count(store, user_id):
     invites = yield store.get_invited_rooms_for_user(user_id)
     joins = yield store.get_rooms_for_user(user_id)
 
-    my_receipts_by_room = yield store.get_receipts_for_user(
-        user_id, "m.read",
+    notifs_by_room = yield store.get_unread_event_push_actions_by_rooms_for_user(
+        joins, user_id,
     )
 
     badge = len(invites)
 
-    for room_id in joins:
-        if room_id in my_receipts_by_room:
-            last_unread_event_id = my_receipts_by_room[room_id]
-
-            notifs = yield (
-                store.get_unread_event_push_actions_by_room_for_user(
-                    room_id, user_id, last_unread_event_id
-                )
-            )
-            # return one badge count per conversation, as count per
-            # message is so noisy as to be almost useless
-            badge += 1 if notifs["notify_count"] else 0
+    for notifs in itervalues(notifs_by_room):
+        # return one badge count per conversation, as count per
+        # message is so noisy as to be almost useless
+        badge += 1 if notifs["notify_count"] else 0
     defer.returnValue(badge)
 
 
@@ -20,11 +20,28 @@ from twisted.internet import defer
 
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.push import PusherConfigException
+from synapse.push.badge_counter import BadgeCounter
+from synapse.push.push_gateway import PushGatewayClient
 from synapse.push.pusher import PusherFactory
+from synapse.util import get_shard_for_key
 
 logger = logging.getLogger(__name__)
 
 
+def get_pusher_shard_for_user(user_id, shard_count):
+    """Get the index of the pusher shard responsible for the given user's
+    pushers.
+
+    Args:
+        user_id (str)
+        shard_count (int): the number of pusher shards
+
+    Returns:
+        int
+    """
+    return get_shard_for_key(user_id, shard_count)
+
+
 class PusherPool:
     """
     The pusher pool. This is responsible for dispatching notifications of new events to
@@ -46,6 +63,26 @@ class PusherPool:
         self.store = self.hs.get_datastore()
         self.clock = self.hs.get_clock()
         self.pushers = {}
+        self.badge_counter = BadgeCounter(_hs)
+        self.push_gateway_client = PushGatewayClient(_hs)
+
+        # If there are several pusher workers, we only run the pushers for the
+        # users in our shard.
+        self._pusher_shard_count = _hs.config.worker_pusher_shard_count
+        self._pusher_shard_index = _hs.config.worker_pusher_shard_index
+
+    def is_pusher_shard_for_user(self, user_id):
+        """Whether we are responsible for running the given user's pushers.
+
+        Args:
+            user_id (str)
+
+        Returns:
+            bool
+        """
+        return get_pusher_shard_for_user(
+            user_id, self._pusher_shard_count,
+        ) == self._pusher_shard_index
 
     def start(self):
         """Starts the pushers off in a background process.
@@ -146,10 +183,17 @@ class PusherPool:
             return
 
         try:
-            users_affected = yield self.store.get_push_action_users_in_range(
-                min_stream_id, max_stream_id
+            user_and_room_ids = yield (
+                self.store.get_push_action_users_and_rooms_in_range(
+                    min_stream_id, max_stream_id
+                )
             )
 
+            # update the badge counts before the pushers go looking for them
+            self.badge_counter.on_new_notifications(user_and_room_ids)
+
+            users_affected = set(user_id for user_id, _ in user_and_room_ids)
+
             for u in users_affected:
                 if u in self.pushers:
                     for p in self.pushers[u].values():
@@ -170,6 +214,14 @@ class PusherPool:
             updated_receipts = yield self.store.get_all_updated_receipts(
                 min_stream_id - 1, max_stream_id
             )
+            updated_receipts = list(updated_receipts)
+
+            # update the badge counts before the pushers go looking for them
+            yield self.badge_counter.on_new_receipts(
+                r[1:5] for r in updated_receipts
+                if r[3] in self.pushers
+            )
+
             # This returns a tuple, user_id is at index 3
             users_affected = set([r[3] for r in updated_receipts])
 
@@ -187,6 +239,9 @@ class PusherPool:
         if not self._should_start_pushers:
             return
 
+        if not self.is_pusher_shard_for_user(user_id):
+            return
+
         resultlist = yield self.store.get_pushers_by_app_id_and_pushkey(
             app_id, pushkey
         )
@@ -207,6 +262,9 @@ class PusherPool:
             Deferred
         """
         pushers = yield self.store.get_all_pushers()
+        pushers = [
+            p for p in pushers if self.is_pusher_shard_for_user(p['user_name'])
+        ]
         logger.info("Starting %d pushers", len(pushers))
         for pusherdict in pushers:
             self._start_pusher(pusherdict)
@@ -260,6 +318,10 @@ class PusherPool:
             logger.info("Stopping pusher %s / %s", user_id, appid_pushkey)
             byuser[appid_pushkey].on_stop()
             del byuser[appid_pushkey]
+
+        if not byuser:
+            self.badge_counter.forget_user(user_id)
+
         yield self.store.delete_pusher_by_app_id_pushkey_user_id(
             app_id, pushkey, user_id
         )
@@ -162,11 +162,15 @@ class ReplicationClientHandler(object):
             logger.warn("Queuing command as not connected: %r", cmd.NAME)
             self.pending_commands.append(cmd)
 
-    def send_federation_ack(self, token):
+    def send_federation_ack(self, token, shard_index=0):
         """Ack data for the federation stream. This allows the master to drop
         data stored purely in memory.
+
+        Args:
+            token (int): the position the federation sender has processed up to
+            shard_index (int): the federation sender shard sending the ack
         """
-        self.send_command(FederationAckCommand(token))
+        self.send_command(FederationAckCommand(token, shard_index))
 
     def send_user_sync(self, user_id, is_syncing, last_sync_ms):
         """Poke the master that a user has started/stopped syncing.
@@ -245,22 +245,30 @@ class FederationAckCommand(Command):
     federation stream. This allows the master to drop in-memory caches of the
     federation stream.
 
-    This must only be sent from one worker (i.e. the one sending federation)
+    This must only be sent from the workers sending federation. If federation
+    sending is sharded, each shard includes its index, which is omitted for
+    the first shard.
 
     Format::
 
-        FEDERATION_ACK <token>
+        FEDERATION_ACK <token> [<shard_index>]
     """
     NAME = "FEDERATION_ACK"
 
-    def __init__(self, token):
+    def __init__(self, token, shard_index=0):
         self.token = token
+        self.shard_index = shard_index
 
     @classmethod
     def from_line(cls, line):
-        return cls(int(line))
+        parts = line.split(" ")
+        token = int(parts[0])
+        shard_index = int(parts[1]) if len(parts) > 1 else 0
+        return cls(token, shard_index)
 
     def to_line(self):
+        if self.shard_index:
+            return "%d %d" % (self.token, self.shard_index)
         return str(self.token)
 
 
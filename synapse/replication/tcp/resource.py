@@ -107,6 +107,14 @@ class ReplicationStreamer(object):
         if not hs.config.send_federation:
             self.federation_sender = hs.get_federation_sender()
 
+        # shard index -> the latest position in the federation stream that
+        # the federation sender shard has acknowledged. There may be several
+        # federation sender shards, so we can only drop data once every one of
+        # them has acknowledged it. We keep a shard's position after it
+        # disconnects, as it will resume from there when it reconnects.
+        self._federation_shard_count = hs.config.worker_federation_sender_shard_count
+        self._federation_acks = {}
+
         self.notifier.add_replication_callback(self.on_notifier_poke)
 
         # Keeps track of whether we are currently checking for updates
@@ -228,12 +236,34 @@ class ReplicationStreamer(object):
         return stream.get_updates_since(token)
 
     @measure_func("repl.federation_ack")
-    def federation_ack(self, token):
+    def federation_ack(self, shard_index, token):
         """We've received an ack for federation stream from a client.
+
+        Args:
+            shard_index (int): the federation sender shard that sent the ack
+            token (int): the position the shard has processed up to
         """
         federation_ack_counter.inc()
-        if self.federation_sender:
-            self.federation_sender.federation_ack(token)
+        if not self.federation_sender:
+            return
+
+        if not 0 <= shard_index < self._federation_shard_count:
+            logger.warning(
+                "Ignoring federation ack from unknown shard %d (of %d)",
+                shard_index, self._federation_shard_count,
+            )
+            return
+
+        self._federation_acks[shard_index] = token
+
+        # Until every shard has told us where it has got to, we can't tell
+        # which data they might still need.
+        if len(self._federation_acks) < self._federation_shard_count:
+            return
+
+        self.federation_sender.federation_ack(
+            min(itervalues(self._federation_acks)),
+        )
 
     @measure_func("repl.on_user_sync")
     @defer.inlineCallbacks
@@ -61,6 +61,7 @@ from synapse.handlers.initial_sync import InitialSyncHandler
 from synapse.handlers.message import EventCreationHandler, MessageHandler
 from synapse.handlers.pagination import PaginationHandler
 from synapse.handlers.presence import PresenceHandler
+from synapse.handlers.presence_audience import PresenceAudience
 from synapse.handlers.profile import BaseProfileHandler, MasterProfileHandler
 from synapse.handlers.read_marker import ReadMarkerHandler
 from synapse.handlers.receipts import ReceiptsHandler
@@ -131,6 +132,7 @@ class HomeServer(object):
         'state_handler',
         'state_resolution_handler',
         'presence_handler',
+        'presence_audience',
         'sync_handler',
         'typing_handler',
         'room_list_handler',
@@ -308,6 +310,9 @@ class HomeServer(object):
     def build_presence_handler(self):
         return PresenceHandler(self)
 
+    def build_presence_audience(self):
+        return PresenceAudience(self)
+
     def build_typing_handler(self):
         return TypingHandler(self)
 
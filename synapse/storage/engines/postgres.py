@@ -89,6 +89,13 @@ class PostgresEngine(object):
         txn.execute("SELECT nextval('state_group_id_seq')")
         return txn.fetchone()[0]
 
+    def get_next_inbound_staging_stream_id(self, txn):
+        """Returns an int that can be used as the stream_id of a new row in
+        federation_inbound_events_staging
+        """
+        txn.execute("SELECT nextval('federation_inbound_events_staging_seq')")
+        return txn.fetchone()[0]
+
     @property
     def server_version(self):
         """Returns a string giving the server version. For example: '8.1.5'
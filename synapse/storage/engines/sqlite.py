@@ -30,6 +30,11 @@ class Sqlite3Engine(object):
         self._current_state_group_id = None
         self._current_state_group_id_lock = threading.Lock()
 
+        # The current max stream_id in federation_inbound_events_staging, or
+        # None if we haven't looked in the DB yet.
+        self._current_inbound_staging_stream_id = None
+        self._current_inbound_staging_stream_id_lock = threading.Lock()
+
     @property
     def can_native_upsert(self):
         """
@@ -70,6 +75,22 @@ class Sqlite3Engine(object):
             self._current_state_group_id += 1
             return self._current_state_group_id
 
+    def get_next_inbound_staging_stream_id(self, txn):
+        """Returns an int that can be used as the stream_id of a new row in
+        federation_inbound_events_staging
+        """
+        # As above, we're a single process synapse.
+        with self._current_inbound_staging_stream_id_lock:
+            if self._current_inbound_staging_stream_id is None:
+                txn.execute(
+                    "SELECT COALESCE(max(stream_id), 0)"
+                    " FROM federation_inbound_events_staging"
+                )
+                self._current_inbound_staging_stream_id = txn.fetchone()[0]
+
+            self._current_inbound_staging_stream_id += 1
+            return self._current_inbound_staging_stream_id
+
     @property
     def server_version(self):
         """Gets a string giving the server version. For example: '3.22.0'
@@ -16,18 +16,28 @@
 
 import logging
 
-from six import iteritems
+from six import iteritems, itervalues
 
 from canonicaljson import json
+from prometheus_client import Counter
 
 from twisted.internet import defer
 
+from synapse.metrics import LaterGauge
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage._base import LoggingTransaction, SQLBaseStore
+from synapse.util import batch_iter
+from synapse.util.async_helpers import ObservableDeferred
 from synapse.util.caches.descriptors import cachedInlineCallbacks
+from synapse.util.logcontext import make_deferred_yieldable
 
 logger = logging.getLogger(__name__)
 
+# The number of push actions which have been rotated into event_push_summary
+rotated_push_actions_counter = Counter(
+    "synapse_push_notif_rotation_rotated_push_actions", "",
+)
+
 
 DEFAULT_NOTIF_ACTION = ["notify", {"set_tweak": "highlight", "value": False}]
 DEFAULT_HIGHLIGHT_ACTION = [
@@ -166,6 +176,139 @@ class EventPushActionsWorkerStore(SQLBaseStore):
             "highlight_count": highlight_count,
         }
 
+    @defer.inlineCallbacks
+    def get_unread_event_push_actions_by_rooms_for_user(self, room_ids, user_id):
+        """Get the unread notification and highlight counts for a user in many
+        rooms at once, relative to their read receipt in each room.
+
+        This shares its cache with `get_unread_event_push_actions_by_room_for_user`,
+        and all the counts which aren't already cached are calculated in a
+        single query.
+
+        Args:
+            room_ids (Iterable[str])
+            user_id (str)
+
+        Returns:
+            Deferred[dict[str, dict]]: map from room ID to a dict with
+            "notify_count" and "highlight_count" keys. Rooms in which the user
+            has no read receipt are omitted.
+        """
+        receipts_by_room = yield self.get_receipts_for_user(user_id, "m.read")
+
+        cache = self.get_unread_event_push_actions_by_room_for_user.cache
+
+        results = {}
+        pending = []
+        missing = {}
+        for room_id in room_ids:
+            last_read_event_id = receipts_by_room.get(room_id)
+            if last_read_event_id is None:
+                continue
+
+            key = (room_id, user_id, last_read_event_id)
+            try:
+                res = cache.get(key)
+            except KeyError:
+                missing[room_id] = last_read_event_id
+                continue
+
+            if not isinstance(res, ObservableDeferred):
+                results[room_id] = res
+            elif res.has_succeeded():
+                results[room_id] = res.get_result()
+            else:
+                pending.append((room_id, res.observe()))
+
+        if missing:
+            # Put a deferred for each missing entry in the cache, as
+            # `cachedList` does, so that we don't overwrite any invalidations
+            # which happen while we're running the query.
+            deferreds = {}
+            for room_id, last_read_event_id in iteritems(missing):
+                deferreds[room_id] = defer.Deferred()
+                cache.set(
+                    (room_id, user_id, last_read_event_id),
+                    ObservableDeferred(deferreds[room_id], consumeErrors=True),
+                )
+
+            try:
+                counts_by_room = yield self.runInteraction(
+                    "get_unread_event_push_actions_by_rooms",
+                    self._get_unread_counts_by_receipts_txn,
+                    user_id, missing,
+                )
+            except Exception:
+                for room_id, last_read_event_id in iteritems(missing):
+                    cache.invalidate((room_id, user_id, last_read_event_id))
+                for d in itervalues(deferreds):
+                    d.errback()
+                raise
+
+            for room_id, d in iteritems(deferreds):
+                results[room_id] = counts_by_room[room_id]
+                d.callback(counts_by_room[room_id])
+
+        for room_id, d in pending:
+            results[room_id] = yield make_deferred_yieldable(d)
+
+        defer.returnValue(results)
+
+    def _get_unread_counts_by_receipts_txn(self, txn, user_id, receipts_by_room):
+        """Calculate the unread counts for a user in several rooms.
+
+        Args:
+            txn
+            user_id (str)
+            receipts_by_room (dict[str, str]): map from room ID to the event ID
+                of the user's read receipt in that room.
+
+        Returns:
+            dict[str, dict]: map from room ID to a dict with "notify_count" and
+            "highlight_count" keys.
+        """
+        # As in _get_unread_counts_by_pos_txn, we don't need a notif=1 clause
+        # as all rows always have notif=1.
+        sql = (
+            "SELECT e.room_id, e.event_id,"
+            " (SELECT count(*) FROM event_push_actions AS ea"
+            "  WHERE ea.user_id = ? AND ea.room_id = e.room_id"
+            "  AND ea.stream_ordering > e.stream_ordering),"
+            " (SELECT COALESCE(SUM(eps.notif_count), 0) FROM event_push_summary AS eps"
+            "  WHERE eps.user_id = ? AND eps.room_id = e.room_id"
+            "  AND eps.stream_ordering > e.stream_ordering),"
+            " (SELECT count(*) FROM event_push_actions AS ea"
+            "  WHERE ea.user_id = ? AND ea.room_id = e.room_id"
+            "  AND ea.stream_ordering > e.stream_ordering AND ea.highlight = 1)"
+            " FROM events AS e"
+            " WHERE e.event_id IN (%s)"
+        )
+
+        # Rooms whose read receipt points at an event we don't have get zero
+        # counts, as in _get_unread_counts_by_receipt_txn.
+        results = {
+            room_id: {"notify_count": 0, "highlight_count": 0}
+            for room_id in receipts_by_room
+        }
+
+        for batch in batch_iter(iteritems(receipts_by_room), 100):
+            batch = dict(batch)
+            event_ids = list(itervalues(batch))
+            txn.execute(
+                sql % (",".join("?" for _ in event_ids),),
+                [user_id, user_id, user_id] + event_ids,
+            )
+            for room_id, event_id, notify_count, summary_count, highlight_count in txn:
+                if batch.get(room_id) != event_id:
+                    continue
+
+                results[room_id] = {
+                    "notify_count": notify_count + summary_count,
+                    "highlight_count": highlight_count,
+                }
+
+        return results
+
     @defer.inlineCallbacks
     def get_push_action_users_in_range(self, min_stream_ordering, max_stream_ordering):
         def f(txn):
@@ -178,6 +321,28 @@ class EventPushActionsWorkerStore(SQLBaseStore):
         ret = yield self.runInteraction("get_push_action_users_in_range", f)
         defer.returnValue(ret)
 
+    def get_push_action_users_and_rooms_in_range(
+        self, min_stream_ordering, max_stream_ordering
+    ):
+        """Get the users who have push actions in the given range, along with
+        the rooms the push actions are in.
+
+        Args:
+            min_stream_ordering (int): inclusive lower bound
+            max_stream_ordering (int): inclusive upper bound
+
+        Returns:
+            Deferred[list[tuple[str, str]]]: distinct (user_id, room_id) pairs
+        """
+        def f(txn):
+            sql = (
+                "SELECT DISTINCT user_id, room_id FROM event_push_actions WHERE"
+                " stream_ordering >= ? AND stream_ordering <= ?"
+            )
+            txn.execute(sql, (min_stream_ordering, max_stream_ordering))
+            return txn.fetchall()
+        return self.runInteraction("get_push_action_users_and_rooms_in_range", f)
+
     @defer.inlineCallbacks
     def get_unread_push_actions_for_user_in_range_for_http(
         self, user_id, min_stream_ordering, max_stream_ordering, limit=20
@@ -605,10 +770,51 @@ class EventPushActionsStore(EventPushActionsWorkerStore):
         )
 
         self._doing_notif_rotation = False
+
+        # In streaming mode we rotate a small chunk of push actions at a time,
+        # frequently, rather than everything there is to rotate at once.
+        self._streaming_notif_rotation = bool(
+            hs.config.push_notif_rotation_chunk_size
+        )
+        if self._streaming_notif_rotation:
+            self._rotate_count = hs.config.push_notif_rotation_chunk_size
+            rotate_interval_ms = hs.config.push_notif_rotation_interval_ms
+        else:
+            rotate_interval_ms = 30 * 60 * 1000
+
+        # The stream ordering we have rotated up to
+        cur = LoggingTransaction(
+            db_conn.cursor(),
+            name="_get_rotated_stream_ordering",
+            database_engine=self.database_engine,
+            after_callbacks=[],
+            exception_callbacks=[],
+        )
+        self._rotated_stream_ordering = self._simple_select_one_onecol_txn(
+            cur,
+            table="event_push_summary_stream_ordering",
+            keyvalues={},
+            retcol="stream_ordering",
+        )
+        cur.close()
+
+        LaterGauge(
+            "synapse_push_notif_rotation_lag",
+            "The number of stream orderings which are due to be rotated into"
+            " event_push_summary but haven't been",
+            [],
+            self._get_notif_rotation_lag,
+        )
+
         self._rotate_notif_loop = self._clock.looping_call(
-            self._start_rotate_notifs, 30 * 60 * 1000,
+            self._start_rotate_notifs, rotate_interval_ms,
         )
 
+    def _get_notif_rotation_lag(self):
+        if self.stream_ordering_day_ago is None:
+            return 0
+        return max(0, self.stream_ordering_day_ago - self._rotated_stream_ordering)
+
     def _set_push_actions_for_event_and_users_txn(self, txn, events_and_contexts,
                                                   all_events_and_contexts):
         """Handles moving push actions from staging table to main
@@ -806,7 +1012,9 @@ class EventPushActionsStore(EventPushActionsWorkerStore):
                     "_rotate_notifs",
                     self._rotate_notifs_txn
                 )
-                if caught_up:
+                if caught_up or self._streaming_notif_rotation:
+                    # In streaming mode, we wait for the next run to rotate the
+                    # next chunk.
                     break
                 yield self.hs.get_clock().sleep(self._rotate_delay)
         finally:
@@ -911,12 +1119,18 @@ class EventPushActionsStore(EventPushActionsWorkerStore):
         )
 
         logger.info("Rotating notifications, deleted %s push actions", txn.rowcount)
+        rotated_count = txn.rowcount
 
         txn.execute(
             "UPDATE event_push_summary_stream_ordering SET stream_ordering = ?",
             (rotate_to_stream_ordering,)
         )
 
+        txn.call_after(rotated_push_actions_counter.inc, rotated_count)
+        txn.call_after(
+            setattr, self, "_rotated_stream_ordering", rotate_to_stream_ordering,
+        )
+
 
 def _action_has_highlight(actions):
     for action in actions:
@@ -2305,6 +2305,90 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             get_all_updated_current_state_deltas_txn,
         )
 
+    @defer.inlineCallbacks
+    def complete_partial_state_join(self, room_id, event_id, state_ids):
+        """Replaces the partial state that a join event was persisted with by
+        the full state of the room, and adds the state which was missing to the
+        current state of the room.
+
+        Args:
+            room_id (str)
+            event_id (str): the join event which was persisted with partial
+                state.
+            state_ids (dict[(str, str), str]): the full state after the join
+                event. All of the events must already have been persisted.
+
+        Returns:
+            Deferred
+        """
+        state_group = yield self._get_state_group_for_event(event_id)
+        partial_state_ids = yield self.get_state_ids_for_group(state_group)
+
+        delta_ids = {
+            key: state_id for key, state_id in iteritems(state_ids)
+            if key not in partial_state_ids
+        }
+        full_state_ids = dict(partial_state_ids)
+        full_state_ids.update(delta_ids)
+
+        new_state_group = yield self.store_state_group(
+            event_id, room_id,
+            prev_group=state_group,
+            delta_ids=delta_ids,
+            current_state_ids=full_state_ids,
+        )
+
+        def complete_partial_state_join_txn(txn, stream_id):
+            self._simple_update_one_txn(
+                txn,
+                table="event_to_state_groups",
+                keyvalues={"event_id": event_id},
+                updatevalues={"state_group": new_state_group},
+            )
+            self._invalidate_cache_and_stream(
+                txn, self._get_state_group_for_event, (event_id,),
+            )
+
+            # Add the state which was missing to the current state. Anything
+            # which is already in the current state is at least as new as the
+            # state at the join, so is left alone.
+            current_state_keys = set(
+                (row["type"], row["state_key"])
+                for row in self._simple_select_list_txn(
+                    txn,
+                    table="current_state_events",
+                    keyvalues={"room_id": room_id},
+                    retcols=("type", "state_key"),
+                )
+            )
+            to_insert = {
+                key: state_id for key, state_id in iteritems(delta_ids)
+                if key not in current_state_keys
+            }
+            if to_insert:
+                self._update_current_state_txn(
+                    txn, {room_id: ([], to_insert)}, stream_id,
+                )
+
+            self._clear_partial_state_room_txn(txn, room_id)
+
+            # Record when we got the full state, so that clients get sent it.
+            self._simple_upsert_txn(
+                txn,
+                table="partial_state_room_completions",
+                keyvalues={"room_id": room_id},
+                values={"stream_ordering": stream_id},
+            )
+            self._invalidate_cache_and_stream(
+                txn, self.get_partial_state_completion, (room_id,),
+            )
+
+        with self._stream_id_gen.get_next() as stream_id:
+            yield self.runInteraction(
+                "complete_partial_state_join",
+                complete_partial_state_join_txn, stream_id,
+            )
+
 
 AllNewEventsResult = namedtuple("AllNewEventsResult", [
     "new_forward_events", "new_backfill_events",
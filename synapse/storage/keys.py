@@ -188,6 +188,35 @@ class KeyStore(SQLBaseStore):
             desc="store_server_keys_json",
         )
 
+    def get_server_key_valid_until_ts(self, server_name, key_ids):
+        """Get when our copies of the given keys of a server stop being valid.
+        Args:
+            server_name (str): The name of the server.
+            key_ids (iterable[str]): key_ids to look up.
+        Returns:
+            Deferred[dict[str, int]]: map from key_id to the latest
+                ts_valid_until_ms we have for it. Keys we have no JSON for are
+                omitted.
+        """
+        def _get_server_key_valid_until_ts_txn(txn):
+            results = {}
+            for key_id in key_ids:
+                valid_until = self._simple_select_onecol_txn(
+                    txn,
+                    table="server_keys_json",
+                    keyvalues={
+                        "server_name": server_name,
+                        "key_id": key_id,
+                    },
+                    retcol="ts_valid_until_ms",
+                )
+                if valid_until:
+                    results[key_id] = max(valid_until)
+            return results
+        return self.runInteraction(
+            "get_server_key_valid_until_ts", _get_server_key_valid_until_ts_txn,
+        )
+
     def get_server_keys_json(self, server_keys):
         """Retrive the key json for a list of server_keys and key ids.
         If no keys are found for a given server, key_id and source then
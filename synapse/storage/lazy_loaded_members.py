@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from six import iteritems
+
+from synapse.storage._base import SQLBaseStore
+
+
+class LazyLoadedMembersStore(SQLBaseStore):
+    """Persists which membership events have been sent to each device when
+    lazy-loading members, so that this survives restarts and can be shared
+    between synchrotrons.
+
+    This table isn't tied to any stream, so it is safe to write to from
+    workers.
+    """
+
+    def get_lazy_loaded_members(self, user_id, device_id):
+        """Get the members which have been sent to the given device.
+
+        Args:
+            user_id (str)
+            device_id (str)
+
+        Returns:
+            Deferred[dict[str, str]]: map from room ID to the encoded
+            members sent in that room.
+        """
+        def get_lazy_loaded_members_txn(txn):
+            rows = self._simple_select_list_txn(
+                txn,
+                table="lazy_loaded_members",
+                keyvalues={"user_id": user_id, "device_id": device_id},
+                retcols=("room_id", "members"),
+            )
+            return {row["room_id"]: row["members"] for row in rows}
+
+        return self.runInteraction(
+            "get_lazy_loaded_members", get_lazy_loaded_members_txn,
+        )
+
+    def update_lazy_loaded_members(self, user_id, device_id, members_by_room,
+                                   clear=False):
+        """Store the members which have been sent to the given device.
+
+        Args:
+            user_id (str)
+            device_id (str)
+            members_by_room (dict[str, str]): map from room ID to the encoded
+                members sent in that room, for the rooms which have changed.
+                Rooms with no members are removed.
+            clear (bool): whether to first forget everything we have stored
+                for the device, e.g. because it has started a new sync
+                sequence.
+
+        Returns:
+            Deferred
+        """
+        def update_lazy_loaded_members_txn(txn):
+            if clear:
+                self._simple_delete_txn(
+                    txn,
+                    table="lazy_loaded_members",
+                    keyvalues={"user_id": user_id, "device_id": device_id},
+                )
+
+            for room_id, members in iteritems(members_by_room):
+                if not members:
+                    self._simple_delete_txn(
+                        txn,
+                        table="lazy_loaded_members",
+                        keyvalues={
+                            "user_id": user_id,
+                            "device_id": device_id,
+                            "room_id": room_id,
+                        },
+                    )
+                    continue
+
+                self._simple_upsert_txn(
+                    txn,
+                    table="lazy_loaded_members",
+                    keyvalues={
+                        "user_id": user_id,
+                        "device_id": device_id,
+                        "room_id": room_id,
+                    },
+                    values={"members": members},
+                )
+
+        return self.runInteraction(
+            "update_lazy_loaded_members", update_lazy_loaded_members_txn,
+        )
+
+    def delete_lazy_loaded_members_for_device(self, user_id, device_id):
+        """Forget the members sent to a device, e.g. because it was deleted.
+
+        Args:
+            user_id (str)
+            device_id (str)
+
+        Returns:
+            Deferred
+        """
+        return self._simple_delete(
+            table="lazy_loaded_members",
+            keyvalues={"user_id": user_id, "device_id": device_id},
+            desc="delete_lazy_loaded_members_for_device",
+        )
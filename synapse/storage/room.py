@@ -24,7 +24,7 @@ from twisted.internet import defer
 from synapse.api.errors import StoreError
 from synapse.storage._base import SQLBaseStore
 from synapse.storage.search import SearchStore
-from synapse.util.caches.descriptors import cached, cachedInlineCallbacks
+from synapse.util.caches.descriptors import cached, cachedInlineCallbacks, cachedList
 
 logger = logging.getLogger(__name__)
 
@@ -186,6 +186,77 @@ class RoomWorkerStore(SQLBaseStore):
             desc="is_room_blocked",
         )
 
+    @cached(max_entries=10000)
+    def is_partial_state_room(self, room_id):
+        """Checks if we have only persisted part of the state of a room we
+        have joined. See FederationHandler.do_invite_join.
+
+        Args:
+            room_id (str)
+
+        Returns:
+            Deferred[bool]
+        """
+        d = self._simple_select_one_onecol(
+            table="partial_state_rooms",
+            keyvalues={"room_id": room_id},
+            retcol="1",
+            allow_none=True,
+            desc="is_partial_state_room",
+        )
+        return d.addCallback(bool)
+
+    @cached(max_entries=10000)
+    def get_partial_state_completion(self, room_id):
+        # This only exists for the cachedList decorator
+        raise NotImplementedError()
+
+    @cachedList(cached_method_name="get_partial_state_completion",
+                list_name="room_ids", inlineCallbacks=True)
+    def get_partial_state_completions(self, room_ids):
+        """Get the positions in the events stream at which we finished storing
+        the full state of rooms which we joined with partial state.
+
+        Args:
+            room_ids (iterable[str])
+
+        Returns:
+            Deferred[dict[str, int|None]]: map from room_id to stream ordering,
+                or None if we didn't join the room with partial state.
+        """
+        rows = yield self._simple_select_many_batch(
+            table="partial_state_room_completions",
+            column="room_id",
+            iterable=room_ids,
+            retcols=("room_id", "stream_ordering"),
+            desc="get_partial_state_completions",
+        )
+
+        result = {room_id: None for room_id in room_ids}
+        result.update({row["room_id"]: row["stream_ordering"] for row in rows})
+
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def get_partial_state_rooms(self):
+        """Get the rooms which we have only persisted part of the state of.
+
+        Returns:
+            Deferred[dict[str, tuple[str, list[str]]]]: map from room_id to the
+                join event which was persisted with partial state, and the
+                servers we can fetch the full state from.
+        """
+        rows = yield self._simple_select_list(
+            table="partial_state_rooms",
+            keyvalues={},
+            retcols=("room_id", "join_event_id", "servers"),
+            desc="get_partial_state_rooms",
+        )
+        defer.returnValue({
+            row["room_id"]: (row["join_event_id"], json.loads(row["servers"]))
+            for row in rows
+        })
+
     @cachedInlineCallbacks(max_entries=10000)
     def get_ratelimit_for_user(self, user_id):
         """Check if there are any overrides for ratelimiting for the given
@@ -526,6 +597,61 @@ class RoomStore(RoomWorkerStore, SearchStore):
             self.is_room_blocked, (room_id,),
         )
 
+    def store_partial_state_room(self, room_id, join_event_id, servers):
+        """Marks a room as one we have only persisted part of the state of.
+
+        Args:
+            room_id (str)
+            join_event_id (str): the join event which is being persisted with
+                partial state.
+            servers (list[str]): the servers which we can fetch the full
+                state from.
+
+        Returns:
+            Deferred
+        """
+        def store_partial_state_room_txn(txn):
+            self._simple_upsert_txn(
+                txn,
+                table="partial_state_rooms",
+                keyvalues={"room_id": room_id},
+                values={
+                    "join_event_id": join_event_id,
+                    "servers": json.dumps(servers),
+                },
+            )
+            self._invalidate_cache_and_stream(
+                txn, self.is_partial_state_room, (room_id,),
+            )
+
+        return self.runInteraction(
+            "store_partial_state_room", store_partial_state_room_txn,
+        )
+
+    def clear_partial_state_room(self, room_id):
+        """Stops treating a room as one we have only persisted part of the
+        state of.
+
+        Args:
+            room_id (str)
+
+        Returns:
+            Deferred
+        """
+        return self.runInteraction(
+            "clear_partial_state_room", self._clear_partial_state_room_txn, room_id,
+        )
+
+    def _clear_partial_state_room_txn(self, txn, room_id):
+        self._simple_delete_txn(
+            txn,
+            table="partial_state_rooms",
+            keyvalues={"room_id": room_id},
+        )
+        self._invalidate_cache_and_stream(
+            txn, self.is_partial_state_room, (room_id,),
+        )
+
     def get_media_mxcs_in_room(self, room_id):
         """Retrieves all the local and remote media MXC URIs in a given room
 
@@ -0,0 +1,29 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The stream ordering of the latest event in each room which we have tried
+-- to send to each destination, so that we can catch destinations up if they
+-- miss events.
+CREATE TABLE IF NOT EXISTS destination_rooms (
+    destination TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    stream_ordering BIGINT NOT NULL,
+    PRIMARY KEY (destination, room_id)
+);
+
+-- The stream ordering of the latest event which we successfully sent to
+-- each destination. NULL if we haven't sent them anything since this column
+-- was added.
+ALTER TABLE destinations ADD COLUMN last_successful_stream_ordering BIGINT;
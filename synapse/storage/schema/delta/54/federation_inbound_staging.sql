@@ -0,0 +1,35 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- PDUs which we have received over federation and validated, but not yet
+-- processed. Each process which handles /send requests processes the PDUs it
+-- staged, in stream_id order.
+CREATE TABLE IF NOT EXISTS federation_inbound_events_staging (
+    instance_name TEXT NOT NULL,
+    stream_id BIGINT NOT NULL,
+    origin TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    received_ts BIGINT NOT NULL,
+    event_json TEXT NOT NULL,
+    internal_metadata TEXT NOT NULL
+);
+
+CREATE INDEX federation_inbound_events_staging_room ON federation_inbound_events_staging(
+    instance_name, room_id, stream_id
+);
+
+CREATE UNIQUE INDEX federation_inbound_events_staging_origin_event
+    ON federation_inbound_events_staging(origin, event_id);
@@ -0,0 +1,21 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- Each federation sender shard keeps track of its own position in the
+-- streams. The existing positions belong to the first shard.
+ALTER TABLE federation_stream_position ADD COLUMN shard_index INTEGER NOT NULL DEFAULT 0;
+
+CREATE UNIQUE INDEX federation_stream_position_type_shard_index
+    ON federation_stream_position (type, shard_index);
@@ -0,0 +1,30 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- Tracks which membership events have already been sent to each device in
+-- each room when lazy-loading members in /sync, so that they don't have to
+-- be sent again after a restart or when the device's syncs move to another
+-- synchrotron. `members` is a compact encoding of hashes of the members'
+-- user IDs and membership event IDs (see synapse.handlers.sync).
+CREATE TABLE IF NOT EXISTS lazy_loaded_members (
+    user_id TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    members TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX lazy_loaded_members_idx ON lazy_loaded_members(
+    user_id, device_id, room_id
+);
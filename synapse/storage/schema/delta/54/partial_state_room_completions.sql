@@ -0,0 +1,22 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The position in the events stream at which we finished storing the full
+-- state of a room which we joined with partial state. Clients which synced
+-- before then are sent the full state of the room again.
+CREATE TABLE IF NOT EXISTS partial_state_room_completions (
+    room_id TEXT NOT NULL PRIMARY KEY,
+    stream_ordering BIGINT NOT NULL
+);
@@ -0,0 +1,25 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- Rooms which we have joined over federation, but have only persisted part of
+-- the state of. The full state is stored in the background, after which the
+-- row is removed.
+CREATE TABLE IF NOT EXISTS partial_state_rooms (
+    room_id TEXT NOT NULL PRIMARY KEY,
+    -- the join event which was persisted with partial state
+    join_event_id TEXT NOT NULL,
+    -- JSON list of the servers which we can fetch the full state from
+    servers TEXT NOT NULL
+);
@@ -0,0 +1,27 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The results of looking up how to reach remote servers, so that they can be
+-- used straight away after a restart. lookup_type is 'srv' (where name is the
+-- SRV record) or 'well_known' (where name is the server name), and
+-- resolution is the JSON-encoded result. expires_ts is when the result should
+-- be refreshed.
+CREATE TABLE IF NOT EXISTS server_resolutions (
+    lookup_type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    expires_ts BIGINT NOT NULL,
+    PRIMARY KEY (lookup_type, name)
+);
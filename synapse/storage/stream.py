@@ -37,6 +37,7 @@ import abc
 import logging
 from collections import namedtuple
 
+from six import iteritems, itervalues
 from six.moves import range
 
 from twisted.internet import defer
@@ -45,6 +46,7 @@ from synapse.storage._base import SQLBaseStore
 from synapse.storage.engines import PostgresEngine
 from synapse.storage.events_worker import EventsWorkerStore
 from synapse.types import RoomStreamToken
+from synapse.util import batch_iter
 from synapse.util.caches.stream_change_cache import StreamChangeCache
 from synapse.util.logcontext import make_deferred_yieldable, run_in_background
 
@@ -53,6 +55,10 @@ logger = logging.getLogger(__name__)
 
 MAX_STREAM_SIZE = 1000
 
+# The maximum number of arguments to bind to a single query, which is the
+# default limit in SQLite.
+MAX_QUERY_ARGS = 999
+
 
 _STREAM_TOKEN = "stream"
 _TOPOLOGICAL_TOKEN = "topological"
@@ -105,6 +111,15 @@ def upper_bound(token, engine, inclusive=True):
 
 
 def filter_to_clause(event_filter):
+    """Translates a Filter into an SQL clause against the events table, such
+    that only events which match the filter are returned.
+
+    Args:
+        event_filter (Filter|None)
+
+    Returns:
+        tuple[str, list]: the clause (which may be empty) and its arguments.
+    """
     # NB: This may create SQL clauses that don't optimise well (and we don't
     # have indices on all possible clauses). E.g. it may create
     # "room_id == X AND room_id != X", which postgres doesn't optimise.
@@ -115,41 +130,83 @@ def filter_to_clause(event_filter):
     clauses = []
     args = []
 
-    if event_filter.types:
-        clauses.append(
-            "(%s)" % " OR ".join("type = ?" for _ in event_filter.types)
-        )
-        args.extend(event_filter.types)
+    _add_filter_clauses(
+        clauses, args, "type", event_filter.types, event_filter.not_types,
+        allow_wildcards=True,
+    )
+    _add_filter_clauses(
+        clauses, args, "sender", event_filter.senders, event_filter.not_senders,
+    )
+    _add_filter_clauses(
+        clauses, args, "room_id", event_filter.rooms, event_filter.not_rooms,
+    )
 
-    for typ in event_filter.not_types:
-        clauses.append("type != ?")
-        args.append(typ)
+    if event_filter.contains_url:
+        clauses.append("contains_url = ?")
+        args.append(True)
+    elif event_filter.contains_url is not None:
+        # contains_url may be null for events persisted before we started
+        # populating it.
+        clauses.append("(contains_url = ? OR contains_url IS NULL)")
+        args.append(False)
 
-    if event_filter.senders:
-        clauses.append(
-            "(%s)" % " OR ".join("sender = ?" for _ in event_filter.senders)
-        )
-        args.extend(event_filter.senders)
+    return " AND ".join(clauses), args
 
-    for sender in event_filter.not_senders:
-        clauses.append("sender != ?")
-        args.append(sender)
 
-    if event_filter.rooms:
-        clauses.append(
-            "(%s)" % " OR ".join("room_id = ?" for _ in event_filter.rooms)
-        )
-        args.extend(event_filter.rooms)
+def _add_filter_clauses(clauses, args, column, allowed, disallowed,
+                        allow_wildcards=False):
+    """Adds the SQL clauses for a pair of allowed/disallowed value lists from
+    a Filter (e.g. "types" and "not_types").
 
-    for room_id in event_filter.not_rooms:
-        clauses.append("room_id != ?")
-        args.append(room_id)
+    Args:
+        clauses (list[str]): list to append the clauses to
+        args (list): list to append the arguments to
+        column (str): the column the values apply to
+        allowed (list[str]|None): values to allow, or None to allow all
+        disallowed (list[str]): values to exclude
+        allow_wildcards (bool): whether values ending in "*" match any value
+            with that prefix, rather than literally.
+    """
+    def split(values):
+        literals = []
+        prefixes = []
+        for value in values:
+            if allow_wildcards and value.endswith("*"):
+                prefixes.append(value[:-1])
+            else:
+                literals.append(value)
+        return literals, prefixes
+
+    # We match wildcards with SUBSTR rather than LIKE, as LIKE is case
+    # insensitive on SQLite.
+    if allowed is not None:
+        literals, prefixes = split(allowed)
+
+        alternatives = []
+        if literals:
+            alternatives.append(
+                "%s IN (%s)" % (column, ",".join("?" for _ in literals)),
+            )
+            args.extend(literals)
+        for prefix in prefixes:
+            alternatives.append("SUBSTR(%s, 1, %d) = ?" % (column, len(prefix)))
+            args.append(prefix)
 
-    if event_filter.contains_url:
-        clauses.append("contains_url = ?")
-        args.append(event_filter.contains_url)
+        if alternatives:
+            clauses.append("(%s)" % " OR ".join(alternatives))
+        else:
+            # An empty list of allowed values matches nothing.
+            clauses.append("1 = 0")
 
-    return " AND ".join(clauses), args
+    literals, prefixes = split(disallowed)
+    if literals:
+        clauses.append(
+            "%s NOT IN (%s)" % (column, ",".join("?" for _ in literals)),
+        )
+        args.extend(literals)
+    for prefix in prefixes:
+        clauses.append("SUBSTR(%s, 1, %d) != ?" % (column, len(prefix)))
+        args.append(prefix)
 
 
 class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
@@ -419,6 +476,150 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         defer.returnValue((rows, token))
 
+    @defer.inlineCallbacks
+    def get_recent_events_for_rooms(self, room_ids, limit, end_token,
+                                    event_filter=None):
+        """Get the most recent events in each of the given rooms in topological
+        ordering.
+
+        This is the batched equivalent of `get_recent_events_for_room`, which
+        fetches the events for many rooms at once rather than issuing a query
+        per room.
+
+        Args:
+            room_ids (iterable[str])
+            limit (int): The maximum number of events to return per room.
+            end_token (str): The stream token representing now.
+            event_filter (Filter|None): If provided filters the events to
+                those that match the filter.
+
+        Returns:
+            Deferred[dict[str, tuple[list[FrozenEvent], str]]]: A map from room
+            id to a list of events (in ascending order) and a token pointing to
+            the start of the returned events.
+        """
+        room_ids = list(room_ids)
+        if not room_ids:
+            defer.returnValue({})
+
+        # Allow a zero limit here, and no-op.
+        if limit == 0:
+            defer.returnValue({room_id: ([], end_token) for room_id in room_ids})
+
+        from_token = RoomStreamToken.parse(end_token)
+
+        rows_by_room = yield self.runInteraction(
+            "get_recent_event_ids_for_rooms",
+            self._get_recent_event_ids_for_rooms_txn,
+            room_ids, from_token, limit, event_filter,
+        )
+
+        events = yield self._get_events(
+            [
+                r.event_id
+                for rows, _ in itervalues(rows_by_room)
+                for r in rows
+            ],
+            get_prev_content=True,
+        )
+        event_map = {e.event_id: e for e in events}
+
+        results = {}
+        for room_id, (rows, token) in iteritems(rows_by_room):
+            # _get_events drops events it couldn't find (e.g. because they
+            # have been rejected), so we need to make sure the rows still line
+            # up with the events.
+            rows = [r for r in rows if r.event_id in event_map]
+            room_events = [event_map[r.event_id] for r in rows]
+            self._set_before_and_after(room_events, rows)
+            results[room_id] = (room_events, token)
+
+        defer.returnValue(results)
+
+    def _get_recent_event_ids_for_rooms_txn(self, txn, room_ids, from_token,
+                                            limit, event_filter=None):
+        """Fetches the most recent `limit` events for each of the given rooms.
+
+        The timelines for a batch of rooms are fetched with a single query,
+        made up of a `LIMIT`ed subquery per room, so that each room only
+        reads its most recent events from the index.
+
+        Args:
+            txn
+            room_ids (list[str])
+            from_token (RoomStreamToken): The token to paginate back from.
+            limit (int): The maximum number of events to return per room.
+            event_filter (Filter|None): If provided filters the events to
+                those that match the filter.
+
+        Returns:
+            dict[str, tuple[list[_EventDictReturn], str]]: A map from room id
+            to the rows, in ascending order, and a token pointing to the start
+            of the returned rows.
+        """
+        bounds = upper_bound(from_token, self.database_engine)
+        filter_clause, filter_args = filter_to_clause(event_filter)
+        if filter_clause:
+            bounds += " AND " + filter_clause
+
+        # We wrap each subquery in a SELECT so that it may have its own ORDER
+        # BY and LIMIT, which SQLite doesn't allow directly within a UNION.
+        room_sql = (
+            "SELECT * FROM ("
+            " SELECT room_id, event_id, topological_ordering, stream_ordering"
+            " FROM events"
+            " WHERE outlier = ? AND room_id = ? AND %(bounds)s"
+            " ORDER BY topological_ordering DESC, stream_ordering DESC"
+            " LIMIT ?"
+            ") AS recent_%(idx)d"
+        )
+
+        # Each subquery binds the filter's arguments as well as its own three,
+        # so fewer rooms fit in a query when the filter is large.
+        batch_size = max(1, min(100, MAX_QUERY_ARGS // (len(filter_args) + 3)))
+
+        rows_by_room = {room_id: [] for room_id in room_ids}
+        for batch in batch_iter(room_ids, batch_size):
+            sql = " UNION ALL ".join(
+                room_sql % {"bounds": bounds, "idx": idx}
+                for idx in range(len(batch))
+            )
+
+            args = []
+            for room_id in batch:
+                args.append(False)
+                args.append(room_id)
+                args.extend(filter_args)
+                args.append(int(limit))
+
+            txn.execute(sql, args)
+
+            for row in txn:
+                rows_by_room[row[0]].append(
+                    _EventDictReturn(row[1], row[2], row[3]),
+                )
+
+        results = {}
+        for room_id, rows in iteritems(rows_by_room):
+            # UNION ALL doesn't preserve the order of the subqueries, and we
+            # want to return the results in ascending order.
+            rows.sort(key=lambda r: (r.topological_ordering, r.stream_ordering))
+
+            if rows:
+                # Tokens are positions between events, so (as with
+                # `_paginate_room_events_txn`) we point to just before the
+                # earliest event in the chunk.
+                token = str(RoomStreamToken(
+                    rows[0].topological_ordering,
+                    rows[0].stream_ordering - 1,
+                ))
+            else:
+                token = str(from_token)
+
+            results[room_id] = (rows, token)
+
+        return results
+
     def get_room_event_after_stream_ordering(self, room_id, stream_ordering):
         """Gets details of the first event in a room at or after a stream ordering
 
@@ -692,20 +893,55 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         defer.returnValue((upper_bound, events))
 
-    def get_federation_out_pos(self, typ):
-        return self._simple_select_one_onecol(
-            table="federation_stream_position",
-            retcol="stream_id",
-            keyvalues={"type": typ},
-            desc="get_federation_out_pos"
+    def get_federation_out_pos(self, typ, shard_index=0):
+        """Get how far a federation sender shard has got through a stream.
+
+        Args:
+            typ (str): the stream, "events" or "federation"
+            shard_index (int): the federation sender shard
+
+        Returns:
+            Deferred[int]
+        """
+        def get_federation_out_pos_txn(txn):
+            stream_id = self._simple_select_one_onecol_txn(
+                txn,
+                table="federation_stream_position",
+                retcol="stream_id",
+                keyvalues={"type": typ, "shard_index": shard_index},
+                allow_none=True,
+            )
+            if stream_id is None:
+                # This is a new shard, so start it off from where the first
+                # shard has got to.
+                stream_id = self._simple_select_one_onecol_txn(
+                    txn,
+                    table="federation_stream_position",
+                    retcol="stream_id",
+                    keyvalues={"type": typ, "shard_index": 0},
+                )
+                self._simple_insert_txn(
+                    txn,
+                    table="federation_stream_position",
+                    values={
+                        "type": typ,
+                        "shard_index": shard_index,
+                        "stream_id": stream_id,
+                    },
+                )
+            return stream_id
+
+        return self.runInteraction(
+            "get_federation_out_pos", get_federation_out_pos_txn,
         )
 
-    def update_federation_out_pos(self, typ, stream_id):
-        return self._simple_update_one(
+    def update_federation_out_pos(self, typ, stream_id, shard_index=0):
+        return self._simple_upsert(
             table="federation_stream_position",
-            keyvalues={"type": typ},
-            updatevalues={"stream_id": stream_id},
+            keyvalues={"type": typ, "shard_index": shard_index},
+            values={"stream_id": stream_id},
             desc="update_federation_out_pos",
+            lock=False,
         )
 
     def has_room_changed_since(self, room_id, stream_id):
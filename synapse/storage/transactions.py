@@ -18,12 +18,13 @@ from collections import namedtuple
 
 import six
 
-from canonicaljson import encode_canonical_json
+from canonicaljson import encode_canonical_json, json
 
 from twisted.internet import defer
 
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.frozenutils import frozendict_json_encoder
 
 from ._base import SQLBaseStore, db_to_json
 
@@ -36,6 +37,11 @@ else:
 
 logger = logging.getLogger(__name__)
 
+# How long after they expire to keep the results of looking up how to reach
+# remote servers. This matches the longest time that the SRV resolver and
+# .well-known lookups keep using a stale result for.
+SERVER_RESOLUTION_MAX_STALE_MS = 24 * 60 * 60 * 1000
+
 
 _TransactionRow = namedtuple(
     "_TransactionRow", (
@@ -265,6 +271,287 @@ class TransactionStore(SQLBaseStore):
                 },
             )
 
+    def store_destination_rooms_entries(self, destinations, room_id, stream_ordering):
+        """Record that we are about to send an event to some destinations, so
+        that they can be caught up on it if it doesn't reach them.
+
+        Args:
+            destinations (iterable[str])
+            room_id (str)
+            stream_ordering (int): the stream ordering of the event
+        """
+        rows = [(destination, room_id) for destination in destinations]
+        if not rows:
+            return defer.succeed(None)
+
+        return self.runInteraction(
+            "store_destination_rooms_entries",
+            self._simple_upsert_many_txn,
+            table="destination_rooms",
+            key_names=("destination", "room_id"),
+            key_values=rows,
+            value_names=("stream_ordering",),
+            value_values=[(stream_ordering,)] * len(rows),
+        )
+
+    def get_destination_last_successful_stream_ordering(self, destination):
+        """Gets the stream ordering of the latest event we successfully sent
+        to the destination.
+
+        Args:
+            destination (str)
+
+        Returns:
+            Deferred[int|None]: None if we haven't successfully sent it an event
+        """
+        return self._simple_select_one_onecol(
+            table="destinations",
+            keyvalues={"destination": destination},
+            retcol="last_successful_stream_ordering",
+            allow_none=True,
+            desc="get_destination_last_successful_stream_ordering",
+        )
+
+    def set_destination_last_successful_stream_ordering(
+        self, destination, stream_ordering,
+    ):
+        """Sets the stream ordering of the latest event we successfully sent
+        to the destination.
+
+        Args:
+            destination (str)
+            stream_ordering (int)
+        """
+        return self._simple_upsert(
+            table="destinations",
+            keyvalues={"destination": destination},
+            values={"last_successful_stream_ordering": stream_ordering},
+            insertion_values={"retry_last_ts": 0, "retry_interval": 0},
+            desc="set_destination_last_successful_stream_ordering",
+        )
+
+    def get_catch_up_room_events(
+        self, destination, last_successful_stream_ordering, limit=50,
+    ):
+        """Gets the latest event we tried to send to the destination in each
+        room, for the rooms where that event hasn't been successfully sent.
+
+        Args:
+            destination (str)
+            last_successful_stream_ordering (int): the stream ordering of the
+                latest event successfully sent to the destination.
+            limit (int): the maximum number of events to return.
+
+        Returns:
+            Deferred[list[tuple[str, int]]]: the event ids and stream orderings
+            of the events, in stream ordering.
+        """
+        def get_catch_up_room_events_txn(txn):
+            sql = """
+                SELECT event_id, stream_ordering FROM destination_rooms
+                INNER JOIN events USING (stream_ordering)
+                WHERE destination = ? AND stream_ordering > ?
+                ORDER BY stream_ordering
+                LIMIT ?
+            """
+            txn.execute(sql, (destination, last_successful_stream_ordering, limit))
+            return txn.fetchall()
+
+        return self.runInteraction(
+            "get_catch_up_room_events", get_catch_up_room_events_txn,
+        )
+
+    def get_catch_up_outstanding_destinations(self, after_destination, limit=25):
+        """Gets destinations which have events to catch up on, and which we
+        aren't backing off from.
+
+        Args:
+            after_destination (str|None): only return destinations after this
+                one, for paginating through them.
+            limit (int)
+
+        Returns:
+            Deferred[list[str]]: the destinations, in order.
+        """
+        def get_catch_up_outstanding_destinations_txn(txn):
+            sql = """
+                SELECT DISTINCT destination FROM destinations
+                INNER JOIN destination_rooms USING (destination)
+                WHERE
+                    stream_ordering > last_successful_stream_ordering
+                    AND destination > ?
+                    AND COALESCE(retry_last_ts, 0) + COALESCE(retry_interval, 0) < ?
+                ORDER BY destination
+                LIMIT ?
+            """
+            txn.execute(sql, (
+                after_destination or "", self._clock.time_msec(), limit,
+            ))
+            return [destination for destination, in txn]
+
+        return self.runInteraction(
+            "get_catch_up_outstanding_destinations",
+            get_catch_up_outstanding_destinations_txn,
+        )
+
+    def stage_received_events(self, instance_name, origin, events, received_ts):
+        """Persist PDUs received over federation until they are processed.
+
+        PDUs which have already been staged are ignored.
+
+        Args:
+            instance_name (str): the process which will process the PDUs. Each
+                process which stages PDUs must have a different name.
+            origin (str): the server which sent the PDUs
+            events (list[FrozenEvent]): the PDUs, in the order to process them
+            received_ts (int): when we received the PDUs
+
+        Returns:
+            Deferred[list[FrozenEvent]]: the PDUs which were newly staged
+        """
+        def stage_received_events_txn(txn):
+            already_staged = set(
+                row["event_id"] for row in self._simple_select_many_txn(
+                    txn,
+                    table="federation_inbound_events_staging",
+                    column="event_id",
+                    iterable=[event.event_id for event in events],
+                    keyvalues={"origin": origin},
+                    retcols=("event_id",),
+                )
+            )
+
+            to_stage = [e for e in events if e.event_id not in already_staged]
+            self._simple_insert_many_txn(
+                txn,
+                table="federation_inbound_events_staging",
+                values=[
+                    {
+                        "instance_name": instance_name,
+                        "stream_id": (
+                            self.database_engine.get_next_inbound_staging_stream_id(
+                                txn,
+                            )
+                        ),
+                        "origin": origin,
+                        "room_id": event.room_id,
+                        "event_id": event.event_id,
+                        "received_ts": received_ts,
+                        "event_json": frozendict_json_encoder.encode(
+                            event.get_pdu_json(),
+                        ),
+                        "internal_metadata": frozendict_json_encoder.encode(
+                            event.internal_metadata.get_dict(),
+                        ),
+                    }
+                    for event in to_stage
+                ],
+            )
+            return to_stage
+
+        return self.runInteraction(
+            "stage_received_events", stage_received_events_txn,
+        )
+
+    def get_next_staged_event_for_room(self, instance_name, room_id):
+        """Get the earliest staged PDU for a room.
+
+        Args:
+            instance_name (str)
+            room_id (str)
+
+        Returns:
+            Deferred[tuple[int, str, dict, dict]|None]: the stream ID of the
+            staged PDU, the origin, the PDU json and its internal metadata, or
+            None if there are no PDUs staged for the room.
+        """
+        def get_next_staged_event_for_room_txn(txn):
+            sql = """
+                SELECT stream_id, origin, event_json, internal_metadata
+                FROM federation_inbound_events_staging
+                WHERE instance_name = ? AND room_id = ?
+                ORDER BY stream_id ASC
+                LIMIT 1
+            """
+            txn.execute(sql, (instance_name, room_id))
+            row = txn.fetchone()
+            if not row:
+                return None
+
+            stream_id, origin, event_json, internal_metadata = row
+            return (
+                stream_id, origin, db_to_json(event_json),
+                db_to_json(internal_metadata),
+            )
+
+        return self.runInteraction(
+            "get_next_staged_event_for_room", get_next_staged_event_for_room_txn,
+        )
+
+    def remove_received_event_from_staging(self, instance_name, room_id, stream_id):
+        """Remove a PDU from the staging area once it has been processed.
+
+        Args:
+            instance_name (str)
+            room_id (str)
+            stream_id (int): the stream ID of the staged PDU, as returned by
+                `get_next_staged_event_for_room`.
+        """
+        return self._simple_delete(
+            table="federation_inbound_events_staging",
+            keyvalues={
+                "instance_name": instance_name,
+                "room_id": room_id,
+                "stream_id": stream_id,
+            },
+            desc="remove_received_event_from_staging",
+        )
+
+    def get_staged_events_received_ts(self, instance_name):
+        """Get when each of the PDUs staged for a process were received.
+
+        Args:
+            instance_name (str)
+
+        Returns:
+            Deferred[list[tuple[str, int]]]: room ID and received timestamp of
+            each staged PDU, in the order they are to be processed.
+        """
+        def get_staged_events_received_ts_txn(txn):
+            sql = """
+                SELECT room_id, received_ts FROM federation_inbound_events_staging
+                WHERE instance_name = ?
+                ORDER BY stream_id ASC
+            """
+            txn.execute(sql, (instance_name,))
+            return txn.fetchall()
+
+        return self.runInteraction(
+            "get_staged_events_received_ts", get_staged_events_received_ts_txn,
+        )
+
+    def get_staged_event_counts_by_instance(self):
+        """Get how many PDUs are staged for each process.
+
+        Returns:
+            Deferred[list[tuple[str, int, int]]]: the instance name, number of
+            staged PDUs and the received timestamp of the oldest of them, for
+            each process with staged PDUs.
+        """
+        def get_staged_event_counts_by_instance_txn(txn):
+            sql = """
+                SELECT instance_name, COUNT(*), MIN(received_ts)
+                FROM federation_inbound_events_staging
+                GROUP BY instance_name
+            """
+            txn.execute(sql)
+            return txn.fetchall()
+
+        return self.runInteraction(
+            "get_staged_event_counts_by_instance",
+            get_staged_event_counts_by_instance_txn,
+        )
+
     def get_destinations_needing_retry(self):
         """Get all destinations which are due a retry for sending a transaction.
 
@@ -286,6 +573,55 @@ class TransactionStore(SQLBaseStore):
         txn.execute(query, (self._clock.time_msec(),))
         return self.cursor_to_dict(txn)
 
+    def get_server_resolutions(self, lookup_type, min_expires_ts):
+        """Get the stored results of looking up how to reach remote servers.
+
+        Args:
+            lookup_type (str): "srv" or "well_known"
+            min_expires_ts (int): results which expired before this time are
+                ignored.
+
+        Returns:
+            Deferred[list[tuple[str, object, int]]]: the name, decoded
+            resolution and expiry time of each result.
+        """
+        def get_server_resolutions_txn(txn):
+            txn.execute(
+                "SELECT name, resolution, expires_ts FROM server_resolutions"
+                " WHERE lookup_type = ? AND expires_ts >= ?",
+                (lookup_type, min_expires_ts),
+            )
+            return [
+                (name, json.loads(resolution), expires_ts)
+                for name, resolution, expires_ts in txn
+            ]
+
+        return self.runInteraction(
+            "get_server_resolutions", get_server_resolutions_txn,
+        )
+
+    def store_server_resolution(self, lookup_type, name, resolution, expires_ts):
+        """Store the result of looking up how to reach a remote server.
+
+        Args:
+            lookup_type (str): "srv" or "well_known"
+            name (str): the name which was looked up
+            resolution (object): the result, which must be JSON-serialisable
+            expires_ts (int): when the result should be refreshed
+        """
+        return self._simple_upsert(
+            table="server_resolutions",
+            keyvalues={
+                "lookup_type": lookup_type,
+                "name": name,
+            },
+            values={
+                "resolution": json.dumps(resolution),
+                "expires_ts": expires_ts,
+            },
+            desc="store_server_resolution",
+        )
+
     def _start_cleanup_transactions(self):
         return run_as_background_process(
             "cleanup_transactions", self._cleanup_transactions,
@@ -298,4 +634,10 @@ class TransactionStore(SQLBaseStore):
         def _cleanup_transactions_txn(txn):
             txn.execute("DELETE FROM received_transactions WHERE ts < ?", (month_ago,))
 
+            # results which are too old to be used, even while refreshing them
+            txn.execute(
+                "DELETE FROM server_resolutions WHERE expires_ts < ?",
+                (now - SERVER_RESOLUTION_MAX_STALE_MS,),
+            )
+
         return self.runInteraction("_cleanup_transactions", _cleanup_transactions_txn)
@@ -13,8 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
 import re
+import struct
 from itertools import islice
 
 import attr
@@ -115,6 +117,26 @@ def batch_iter(iterable, size):
     return iter(lambda: tuple(islice(sourceiter, size)), ())
 
 
+def get_shard_for_key(key, shard_count):
+    """Get the index of the shard responsible for the given key, when work is
+    split between several processes.
+
+    This needs to be stable across processes and restarts, so we can't use
+    `hash`.
+
+    Args:
+        key (str)
+        shard_count (int): the number of shards
+
+    Returns:
+        int
+    """
+    if shard_count == 1:
+        return 0
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return struct.unpack(">I", digest[:4])[0] % shard_count
+
+
 def log_failure(failure, msg, consumeErrors=True):
     """Creates a function suitable for passing to `Deferred.addErrback` that
     logs any failures that occur.
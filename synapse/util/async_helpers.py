@@ -27,6 +27,7 @@ from synapse.util import Clock, logcontext, unwrapFirstError
 
 from .logcontext import (
     PreserveLoggingContext,
+    defer_to_thread,
     make_deferred_yieldable,
     run_in_background,
 )
@@ -454,3 +455,68 @@ def timeout_deferred(deferred, timeout, reactor, on_timeout_cancel=None):
     deferred.addCallbacks(success_cb, failure_cb)
 
     return new_d
+
+
+class ThreadedBatcher(object):
+    """Calls a function in the reactor's thread pool, in batches.
+
+    Calls which are submitted in the same reactor tick are made by a single
+    job in the thread pool. This keeps the overhead of handing over to a
+    thread down when lots of calls are made at once (for instance to check
+    each of the events in a large /state response), while freeing up the
+    reactor thread to do other things.
+
+    Args:
+        reactor (twisted.internet.base.ReactorBase)
+        func (callable): the function to call. It is called in a thread, so
+            must be thread safe, and must not touch any logcontexts.
+    """
+
+    def __init__(self, reactor, func):
+        self._reactor = reactor
+        self._func = func
+
+        # list of (args, Deferred) for the calls waiting to be made
+        self._pending = []
+
+    def submit(self, *args):
+        """Queue up a call to the function.
+
+        Returns:
+            Deferred: resolves with the result of the call, or fails with its
+            exception.
+        """
+        d = defer.Deferred()
+        if not self._pending:
+            self._reactor.callLater(0, self._run_pending)
+        self._pending.append((args, d))
+        return make_deferred_yieldable(d)
+
+    def _run_pending(self):
+        batch, self._pending = self._pending, []
+
+        def done(results):
+            with PreserveLoggingContext():
+                for (_, d), (success, result) in zip(batch, results):
+                    if success:
+                        d.callback(result)
+                    else:
+                        d.errback(result)
+
+        def failed(f):
+            with PreserveLoggingContext():
+                for _, d in batch:
+                    d.errback(f)
+
+        defer_to_thread(
+            self._reactor, self._call_batch, [args for args, _ in batch],
+        ).addCallbacks(done, failed)
+
+    def _call_batch(self, batch):
+        results = []
+        for args in batch:
+            try:
+                results.append((True, self._func(*args)))
+            except Exception:
+                results.append((False, failure.Failure()))
+        return results
@@ -144,6 +144,42 @@ class ContextResourceUsage(object):
         return res
 
 
+class ContextPhaseUsage(object):
+    """Object for tracking the resources used by a named phase (e.g. a block
+    wrapped in `synapse.util.metrics.Measure`) within a log context
+
+    Attributes:
+        count (int): number of times the phase was entered
+        real_time_sec (float): wallclock time spent in the phase (in seconds)
+        resource_usage (ContextResourceUsage): resources used by the log
+            context while in the phase
+    """
+
+    __slots__ = ["count", "real_time_sec", "resource_usage"]
+
+    def __init__(self):
+        self.count = 0
+        self.real_time_sec = 0.
+        self.resource_usage = ContextResourceUsage()
+
+    def __repr__(self):
+        return (
+            "<ContextPhaseUsage count='%r', real_time_sec='%r', "
+            "resource_usage=%r>"
+        ) % (self.count, self.real_time_sec, self.resource_usage)
+
+    def __iadd__(self, other):
+        """Add another ContextPhaseUsage's stats to this one's.
+
+        Args:
+            other (ContextPhaseUsage): the other phase usage object
+        """
+        self.count += other.count
+        self.real_time_sec += other.real_time_sec
+        self.resource_usage += other.resource_usage
+        return self
+
+
 class LoggingContext(object):
     """Additional context for log formatting. Contexts are scoped within a
     "with" block.
@@ -161,6 +197,7 @@ class LoggingContext(object):
     __slots__ = [
         "previous_context", "name", "parent_context",
         "_resource_usage",
+        "_phase_usage",
         "usage_start",
         "main_thread", "alive",
         "request", "tag",
@@ -194,6 +231,9 @@ class LoggingContext(object):
         def record_event_fetch(self, event_count):
             pass
 
+        def record_phase(self, name, real_time_sec, usage):
+            pass
+
         def __nonzero__(self):
             return False
         __bool__ = __nonzero__  # python3
@@ -207,6 +247,10 @@ class LoggingContext(object):
         # track the resources used by this context so far
         self._resource_usage = ContextResourceUsage()
 
+        # track the resources used by named phases within this context:
+        # dict[str, ContextPhaseUsage]
+        self._phase_usage = {}
+
         # If alive has the thread resource usage when the logcontext last
         # became active.
         self.usage_start = None
@@ -291,8 +335,16 @@ class LoggingContext(object):
         ):
             self.parent_context._resource_usage += self._resource_usage
 
+            for name, phase_usage in self._phase_usage.items():
+                parent_usage = self.parent_context._phase_usage.get(name)
+                if parent_usage is None:
+                    parent_usage = ContextPhaseUsage()
+                    self.parent_context._phase_usage[name] = parent_usage
+                parent_usage += phase_usage
+
             # reset them in case we get entered again
             self._resource_usage.reset()
+            self._phase_usage = {}
 
     def copy_to(self, record):
         """Copy logging fields from this context to a log record or
@@ -373,6 +425,34 @@ class LoggingContext(object):
         """
         self._resource_usage.evt_db_fetch_count += event_count
 
+    def record_phase(self, name, real_time_sec, usage):
+        """Record the resources used by a named phase of processing within this
+        context.
+
+        Args:
+            name (str): name of the phase
+            real_time_sec (float): wallclock time spent in the phase
+            usage (ContextResourceUsage): resources used during the phase
+        """
+        phase_usage = self._phase_usage.get(name)
+        if phase_usage is None:
+            phase_usage = ContextPhaseUsage()
+            self._phase_usage[name] = phase_usage
+
+        phase_usage.count += 1
+        phase_usage.real_time_sec += real_time_sec
+        phase_usage.resource_usage += usage
+
+    def get_phase_usage(self):
+        """Get the resources used by each named phase within this logcontext
+        so far.
+
+        Returns:
+            dict[str, ContextPhaseUsage]: a map from phase name to the
+                resources used by that phase. Callers must not modify it.
+        """
+        return self._phase_usage
+
 
 class LoggingContextFilter(logging.Filter):
     """Logging filter that adds values from the current logging context to each
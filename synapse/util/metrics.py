@@ -118,6 +118,9 @@ class Measure(object):
 
         current = context.get_resource_usage()
         usage = current - self.start_usage
+
+        context.record_phase(self.name, duration, usage)
+
         try:
             block_ru_utime.labels(self.name).inc(usage.ru_utime)
             block_ru_stime.labels(self.name).inc(usage.ru_stime)
@@ -20,7 +20,7 @@ import jsonschema
 from twisted.internet import defer
 
 from synapse.api.errors import SynapseError
-from synapse.api.filtering import Filter
+from synapse.api.filtering import Filter, FilterCollection
 from synapse.events import FrozenEvent
 
 from tests import unittest
@@ -408,6 +408,51 @@ class FilteringTestCase(unittest.TestCase):
 
         self.assertEquals(filtered_room_ids, ["!allowed:example.com"])
 
+    def test_filter_room_timeline_applies_room_filter(self):
+        user_filter_json = {
+            "room": {
+                "rooms": ["!foo:bar", "!bar:bar"],
+                "not_rooms": ["!bar:bar"],
+                "timeline": {
+                    "rooms": ["!foo:bar", "!bar:bar", "!baz:bar"],
+                    "types": ["m.room.*"],
+                },
+            }
+        }
+        filter_collection = FilterCollection(user_filter_json)
+
+        events = [
+            MockEvent(sender="@foo:bar", type="m.room.message", room_id=room_id)
+            for room_id in ("!foo:bar", "!bar:bar", "!baz:bar", "!qux:bar")
+        ]
+        events.append(
+            MockEvent(sender="@foo:bar", type="org.example", room_id="!foo:bar")
+        )
+
+        filtered = filter_collection.filter_room_timeline(events)
+        self.assertEquals(filtered, events[:1])
+
+        # The original filter definitions should not have been modified.
+        self.assertEquals(
+            user_filter_json["room"]["timeline"]["rooms"],
+            ["!foo:bar", "!bar:bar", "!baz:bar"],
+        )
+        self.assertNotIn("not_rooms", user_filter_json["room"]["timeline"])
+
+    def test_with_room_ids(self):
+        definition = {"rooms": ["!foo:bar"]}
+        event_filter = Filter(definition)
+
+        new_filter = event_filter.with_room_ids(["!bar:bar"])
+
+        self.assertTrue(
+            new_filter.check(MockEvent(sender="@foo:bar", room_id="!bar:bar"))
+        )
+        self.assertFalse(
+            event_filter.check(MockEvent(sender="@foo:bar", room_id="!bar:bar"))
+        )
+        self.assertEquals(definition, {"rooms": ["!foo:bar"]})
+
     @defer.inlineCallbacks
     def test_add_filter(self):
         user_filter_json = {"room": {"state": {"types": ["m.*"]}}}
@@ -441,3 +486,20 @@ class FilteringTestCase(unittest.TestCase):
         self.assertEquals(filter.get_filter_json(), user_filter_json)
 
         self.assertRegexpMatches(repr(filter), r"<FilterCollection \{.*\}>")
+
+    @defer.inlineCallbacks
+    def test_get_filter_is_cached(self):
+        user_filter_json = {"room": {"state": {"types": ["m.*"]}}}
+
+        filter_id = yield self.datastore.add_user_filter(
+            user_localpart=user_localpart, user_filter=user_filter_json
+        )
+
+        filter = yield self.filtering.get_user_filter(
+            user_localpart=user_localpart, filter_id=filter_id
+        )
+        filter_again = yield self.filtering.get_user_filter(
+            user_localpart=user_localpart, filter_id=filter_id
+        )
+
+        self.assertIs(filter, filter_again)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.config._base import ConfigError
+from synapse.config.workers import WorkerConfig
+
+from tests import unittest
+
+
+class WorkerConfigTestCase(unittest.TestCase):
+    def _read(self, config):
+        worker_config = WorkerConfig()
+        worker_config.read_config(config)
+        return worker_config
+
+    def test_federation_reader_worker_name(self):
+        config = {"worker_app": "synapse.app.federation_reader"}
+        self.assertEqual(
+            self._read(config).worker_name, "synapse.app.federation_reader",
+        )
+
+        config["worker_name"] = "master"
+        with self.assertRaises(ConfigError):
+            self._read(config)
+
+        config["worker_name"] = "federation_reader1"
+        self.assertEqual(self._read(config).worker_name, "federation_reader1")
+
+    def test_worker_name_defaults_to_app(self):
+        worker_config = self._read({"worker_app": "synapse.app.synchrotron"})
+        self.assertEqual(worker_config.worker_name, "synapse.app.synchrotron")
@@ -223,3 +223,100 @@ class KeyringTestCase(unittest.TestCase):
             yield defer
 
             self.assertIs(LoggingContext.current_context(), context_one)
+
+    @defer.inlineCallbacks
+    def _store_key(self, server_name, verify_key, valid_until_ts):
+        key_id = "%s:%s" % (verify_key.alg, verify_key.version)
+        now = self.hs.get_clock().time_msec()
+        yield self.hs.datastore.store_server_verify_key(
+            server_name, "", now, verify_key
+        )
+        yield self.hs.datastore.store_server_keys_json(
+            server_name, key_id, server_name, now, valid_until_ts, b"{}"
+        )
+        defer.returnValue(key_id)
+
+    @defer.inlineCallbacks
+    def test_verify_json_uses_cached_keys(self):
+        kr = keyring.Keyring(self.hs)
+        clock = self.hs.get_clock()
+
+        key1 = signedjson.key.generate_signing_key(1)
+        key_id = yield self._store_key(
+            "server9", signedjson.key.get_verify_key(key1),
+            clock.time_msec() + 24 * 3600 * 1000,
+        )
+        json1 = {}
+        signedjson.sign.sign_json(json1, "server9", key1)
+
+        yield kr.verify_json_for_server("server9", json1)
+
+        # the key is now cached, so we don't go back to the store for it
+        kr.store = Mock()
+        kr.get_keys_from_perspectives = Mock(side_effect=lambda _: defer.succeed({}))
+        kr.get_keys_from_server = Mock(side_effect=lambda _: defer.succeed({}))
+        yield kr.verify_json_for_server("server9", json1)
+        kr.store.get_server_verify_keys.assert_not_called()
+        kr.get_keys_from_perspectives.assert_not_called()
+
+        # once the key is about to expire, it gets refreshed in the background,
+        # while we carry on using the cached key
+        clock.advance_time(23.9 * 3600)
+        yield kr.verify_json_for_server("server9", json1)
+        kr.get_keys_from_perspectives.assert_called_once_with(
+            [("server9", {key_id})],
+        )
+        kr.get_keys_from_server.assert_called_once_with([("server9", {key_id})])
+
+        # the failed refresh isn't retried immediately
+        yield kr.verify_json_for_server("server9", json1)
+        kr.get_keys_from_perspectives.assert_called_once()
+        kr.store.get_server_verify_keys.assert_not_called()
+
+    @defer.inlineCallbacks
+    def test_expired_keys_not_refreshed(self):
+        kr = keyring.Keyring(self.hs)
+        clock = self.hs.get_clock()
+
+        key1 = signedjson.key.generate_signing_key(1)
+        yield self._store_key(
+            "server9", signedjson.key.get_verify_key(key1), clock.time_msec() - 1000,
+        )
+        json1 = {}
+        signedjson.sign.sign_json(json1, "server9", key1)
+
+        kr.get_keys_from_perspectives = Mock(side_effect=lambda _: defer.succeed({}))
+        kr.get_keys_from_server = Mock(side_effect=lambda _: defer.succeed({}))
+
+        # the expired key is still used, without asking remote servers for it
+        yield kr.verify_json_for_server("server9", json1)
+        yield kr.verify_json_for_server("server9", json1)
+        clock.advance_time(keyring.EXPIRED_KEY_CACHE_MS / 1000.)
+        yield kr.verify_json_for_server("server9", json1)
+        kr.get_keys_from_perspectives.assert_not_called()
+        kr.get_keys_from_server.assert_not_called()
+
+    @defer.inlineCallbacks
+    def test_unknown_keys_are_cached(self):
+        kr = keyring.Keyring(self.hs)
+        kr.get_keys_from_perspectives = Mock(side_effect=lambda _: defer.succeed({}))
+        kr.get_keys_from_server = Mock(side_effect=lambda _: defer.succeed({}))
+
+        json1 = {}
+        signedjson.sign.sign_json(
+            json1, "server8", signedjson.key.generate_signing_key(1),
+        )
+
+        with self.assertRaises(SynapseError):
+            yield kr.verify_json_for_server("server8", json1)
+        kr.get_keys_from_server.assert_called_once()
+
+        # we don't look for the key again for a while
+        with self.assertRaises(SynapseError):
+            yield kr.verify_json_for_server("server8", json1)
+        kr.get_keys_from_server.assert_called_once()
+
+        self.hs.get_clock().advance_time(keyring.UNKNOWN_KEY_CACHE_MS / 1000.)
+        with self.assertRaises(SynapseError):
+            yield kr.verify_json_for_server("server8", json1)
+        self.assertEqual(kr.get_keys_from_server.call_count, 2)
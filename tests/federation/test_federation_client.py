@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.api.constants import RoomVersions
+from synapse.federation.federation_client import MAX_CONCURRENT_PDU_FETCHES
+from synapse.util.logcontext import make_deferred_yieldable
+
+from tests.unittest import HomeserverTestCase
+
+
+def _pdu(event_id):
+    return {
+        "event_id": event_id,
+        "room_id": "!room:remote",
+        "type": "m.room.message",
+        "sender": "@user:remote",
+        "content": {},
+        "depth": 1,
+    }
+
+
+class GetPduTestCase(HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        # list of (destination, event_id, Deferred) for each request made
+        self.requests = []
+
+        def get_event(destination, event_id, timeout=None):
+            d = defer.Deferred()
+            self.requests.append((destination, event_id, d))
+            return make_deferred_yieldable(d)
+
+        self.client = hs.get_federation_client()
+        self.client.transport_layer = Mock()
+        self.client.transport_layer.get_event.side_effect = get_event
+        self.client._check_sigs_and_hash = lambda room_version, pdu: defer.succeed(
+            pdu,
+        )
+
+        # get_pdu treats the time of the last attempt as 0 for destinations
+        # it hasn't tried, so move away from the epoch.
+        self.reactor.advance(1000)
+
+    def _get_pdu(self, destinations, event_id):
+        return self.client.get_pdu(destinations, event_id, RoomVersions.V1)
+
+    def test_concurrent_requests_deduplicated(self):
+        d1 = self._get_pdu(["remote1"], "$ev")
+        d2 = self._get_pdu(["remote1", "remote2"], "$ev")
+
+        self.assertEqual(len(self.requests), 1)
+        self.requests[0][2].callback({"pdus": [_pdu("$ev")]})
+
+        self.assertEqual(self.successResultOf(d1).event_id, "$ev")
+        self.assertEqual(self.successResultOf(d2).event_id, "$ev")
+        self.assertEqual(len(self.requests), 1)
+
+    def test_waiter_tries_other_destinations(self):
+        d1 = self._get_pdu(["remote1"], "$ev")
+        d2 = self._get_pdu(["remote1", "remote2"], "$ev")
+
+        self.requests[0][2].errback(Exception("not found"))
+        self.assertIsNone(self.successResultOf(d1))
+
+        # remote1 has just failed, so the second request only goes to remote2
+        self.assertEqual(
+            [(dest, event_id) for dest, event_id, _ in self.requests],
+            [("remote1", "$ev"), ("remote2", "$ev")],
+        )
+        self.requests[1][2].callback({"pdus": [_pdu("$ev")]})
+        self.assertEqual(self.successResultOf(d2).event_id, "$ev")
+
+    def test_failures_cached(self):
+        d = self._get_pdu(["remote1"], "$ev")
+        self.requests[0][2].errback(Exception("not found"))
+        self.assertIsNone(self.successResultOf(d))
+
+        d = self._get_pdu(["remote1"], "$ev")
+        self.assertIsNone(self.successResultOf(d))
+        self.assertEqual(len(self.requests), 1)
+
+        # remote1 is asked again once the failure has expired
+        self.reactor.advance(61)
+        self._get_pdu(["remote1"], "$ev")
+        self.assertEqual(len(self.requests), 2)
+
+    def test_get_pdus_bounded(self):
+        event_ids = ["$ev%i" % (i,) for i in range(MAX_CONCURRENT_PDU_FETCHES + 5)]
+        d = self.client.get_pdus(["remote1", "remote2"], event_ids, RoomVersions.V1)
+
+        self.assertEqual(len(self.requests), MAX_CONCURRENT_PDU_FETCHES)
+
+        # answer the requests as they come in, failing one of the events
+        answered = 0
+        while answered < len(self.requests):
+            _, event_id, request_d = self.requests[answered]
+            answered += 1
+            if event_id == "$ev3":
+                request_d.errback(Exception("not found"))
+            else:
+                request_d.callback({"pdus": [_pdu(event_id)]})
+
+        pdus = self.successResultOf(d)
+        self.assertEqual(set(pdus), set(event_ids) - {"$ev3"})
+
+        # both servers were asked for the failed event
+        self.assertEqual(
+            set(dest for dest, event_id, _ in self.requests if event_id == "$ev3"),
+            {"remote1", "remote2"},
+        )
@@ -17,8 +17,22 @@ from mock import Mock
 
 from twisted.internet import defer
 
+from synapse.api.errors import RequestSendFailed
+from synapse.federation.send_queue import (
+    EduRow,
+    KeyedEduRow,
+    process_rows_for_federation,
+)
+from synapse.federation.sender.per_destination_queue import TransactionPacer
+from synapse.federation.units import Edu
+from synapse.replication.tcp.streams import FederationStreamRow
+from synapse.rest import admin
+from synapse.rest.client.v1 import login, room
 from synapse.types import ReadReceipt
+from synapse.util import get_shard_for_key
+from synapse.util.logcontext import make_deferred_yieldable
 
+from tests import unittest
 from tests.unittest import HomeserverTestCase
 
 
@@ -126,3 +140,316 @@ class FederationSenderTestCases(HomeserverTestCase):
                 },
             },
         ])
+
+
+class FederationCatchUpTestCases(HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver(
+            federation_transport_client=Mock(spec=["send_transaction"]),
+        )
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        self.mock_send_transaction = (
+            hs.get_federation_transport_client().send_transaction
+        )
+        self.mock_send_transaction.return_value = defer.succeed({})
+
+        self.user_id = self.register_user("u1", "you the one")
+        self.tok = self.login("u1", "you the one")
+
+    def _send_event(self, room_id, body):
+        """Send a message, and record it as sent to host2"""
+        event_id = self.helper.send(room_id, body, tok=self.tok)["event_id"]
+        event = self.get_success(self.store.get_event(event_id))
+        self.get_success(self.store.store_destination_rooms_entries(
+            ["host2"], room_id, event.internal_metadata.stream_ordering,
+        ))
+        return event
+
+    def _get_sent_event_ids(self):
+        event_ids = []
+        for args, _ in self.mock_send_transaction.call_args_list:
+            data = args[1]()
+            event_ids.extend(pdu["event_id"] for pdu in data["pdus"])
+        return event_ids
+
+    def test_catch_up_sends_latest_event_per_room(self):
+        room_1 = self.helper.create_room_as(self.user_id, tok=self.tok)
+        room_2 = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        event_1 = self._send_event(room_1, "sent")
+        self.get_success(self.store.set_destination_last_successful_stream_ordering(
+            "host2", event_1.internal_metadata.stream_ordering,
+        ))
+
+        # host2 misses these
+        self._send_event(room_1, "missed 1")
+        event_2 = self._send_event(room_1, "missed 2")
+        event_3 = self._send_event(room_2, "missed 3")
+
+        self.assertEqual(
+            self.get_success(self.store.get_catch_up_outstanding_destinations(None)),
+            ["host2"],
+        )
+
+        # host2 gets woken up to catch up
+        self.reactor.advance(60)
+
+        self.assertEqual(
+            self._get_sent_event_ids(), [event_2.event_id, event_3.event_id],
+        )
+        self.assertEqual(
+            self.get_success(
+                self.store.get_destination_last_successful_stream_ordering("host2"),
+            ),
+            event_3.internal_metadata.stream_ordering,
+        )
+        self.assertEqual(
+            self.get_success(self.store.get_catch_up_outstanding_destinations(None)),
+            [],
+        )
+
+    def test_failure_starts_catching_up(self):
+        room_1 = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        event_1 = self._send_event(room_1, "sent")
+        self.get_success(self.store.set_destination_last_successful_stream_ordering(
+            "host2", event_1.internal_metadata.stream_ordering,
+        ))
+
+        queue = self.hs.get_federation_sender()._get_per_destination_queue("host2")
+
+        # nothing to catch up on yet, so the PDU is sent as normal, but fails
+        self.mock_send_transaction.return_value = defer.fail(
+            RequestSendFailed(Exception("down"), can_retry=True),
+        )
+        event_2 = self._send_event(room_1, "failed")
+        queue.send_pdu(event_2, 1)
+        self.pump()
+        self.assertEqual(self._get_sent_event_ids(), [event_2.event_id])
+        self.assertEqual(queue.pending_pdu_count(), 0)
+
+        # new PDUs aren't queued in memory while catching up
+        event_3 = self._send_event(room_1, "missed")
+        self.reactor.advance(600)
+        self.mock_send_transaction.reset_mock()
+        self.mock_send_transaction.return_value = defer.succeed({})
+        queue.send_pdu(event_3, 2)
+        self.assertEqual(queue.pending_pdu_count(), 0)
+        self.pump()
+
+        # ... but it is sent once the catch up happens
+        self.assertEqual(self._get_sent_event_ids(), [event_3.event_id])
+
+
+class TransactionPacerTestCase(unittest.TestCase):
+    def test_adapts_to_response_times(self):
+        pacer = TransactionPacer(4)
+        self.assertEqual(pacer.pdu_limit, 50)
+        self.assertEqual(pacer.allowed_in_flight(), 1)
+
+        pacer.record_response(30)
+        self.assertEqual(pacer.pdu_limit, 25)
+
+        pacer.record_failure()
+        self.assertEqual(pacer.pdu_limit, 12)
+        self.assertEqual(pacer.allowed_in_flight(), 1)
+
+        # quick responses grow the transactions, and allow several in flight
+        pacer.record_response(0.5)
+        self.assertEqual(pacer.pdu_limit, 17)
+        self.assertEqual(pacer.allowed_in_flight(), 4)
+
+        for _ in range(10):
+            pacer.record_response(0.5)
+        self.assertEqual(pacer.pdu_limit, 50)
+
+
+class FederationPipeliningTestCases(HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        self.transactions = []
+
+        def send_transaction(transaction, json_data_cb):
+            d = defer.Deferred()
+            self.transactions.append((d, json_data_cb()))
+            return make_deferred_yieldable(d)
+
+        transport_client = Mock(spec=["send_transaction"])
+        transport_client.send_transaction.side_effect = send_transaction
+
+        config = self.default_config()
+        config.federation_transaction_max_in_flight = 2
+
+        return self.setup_test_homeserver(
+            config=config, federation_transport_client=transport_client,
+        )
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        user_id = self.register_user("u1", "you the one")
+        tok = self.login("u1", "you the one")
+        room_id = self.helper.create_room_as(user_id, tok=tok)
+
+        self.events = []
+        for i in range(3):
+            event_id = self.helper.send(room_id, str(i), tok=tok)["event_id"]
+            self.events.append(self.get_success(self.store.get_event(event_id)))
+
+    def _get_last_successful_stream_ordering(self):
+        return self.get_success(
+            self.store.get_destination_last_successful_stream_ordering("host2"),
+        )
+
+    def test_transactions_pipelined_to_fast_destination(self):
+        queue = self.hs.get_federation_sender()._get_per_destination_queue("host2")
+        queue._pacer.response_time = 0.1
+        queue._pacer.pdu_limit = 1
+
+        for i, event in enumerate(self.events):
+            queue.send_pdu(event, i)
+        self.pump()
+
+        # two transactions are sent without waiting for a response
+        self.assertEqual(len(self.transactions), 2)
+        self.assertEqual(
+            [data["pdus"][0]["event_id"] for _, data in self.transactions],
+            [self.events[0].event_id, self.events[1].event_id],
+        )
+
+        # the second is acked first, so the first is still outstanding
+        self.transactions[1][0].callback({})
+        self.pump()
+        self.assertLess(
+            self._get_last_successful_stream_ordering(),
+            self.events[0].internal_metadata.stream_ordering,
+        )
+
+        # ... and the third can now be sent
+        self.assertEqual(len(self.transactions), 3)
+
+        self.transactions[0][0].callback({})
+        self.pump()
+        self.assertEqual(
+            self._get_last_successful_stream_ordering(),
+            self.events[1].internal_metadata.stream_ordering,
+        )
+
+        self.transactions[2][0].callback({})
+        self.pump()
+        self.assertEqual(
+            self._get_last_successful_stream_ordering(),
+            self.events[2].internal_metadata.stream_ordering,
+        )
+        self.assertFalse(queue.transmission_loop_running)
+
+    def test_slow_destination_not_pipelined(self):
+        queue = self.hs.get_federation_sender()._get_per_destination_queue("host2")
+        queue._pacer.pdu_limit = 1
+
+        for i, event in enumerate(self.events):
+            queue.send_pdu(event, i)
+        self.pump()
+        self.assertEqual(len(self.transactions), 1)
+
+        # a slow response halves the transaction size
+        self.reactor.advance(30)
+        self.transactions[0][0].callback({})
+        self.pump()
+        self.assertEqual(len(self.transactions), 2)
+        self.assertEqual(queue._pacer.pdu_limit, 1)
+
+
+class FederationSenderShardingTestCases(HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.worker_federation_sender_shard_count = 2
+        config.worker_federation_sender_shard_index = 1
+
+        return self.setup_test_homeserver(
+            config=config,
+            state_handler=Mock(spec=["get_current_hosts_in_room"]),
+            federation_transport_client=Mock(spec=["send_transaction"]),
+        )
+
+    def prepare(self, reactor, clock, hs):
+        self.sender = hs.get_federation_sender()
+
+        self.mock_send_transaction = (
+            hs.get_federation_transport_client().send_transaction
+        )
+        self.mock_send_transaction.return_value = defer.succeed({})
+
+        self.hosts = ["host%d" % (i,) for i in range(10)]
+        self.our_hosts = set(
+            h for h in self.hosts if get_shard_for_key(h, 2) == 1
+        )
+
+        # make sure the test is actually testing something
+        self.assertTrue(self.our_hosts)
+        self.assertNotEqual(self.our_hosts, set(self.hosts))
+
+    def _get_destinations(self):
+        return set(
+            args[0].destination
+            for args, _ in self.mock_send_transaction.call_args_list
+        )
+
+    def test_send_receipts_to_own_shard(self):
+        mock_state_handler = self.hs.get_state_handler()
+        mock_state_handler.get_current_hosts_in_room.return_value = (
+            ["test"] + self.hosts
+        )
+
+        receipt = ReadReceipt("room_id", "m.read", "user_id", ["event_id"], {"ts": 1234})
+        self.successResultOf(self.sender.send_read_receipt(receipt))
+        self.pump()
+
+        self.assertEqual(self._get_destinations(), self.our_hosts)
+
+    def test_edus_routed_to_own_shard(self):
+        rows = []
+        for host in self.hosts:
+            edu = Edu(
+                origin="test", destination=host, edu_type="m.test", content={},
+            )
+            rows.append(FederationStreamRow(EduRow.TypeId, EduRow(edu).to_data()))
+            rows.append(FederationStreamRow(
+                KeyedEduRow.TypeId, KeyedEduRow(("key",), edu).to_data(),
+            ))
+
+        process_rows_for_federation(self.sender, rows)
+        self.pump()
+
+        self.assertEqual(self._get_destinations(), self.our_hosts)
+
+    def test_shard_stream_positions(self):
+        store = self.hs.get_datastore()
+        self.get_success(store.update_federation_out_pos("events", 5))
+
+        # a new shard starts from where the first one is
+        self.assertEqual(
+            self.get_success(store.get_federation_out_pos("events", shard_index=1)),
+            5,
+        )
+
+        self.get_success(store.update_federation_out_pos("events", 7, shard_index=1))
+        self.assertEqual(self.get_success(store.get_federation_out_pos("events")), 5)
+        self.assertEqual(
+            self.get_success(store.get_federation_out_pos("events", shard_index=1)),
+            7,
+        )
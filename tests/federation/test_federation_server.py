@@ -14,8 +14,20 @@
 # limitations under the License.
 import logging
 
-from synapse.events import FrozenEvent
-from synapse.federation.federation_server import server_matches_acl_event
+from mock import Mock, patch
+
+from twisted.internet import defer
+
+from synapse.api.errors import FederationError
+from synapse.events import FrozenEvent, FrozenEventV2
+from synapse.federation.federation_server import (
+    STAGED_PDU_PARTIAL_STATE_CHECK_INTERVAL_SECS,
+    STAGED_PDU_RETRY_INTERVAL_SECS,
+    server_matches_acl_event,
+)
+from synapse.rest import admin
+from synapse.rest.client.v1 import login, room
+from synapse.util.logcontext import make_deferred_yieldable
 
 from tests import unittest
 
@@ -42,6 +54,160 @@ class ServerACLsTestCase(unittest.TestCase):
         self.assertTrue(server_matches_acl_event("1:2:3:4", e))
 
 
+class StagedPDUsTestCase(unittest.HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        # the results of each call to on_receive_pdu
+        self.processing = []
+
+        def on_receive_pdu(origin, pdu, sent_to_us_directly):
+            d = defer.Deferred()
+            self.processing.append((pdu.event_id, d))
+            return make_deferred_yieldable(d)
+
+        handler = hs.get_handlers().federation_handler
+        handler.on_receive_pdu = Mock(side_effect=on_receive_pdu)
+
+        user_id = self.register_user("u1", "pass")
+        tok = self.login("u1", "pass")
+        self.room_id = self.helper.create_room_as(user_id, tok=tok)
+
+    def _make_pdu(self, i):
+        return FrozenEvent({
+            "event_id": "$%d:remote" % (i,),
+            "room_id": self.room_id,
+            "type": "m.room.message",
+            "sender": "@u:remote",
+            "content": {"body": str(i)},
+            "depth": i,
+            "prev_events": [],
+            "auth_events": [],
+        })
+
+    def _stage(self, *pdus):
+        return self.hs.get_federation_server()._stage_pdus_for_room(
+            "remote", self.room_id, list(pdus), self.clock.time_msec(),
+        )
+
+    def _get_next_staged_event_id(self):
+        row = self.get_success(
+            self.store.get_next_staged_event_for_room("master", self.room_id),
+        )
+        return row[2]["event_id"] if row else None
+
+    def test_staged_pdus_processed_in_order(self):
+        self.get_success(self._stage(self._make_pdu(1), self._make_pdu(2)))
+        self.get_success(self._stage(self._make_pdu(3)))
+
+        for i in range(1, 4):
+            self.assertEqual(self._get_next_staged_event_id(), "$%d:remote" % (i,))
+            self.assertEqual(len(self.processing), i)
+            self.assertEqual(self.processing[-1][0], "$%d:remote" % (i,))
+            self.processing[-1][1].callback(None)
+            self.pump()
+
+        self.assertIsNone(self._get_next_staged_event_id())
+        self.assertEqual(self.hs.get_federation_server()._staged_pdus, {})
+
+    def test_pdu_without_event_id_removed(self):
+        # PDUs in newer room versions don't include their event ID
+        pdu = FrozenEventV2({
+            "room_id": self.room_id,
+            "type": "m.room.message",
+            "sender": "@u:remote",
+            "content": {"body": "hi"},
+            "depth": 1,
+            "prev_events": [],
+            "auth_events": [],
+            "hashes": {"sha256": "abc"},
+            "signatures": {},
+        })
+        self.assertNotIn("event_id", pdu.get_pdu_json())
+
+        # it can't be parsed as an event for this room, but it is still
+        # removed once we have tried to process it
+        self.get_success(self._stage(pdu))
+        self.pump()
+        self.assertIsNone(self._get_next_staged_event_id())
+        self.assertEqual(self.hs.get_federation_server()._staged_pdus, {})
+
+    def test_failed_pdu_retried(self):
+        self.get_success(self._stage(self._make_pdu(1), self._make_pdu(2)))
+
+        # an unexpected error leaves the PDU staged, and it is tried again later
+        self.processing[0][1].errback(Exception("database went away"))
+        self.pump()
+        self.assertEqual(len(self.processing), 1)
+        self.assertEqual(self._get_next_staged_event_id(), "$1:remote")
+
+        self.reactor.advance(STAGED_PDU_RETRY_INTERVAL_SECS)
+        self.assertEqual(
+            [event_id for event_id, _ in self.processing], ["$1:remote", "$1:remote"],
+        )
+
+        # a rejected PDU is removed
+        self.processing[1][1].errback(
+            FederationError("ERROR", 403, "rejected", affected="$1:remote"),
+        )
+        self.pump()
+        self.assertEqual(self._get_next_staged_event_id(), "$2:remote")
+        self.assertEqual(self.processing[-1][0], "$2:remote")
+
+    def test_duplicate_pdus_ignored(self):
+        self.get_success(self._stage(self._make_pdu(1)))
+        self.get_success(self._stage(self._make_pdu(1)))
+
+        self.processing[0][1].callback(None)
+        self.pump()
+        self.assertEqual(len(self.processing), 1)
+
+    @patch("synapse.federation.federation_server.MAX_STAGED_PDUS_PER_ROOM", 2)
+    def test_backpressure(self):
+        self.get_success(self._stage(self._make_pdu(1), self._make_pdu(2)))
+
+        # the room is full, so staging more has to wait
+        d = self._stage(self._make_pdu(3))
+        self.pump()
+        self.assertNoResult(d)
+
+        self.processing[0][1].callback(None)
+        self.pump()
+        self.successResultOf(d)
+
+    def test_partial_state_room(self):
+        # PDUs for a room which we only have partial state for stay staged
+        # until we have the full state
+        self.get_success(
+            self.store.store_partial_state_room(self.room_id, "$join", ["remote"]),
+        )
+        self.get_success(self._stage(self._make_pdu(1)))
+        self.reactor.advance(60)
+
+        self.assertEqual(self.processing, [])
+        self.assertEqual(self._get_next_staged_event_id(), "$1:remote")
+
+        self.get_success(self.store.clear_partial_state_room(self.room_id))
+        self.reactor.advance(STAGED_PDU_PARTIAL_STATE_CHECK_INTERVAL_SECS)
+        self.assertEqual([event_id for event_id, _ in self.processing], ["$1:remote"])
+
+    def test_resume_staged_pdus(self):
+        # PDUs staged before a restart get processed when we start up again
+        self.get_success(self.store.stage_received_events(
+            "master", "remote", [self._make_pdu(1)], self.clock.time_msec(),
+        ))
+
+        self.hs.get_federation_server()
+        self.pump()
+        self.assertEqual([event_id for event_id, _ in self.processing], ["$1:remote"])
+
+
 def _create_acl_event(content):
     return FrozenEvent(
         {
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.api.errors import SynapseError
+from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
+from synapse.events import FrozenEvent
+from synapse.handlers.federation import PARTIAL_STATE_MAX_RESYNC_TIME_SECS
+from synapse.handlers.sync import SyncConfig
+from synapse.types import UserID, create_requester, get_domain_from_id
+
+from tests.unittest import HomeserverTestCase
+
+ROOM_ID = "!room:remote"
+CREATOR = "@creator:remote"
+JOINEE = "@alice:test"
+
+
+class PartialStateJoinTestCase(HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.handler = hs.get_handlers().federation_handler
+
+        self.depth = 0
+        self.prev_event_id = None
+
+        self.create = self._make_event(
+            EventTypes.Create, CREATOR, "", {"creator": CREATOR}, [],
+        )
+        self.creator_join = self._make_event(
+            EventTypes.Member, CREATOR, CREATOR, {"membership": "join"},
+            [self.create],
+        )
+        self.power_levels = self._make_event(
+            EventTypes.PowerLevels, CREATOR, "", {"users": {CREATOR: 100}},
+            [self.create, self.creator_join],
+        )
+        self.join_rules = self._make_event(
+            EventTypes.JoinRules, CREATOR, "", {"join_rule": "public"},
+            [self.create, self.creator_join, self.power_levels],
+        )
+        self.name = self._make_event(
+            EventTypes.Name, CREATOR, "", {"name": "Big room"},
+            [self.create, self.creator_join, self.power_levels],
+        )
+        self.members = [
+            self._make_join("@user%i:other%i" % (i, i)) for i in range(5)
+        ]
+        self.join = self._make_join(JOINEE)
+
+        self.auth_chain = [
+            self.create, self.creator_join, self.power_levels, self.join_rules,
+        ]
+        self.state = self.auth_chain + [self.name] + self.members
+
+    def _make_event(self, event_type, sender, state_key, content, auth_events):
+        self.depth += 1
+        event = FrozenEvent({
+            "room_id": ROOM_ID,
+            "event_id": "$%i:remote" % (self.depth,),
+            "type": event_type,
+            "sender": sender,
+            "state_key": state_key,
+            "content": content,
+            "auth_events": [(e.event_id, {}) for e in auth_events],
+            "prev_events": (
+                [(self.prev_event_id, {})] if self.prev_event_id else []
+            ),
+            "depth": self.depth,
+            "origin": "remote",
+            "origin_server_ts": 0,
+            "hashes": {},
+            # the signatures aren't checked, just that they are there
+            "signatures": {
+                get_domain_from_id(sender): {"ed25519:a": "sig"},
+                "remote": {"ed25519:a": "sig"},
+            },
+        })
+        self.prev_event_id = event.event_id
+        return event
+
+    def _make_join(self, user_id):
+        return self._make_event(
+            EventTypes.Member, user_id, user_id, {"membership": "join"},
+            [self.create, self.join_rules, self.power_levels],
+        )
+
+    def _join_with_partial_state(self):
+        self.get_success(
+            self.store.store_partial_state_room(
+                ROOM_ID, self.join.event_id, ["remote"],
+            )
+        )
+        return self.get_success(
+            self.handler._persist_auth_tree(
+                "remote", self.auth_chain, self.state, self.join,
+                partial_state=True,
+            )
+        )
+
+    def test_partial_state_join(self):
+        remaining = self._join_with_partial_state()
+
+        # only the members are left to persist. (The creator's membership is in
+        # the auth chain, so is persisted, but isn't part of the partial state.)
+        self.assertEqual(
+            sorted(e.event_id for e, _ in remaining),
+            sorted(e.event_id for e in self.members),
+        )
+
+        current_state = self.get_success(self.store.get_current_state_ids(ROOM_ID))
+        self.assertEqual(set(current_state), {
+            (EventTypes.Create, ""),
+            (EventTypes.PowerLevels, ""),
+            (EventTypes.JoinRules, ""),
+            (EventTypes.Name, ""),
+            (EventTypes.Member, JOINEE),
+        })
+
+        # local users can't send events until we have the full state
+        requester = create_requester(JOINEE)
+        f = self.get_failure(
+            self.hs.get_event_creation_handler().create_event(
+                requester, {
+                    "type": EventTypes.Message,
+                    "room_id": ROOM_ID,
+                    "sender": JOINEE,
+                    "content": {"msgtype": "m.text", "body": "hi"},
+                },
+            ),
+            SynapseError,
+        )
+        self.assertEqual(f.value.code, 503)
+
+        # ... other than to leave the room
+        self.get_success(
+            self.hs.get_event_creation_handler().create_event(
+                requester, {
+                    "type": EventTypes.Member,
+                    "room_id": ROOM_ID,
+                    "sender": JOINEE,
+                    "state_key": JOINEE,
+                    "content": {"membership": Membership.LEAVE},
+                },
+            ),
+        )
+
+        sync_config = SyncConfig(
+            user=UserID.from_string(JOINEE),
+            filter_collection=DEFAULT_FILTER_COLLECTION,
+            is_guest=False,
+            request_key="request_key",
+            device_id="device_id",
+        )
+        sync_result = self.get_success(
+            self.hs.get_sync_handler().wait_for_sync_for_user(sync_config),
+        )
+
+        self.get_success(
+            self.handler._complete_partial_state_join(
+                ROOM_ID, self.join, self.state, remaining,
+            )
+        )
+
+        # the next sync sends down the full state
+        sync_result = self.get_success(
+            self.hs.get_sync_handler().wait_for_sync_for_user(
+                sync_config, since_token=sync_result.next_batch,
+            ),
+        )
+        room_result = sync_result.joined[0]
+        self.assertEqual(room_result.room_id, ROOM_ID)
+        for member in self.members:
+            self.assertIn((member.type, member.state_key), room_result.state)
+
+        self.assertFalse(
+            self.get_success(self.store.is_partial_state_room(ROOM_ID)),
+        )
+
+        expected_state = {(e.type, e.state_key): e.event_id for e in self.state}
+        expected_state[(EventTypes.Member, JOINEE)] = self.join.event_id
+
+        self.assertEqual(
+            self.get_success(self.store.get_current_state_ids(ROOM_ID)),
+            expected_state,
+        )
+        self.assertEqual(
+            self.get_success(self.store.get_state_ids_for_event(self.join.event_id)),
+            expected_state,
+        )
+        self.assertIn(
+            "@user0:other0",
+            self.get_success(self.store.get_users_in_room(ROOM_ID)),
+        )
+
+    def test_give_up_resync(self):
+        self._join_with_partial_state()
+
+        member_handler = self.hs.get_room_member_handler()
+        member_handler.update_membership = Mock(
+            side_effect=lambda *args, **kwargs: defer.succeed(None),
+        )
+
+        # we can't fetch the state from anywhere, so once we have been trying
+        # for long enough, we leave the room.
+        self.reactor.advance(PARTIAL_STATE_MAX_RESYNC_TIME_SECS)
+        self.get_success(
+            self.handler._resync_partial_state_room(ROOM_ID, self.join, []),
+        )
+
+        member_handler.update_membership.assert_called_once()
+        args = member_handler.update_membership.call_args[0]
+        self.assertEqual(
+            (args[1].to_string(), args[2], args[3]),
+            (JOINEE, ROOM_ID, Membership.LEAVE),
+        )
+        self.assertFalse(
+            self.get_success(self.store.is_partial_state_room(ROOM_ID)),
+        )
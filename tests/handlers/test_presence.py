@@ -18,11 +18,13 @@ from mock import Mock, call
 
 from synapse.api.constants import PresenceState
 from synapse.handlers.presence import (
+    EXTERNAL_PROCESS_EXPIRY,
     FEDERATION_PING_INTERVAL,
     FEDERATION_TIMEOUT,
     IDLE_TIMER,
     LAST_ACTIVE_GRANULARITY,
     SYNC_ONLINE_TIMEOUT,
+    PresenceStateColumns,
     handle_timeout,
     handle_update,
 )
@@ -405,3 +407,75 @@ class PresenceTimeoutTestCase(unittest.TestCase):
 
         self.assertIsNotNone(new_state)
         self.assertEquals(state, new_state)
+
+
+class ExternalProcessExpiryTestCase(unittest.HomeserverTestCase):
+    def test_expired_process_syncs_cleared(self):
+        handler = self.hs.get_presence_handler()
+        user_id = "@user:test"
+
+        self.get_success(handler.update_external_syncs_row(
+            "worker1", user_id, True, self.clock.time_msec(),
+        ))
+        self.assertIn(user_id, handler.get_currently_syncing_users())
+
+        # the timeout loop starts after 30s, and then runs every 5s
+        self.reactor.advance(30)
+        self.reactor.advance(EXTERNAL_PROCESS_EXPIRY / 1000.)
+        self.reactor.advance(5)
+
+        self.assertNotIn(user_id, handler.get_currently_syncing_users())
+        self.assertNotIn("worker1", handler.external_process_last_updated_ms)
+
+
+class PresenceStateColumnsTestCase(unittest.TestCase):
+    def test_matches_handle_timeout(self):
+        """get_timed_out_users should find exactly the users whose states
+        handle_timeout changes.
+        """
+        now = 5000000
+        ages = [
+            0, LAST_ACTIVE_GRANULARITY + 1, SYNC_ONLINE_TIMEOUT + 1, IDLE_TIMER + 1,
+            FEDERATION_PING_INTERVAL + 1, FEDERATION_TIMEOUT + 1,
+        ]
+
+        columns = PresenceStateColumns(lambda user_id: user_id.endswith(":local"))
+        states = []
+        for presence in (
+            PresenceState.ONLINE, PresenceState.UNAVAILABLE, PresenceState.OFFLINE,
+        ):
+            for server in ("local", "remote"):
+                for active_age in ages:
+                    for sync_age in ages:
+                        for federation_age in ages:
+                            state = UserPresenceState.default(
+                                "@user%i:%s" % (len(states), server),
+                            ).copy_and_replace(
+                                state=presence,
+                                last_active_ts=now - active_age,
+                                last_user_sync_ts=now - sync_age,
+                                last_federation_update_ts=now - federation_age,
+                            )
+                            states.append(state)
+                            columns.update(state)
+
+        user_ids = [state.user_id for state in states] + ["@unknown:local"]
+        syncing_user_ids = set(user_ids[::3])
+
+        expected = [
+            state.user_id for state in states
+            if handle_timeout(
+                state, state.user_id.endswith(":local"), syncing_user_ids, now,
+            )
+        ]
+        self.assertTrue(expected)
+        self.assertEqual(
+            columns.get_timed_out_users(user_ids, syncing_user_ids, now), expected,
+        )
+
+        # updating a state updates the columns
+        columns.update(states[0].copy_and_replace(state=PresenceState.OFFLINE))
+        self.assertNotIn(
+            states[0].user_id,
+            columns.get_timed_out_users(user_ids, syncing_user_ids, now),
+        )
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.handlers.presence_audience import PresenceAudience
+from synapse.replication.tcp.streams import CurrentStateDeltaStreamRow
+
+from tests import unittest
+from tests.utils import MockClock
+
+
+class PresenceAudienceTestCase(unittest.TestCase):
+    def setUp(self):
+        # room_id -> set of joined user_ids
+        self.rooms = {
+            "!a:test": {"@alice:test", "@bob:test", "@carl:remote1"},
+            "!b:test": {"@alice:test", "@dave:remote1", "@erin:remote2"},
+            "!c:test": {"@bob:test", "@fred:remote3"},
+        }
+
+        # event_id -> membership
+        self.events = {}
+
+        store = Mock()
+        store.get_room_max_stream_ordering.return_value = 10
+        store.get_rooms_for_user.side_effect = lambda user_id: defer.succeed(
+            frozenset(r for r, members in self.rooms.items() if user_id in members)
+        )
+        store.get_users_in_room.side_effect = lambda room_id: defer.succeed(
+            list(self.rooms[room_id])
+        )
+        store.get_event.side_effect = lambda event_id, allow_none: defer.succeed(
+            Mock(membership=self.events[event_id])
+        )
+
+        hs = Mock()
+        hs.hostname = "test"
+        hs.config.worker_app = "synapse.app.federation_sender"
+        hs.get_datastore.return_value = store
+        hs.get_clock.return_value = MockClock()
+
+        self.audience = PresenceAudience(hs)
+
+    def _change_membership(self, token, room_id, user_id, membership):
+        event_id = "$%d" % (token,)
+        self.events[event_id] = membership
+        if membership == Membership.JOIN:
+            self.rooms[room_id].add(user_id)
+        else:
+            self.rooms[room_id].discard(user_id)
+
+        self.audience.process_replication_rows(token, [
+            CurrentStateDeltaStreamRow(room_id, EventTypes.Member, user_id, event_id),
+        ])
+
+    def _get_remote_hosts(self, user_id):
+        return self.successResultOf(self.audience.get_remote_hosts(user_id))
+
+    def _check_audiences(self):
+        for user_id in ("@alice:test", "@bob:test"):
+            expected = set()
+            for members in self.rooms.values():
+                if user_id in members:
+                    expected.update(m.split(":", 1)[1] for m in members)
+            expected.discard("test")
+
+            self.assertEqual(self._get_remote_hosts(user_id), expected, user_id)
+
+    def test_initial_audience(self):
+        self.assertEqual(
+            self._get_remote_hosts("@alice:test"), {"remote1", "remote2"},
+        )
+        self.assertEqual(
+            self._get_remote_hosts("@bob:test"), {"remote1", "remote3"},
+        )
+
+    def test_membership_changes(self):
+        self._check_audiences()
+
+        # remote1 is still in !a after dave leaves !b
+        self._change_membership(11, "!b:test", "@dave:remote1", Membership.LEAVE)
+        self._check_audiences()
+
+        self._change_membership(12, "!a:test", "@carl:remote1", Membership.LEAVE)
+        self._check_audiences()
+
+        # a tracked user joining a room we weren't tracking
+        self._change_membership(13, "!c:test", "@alice:test", Membership.JOIN)
+        self._check_audiences()
+
+        # a tracked user leaving a room
+        self._change_membership(14, "!a:test", "@bob:test", Membership.LEAVE)
+        self._check_audiences()
+
+        self._change_membership(15, "!b:test", "@gina:remote4", Membership.JOIN)
+        self._check_audiences()
+
+        self.assertEqual(self.audience.get_current_token(), 15)
+
+    @defer.inlineCallbacks
+    def test_audience_not_read_while_tracking(self):
+        # room_id -> Deferred for the pending get_users_in_room call
+        users_in_room_ds = {}
+
+        def get_users_in_room(room_id):
+            users_in_room_ds[room_id] = defer.Deferred()
+            return users_in_room_ds[room_id]
+
+        self.audience.store.get_users_in_room.side_effect = get_users_in_room
+
+        d1 = self.audience.get_remote_hosts("@bob:test")
+        self.assertEqual(len(users_in_room_ds), 1)
+        room_id, d = users_in_room_ds.popitem()
+        d.callback(list(self.rooms[room_id]))
+
+        # bob's first room has been added to his audience, but a second caller
+        # waits for the second one too.
+        d2 = self.audience.get_remote_hosts("@bob:test")
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+
+        room_id, d = users_in_room_ds.popitem()
+        d.callback(list(self.rooms[room_id]))
+        self.assertEqual(self.successResultOf(d1), {"remote1", "remote3"})
+
+        # the linearizer wakes up the second caller on the next reactor tick
+        hosts = yield d2
+        self.assertEqual(hosts, {"remote1", "remote3"})
+
+    def test_untracked_rooms_are_forgotten(self):
+        self._get_remote_hosts("@alice:test")
+        self._change_membership(11, "!b:test", "@alice:test", Membership.LEAVE)
+        self._change_membership(12, "!a:test", "@alice:test", Membership.LEAVE)
+        self.assertEqual(self._get_remote_hosts("@alice:test"), set())
+
+        # nobody we are tracking is in the rooms, so they aren't tracked either
+        self.assertEqual(self.audience._members_by_room, {})
@@ -16,7 +16,12 @@ from twisted.internet import defer
 
 from synapse.api.errors import Codes, ResourceLimitError
 from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
-from synapse.handlers.sync import SyncConfig, SyncHandler
+from synapse.handlers.sync import (
+    LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE,
+    LazyLoadedMembersCache,
+    SyncConfig,
+    SyncHandler,
+)
 from synapse.types import UserID
 
 import tests.unittest
@@ -69,3 +74,24 @@ class SyncTestCase(tests.unittest.TestCase):
             request_key="request_key",
             device_id="device_id",
         )
+
+
+class LazyLoadedMembersCacheTestCase(tests.unittest.TestCase):
+    def test_size_bounded_across_rooms(self):
+        cache = LazyLoadedMembersCache()
+        for i in range(LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE + 1):
+            cache.mark_sent("!room%i:test" % (i,), "@user:test", "$ev%i" % (i,))
+
+        # the oldest member was forgotten, and its room is persisted as empty
+        self.assertFalse(cache.has_sent("!room0:test", "@user:test", "$ev0"))
+        self.assertTrue(cache.has_sent("!room1:test", "@user:test", "$ev1"))
+        self.assertEqual(cache.get_changed_rooms()["!room0:test"], "")
+
+        # reloading the persisted form keeps the bound
+        cache = LazyLoadedMembersCache(cache.get_changed_rooms())
+        cache.mark_sent("!other:test", "@user:test", "$other")
+        self.assertTrue(cache.has_sent("!other:test", "@user:test", "$other"))
+        self.assertEqual(
+            sum(len(members) for members in cache._rooms.values()),
+            LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE,
+        )
@@ -73,6 +73,8 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
                     "set_received_txn_response",
                     "get_destination_retry_timings",
                     "get_devices_by_remote",
+                    "get_destination_last_successful_stream_ordering",
+                    "get_catch_up_outstanding_destinations",
                     # Bits that user_directory needs
                     "get_user_directory_stream_pos",
                     "get_current_state_deltas",
@@ -104,6 +106,13 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
 
         self.datastore.get_devices_by_remote.return_value = (0, [])
 
+        self.datastore.get_destination_last_successful_stream_ordering.return_value = (
+            defer.succeed(None)
+        )
+        self.datastore.get_catch_up_outstanding_destinations.return_value = (
+            defer.succeed([])
+        )
+
         def get_received_txn_response(*args):
             return defer.succeed(None)
 
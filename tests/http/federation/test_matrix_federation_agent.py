@@ -29,6 +29,8 @@ from twisted.web.iweb import IPolicyForHTTPS
 
 from synapse.crypto.context_factory import ClientTLSOptionsFactory
 from synapse.http.federation.matrix_federation_agent import (
+    WELL_KNOWN_MAX_STALE_PERIOD,
+    WELL_KNOWN_REFRESH_RETRY_PERIOD,
     MatrixFederationAgent,
     _cache_period_from_headers,
 )
@@ -51,9 +53,11 @@ class MatrixFederationAgentTests(TestCase):
 
         self.well_known_cache = TTLCache("test_cache", timer=self.reactor.seconds)
 
+        self.tls_factory = ClientTLSOptionsFactory(None)
+
         self.agent = MatrixFederationAgent(
             reactor=self.reactor,
-            tls_client_options_factory=ClientTLSOptionsFactory(None),
+            tls_client_options_factory=self.tls_factory,
             _well_known_tls_policy=TrustingTLSPolicyForHTTPS(),
             _srv_resolver=self.mock_resolver,
             _well_known_cache=self.well_known_cache,
@@ -125,6 +129,7 @@ class MatrixFederationAgentTests(TestCase):
 
     def _handle_well_known_connection(
         self, client_factory, expected_sni, content, response_headers={},
+        response_code=200,
     ):
         """Handle an outgoing HTTPs connection: wire it up to a server, check that the
         request is for a .well-known, and send the response.
@@ -133,6 +138,7 @@ class MatrixFederationAgentTests(TestCase):
             client_factory (IProtocolFactory): outgoing connection
             expected_sni (bytes): SNI that we expect the outgoing connection to send
             content (bytes): content to send back as the .well-known
+            response_code (int): HTTP status code to send back
         Returns:
             HTTPChannel: server impl
         """
@@ -144,10 +150,12 @@ class MatrixFederationAgentTests(TestCase):
         # check the .well-known request and send a response
         self.assertEqual(len(well_known_server.requests), 1)
         request = well_known_server.requests[0]
-        self._send_well_known_response(request, content, headers=response_headers)
+        self._send_well_known_response(
+            request, content, headers=response_headers, code=response_code,
+        )
         return well_known_server
 
-    def _send_well_known_response(self, request, content, headers={}):
+    def _send_well_known_response(self, request, content, headers={}, code=200):
         """Check that an incoming request looks like a valid .well-known request, and
         send back the response.
         """
@@ -158,6 +166,7 @@ class MatrixFederationAgentTests(TestCase):
             [b'testserv'],
         )
         # send back a response
+        request.setResponseCode(code)
         for k, v in headers.items():
             request.setHeader(k, v)
         request.write(content)
@@ -223,6 +232,56 @@ class MatrixFederationAgentTests(TestCase):
         json = self.successResultOf(treq.json_content(response))
         self.assertEqual(json, {"a": 1})
 
+    def _get_and_respond(self, http_server=None):
+        """Make a GET request, and respond to it from the given server, or a
+        newly connected one if None.
+
+        Returns:
+            HTTPChannel: the server which responded
+        """
+        test_d = self._make_get_request(b"matrix://testserv:8448/foo/bar")
+        if http_server is None:
+            http_server = self._make_connection(
+                self.reactor.tcpClients[-1][2], expected_sni=b"testserv",
+            )
+        self.reactor.pump((0.1,))
+
+        self.assertEqual(len(http_server.requests), 1)
+        request = http_server.requests[0]
+        request.write(b'{}')
+        request.finish()
+        self.reactor.pump((0.1,))
+
+        response = self.successResultOf(test_d)
+        self.successResultOf(treq.content(response))
+        self.reactor.pump((0.1,))
+
+        return http_server
+
+    def test_connection_reuse(self):
+        """
+        Test that connections are reused by later requests to the same server
+        until they time out
+        """
+        self.reactor.lookups["testserv"] = "1.2.3.4"
+        clients = self.reactor.tcpClients
+
+        http_server = self._get_and_respond()
+        self.assertEqual(len(clients), 1)
+
+        # the TLS session has been kept for later connections to resume
+        self.assertIsNotNone(self.tls_factory._session_cache.get("testserv"))
+
+        # the next request goes over the same connection
+        self._get_and_respond(http_server)
+        self.assertEqual(len(clients), 1)
+
+        # once the connection has been idle for long enough it is closed, and a
+        # new one is opened
+        self.reactor.advance(2 * 60)
+        self._get_and_respond()
+        self.assertEqual(len(clients), 2)
+
     def test_get_ip_address(self):
         """
         Test the behaviour when the server name contains an explicit IP (with no port)
@@ -463,8 +522,8 @@ class MatrixFederationAgentTests(TestCase):
 
         self.assertEqual(self.well_known_cache[b"testserv"], b"target-server")
 
-        # check the cache expires
-        self.reactor.pump((25 * 3600,))
+        # check the cache expires, once it has been stale for long enough
+        self.reactor.pump((25 * 3600 + WELL_KNOWN_MAX_STALE_PERIOD,))
         self.well_known_cache.expire()
         self.assertNotIn(b"testserv", self.well_known_cache)
 
@@ -555,8 +614,8 @@ class MatrixFederationAgentTests(TestCase):
 
         self.assertEqual(self.well_known_cache[b"testserv"], b"target-server")
 
-        # check the cache expires
-        self.reactor.pump((25 * 3600,))
+        # check the cache expires, once it has been stale for long enough
+        self.reactor.pump((25 * 3600 + WELL_KNOWN_MAX_STALE_PERIOD,))
         self.well_known_cache.expire()
         self.assertNotIn(b"testserv", self.well_known_cache)
 
@@ -873,8 +932,11 @@ class MatrixFederationAgentTests(TestCase):
         # expire the cache
         self.reactor.pump((10.0,))
 
-        # now it should connect again
+        # now the cached result is stale: it is still returned, but it is
+        # refreshed in the background
         fetch_d = self.do_get_well_known(b'testserv')
+        r = self.successResultOf(fetch_d)
+        self.assertEqual(r, b'target-server')
 
         self.assertEqual(len(clients), 1)
         (host, port, client_factory, _timeout, _bindAddress) = clients.pop(0)
@@ -887,8 +949,58 @@ class MatrixFederationAgentTests(TestCase):
             content=b'{ "m.server": "other-server" }',
         )
 
+        # the next request gets the new result
+        fetch_d = self.do_get_well_known(b'testserv')
         r = self.successResultOf(fetch_d)
         self.assertEqual(r, b'other-server')
+        self.assertEqual(len(clients), 0)
+
+    def test_well_known_kept_when_refresh_fails(self):
+        self.reactor.lookups["testserv"] = "1.2.3.4"
+
+        fetch_d = self.do_get_well_known(b'testserv')
+
+        clients = self.reactor.tcpClients
+        (host, port, client_factory, _timeout, _bindAddress) = clients.pop(0)
+        self._handle_well_known_connection(
+            client_factory,
+            expected_sni=b"testserv",
+            response_headers={b'Cache-Control': b'max-age=10'},
+            content=b'{ "m.server": "target-server" }',
+        ).loseConnection()
+        self.assertEqual(self.successResultOf(fetch_d), b'target-server')
+
+        # expire the cache, so that the next request triggers a refresh
+        self.reactor.pump((10.0,))
+        fetch_d = self.do_get_well_known(b'testserv')
+        self.assertEqual(self.successResultOf(fetch_d), b'target-server')
+
+        # the refresh can't reach the server
+        self.assertEqual(len(clients), 1)
+        (host, port, client_factory, _timeout, _bindAddress) = clients.pop(0)
+        client_factory.clientConnectionFailed(None, Exception("nope"))
+        self.reactor.pump((0.4,))
+
+        # we keep using the stale result, and don't try again for a while
+        fetch_d = self.do_get_well_known(b'testserv')
+        self.assertEqual(self.successResultOf(fetch_d), b'target-server')
+        self.assertEqual(len(clients), 0)
+
+        self.reactor.pump((WELL_KNOWN_REFRESH_RETRY_PERIOD,))
+        fetch_d = self.do_get_well_known(b'testserv')
+        self.assertEqual(self.successResultOf(fetch_d), b'target-server')
+        self.assertEqual(len(clients), 1)
+
+        # a 404 does replace the stale result
+        (host, port, client_factory, _timeout, _bindAddress) = clients.pop(0)
+        self._handle_well_known_connection(
+            client_factory,
+            expected_sni=b"testserv",
+            content=b'',
+            response_code=404,
+        )
+        fetch_d = self.do_get_well_known(b'testserv')
+        self.assertIsNone(self.successResultOf(fetch_d))
 
 
 class TestCachePeriodFromHeaders(TestCase):
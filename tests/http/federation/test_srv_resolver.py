@@ -21,7 +21,11 @@ from twisted.internet.defer import Deferred
 from twisted.internet.error import ConnectError
 from twisted.names import dns, error
 
-from synapse.http.federation.srv_resolver import SrvResolver
+from synapse.http.federation.srv_resolver import (
+    SRV_NEGATIVE_CACHE_PERIOD,
+    Server,
+    SrvResolver,
+)
 from synapse.util.logcontext import LoggingContext
 
 from tests import unittest
@@ -205,3 +209,101 @@ class SrvResolverTestCase(unittest.TestCase):
         self.assertEquals(len(servers), 1)
         self.assertEquals(servers, cache[service_name])
         self.assertEquals(servers[0].host, b"host")
+
+    def test_stale_results_refreshed_in_background(self):
+        clock = MockClock()
+        service_name = b"test_service.example.com"
+
+        lookup_deferred = Deferred()
+        dns_client_mock = Mock()
+        dns_client_mock.lookupService.return_value = lookup_deferred
+
+        stale_servers = [Server(host=b"old", port=8448, expires=clock.time() - 1)]
+        cache = {service_name: stale_servers}
+        resolver = SrvResolver(
+            dns_client=dns_client_mock, cache=cache, get_time=clock.time,
+        )
+
+        # the stale result is returned straight away, and a refresh started
+        servers = self.successResultOf(resolver.resolve_service(service_name))
+        self.assertEquals(servers, stale_servers)
+        dns_client_mock.lookupService.assert_called_once_with(service_name)
+
+        # only one refresh happens at a time
+        self.successResultOf(resolver.resolve_service(service_name))
+        self.assertEquals(dns_client_mock.lookupService.call_count, 1)
+
+        lookup_deferred.callback((
+            [dns.RRHeader(
+                type=dns.SRV, ttl=60, payload=dns.Record_SRV(target=b"new"),
+            )],
+            None,
+            None,
+        ))
+
+        servers = self.successResultOf(resolver.resolve_service(service_name))
+        self.assertEquals([s.host for s in servers], [b"new"])
+        self.assertEquals(dns_client_mock.lookupService.call_count, 1)
+
+    def test_name_error_cached(self):
+        clock = MockClock()
+        service_name = b"test_service.example.com"
+
+        dns_client_mock = Mock()
+        dns_client_mock.lookupService.side_effect = lambda _: defer.fail(
+            error.DNSNameError(),
+        )
+
+        resolver = SrvResolver(
+            dns_client=dns_client_mock, cache={}, get_time=clock.time,
+        )
+
+        self.assertEquals(
+            self.successResultOf(resolver.resolve_service(service_name)), [],
+        )
+        self.assertEquals(
+            self.successResultOf(resolver.resolve_service(service_name)), [],
+        )
+        self.assertEquals(dns_client_mock.lookupService.call_count, 1)
+
+        # once the negative result expires, it is refreshed
+        clock.advance_time(SRV_NEGATIVE_CACHE_PERIOD)
+        self.successResultOf(resolver.resolve_service(service_name))
+        self.assertEquals(dns_client_mock.lookupService.call_count, 2)
+
+    def test_persisted_results(self):
+        clock = MockClock()
+        service_name = b"test_service.example.com"
+
+        store = Mock()
+        store.get_server_resolutions.return_value = defer.succeed([
+            (
+                service_name.decode("ascii"),
+                [["persisted", 8448, 0, 0]],
+                (clock.time() + 100) * 1000,
+            ),
+        ])
+
+        dns_client_mock = Mock()
+        resolver = SrvResolver(
+            dns_client=dns_client_mock, cache={}, get_time=clock.time, store=store,
+        )
+
+        servers = self.successResultOf(resolver.resolve_service(service_name))
+        self.assertEquals([(s.host, s.port) for s in servers], [(b"persisted", 8448)])
+        self.assertFalse(dns_client_mock.lookupService.called)
+
+        # new results are stored
+        dns_client_mock.lookupService.return_value = defer.succeed((
+            [dns.RRHeader(
+                type=dns.SRV, ttl=60,
+                payload=dns.Record_SRV(target=b"new", port=1234),
+            )],
+            None,
+            None,
+        ))
+        self.successResultOf(resolver.resolve_service(b"other.example.com"))
+        store.store_server_resolution.assert_called_once_with(
+            "srv", "other.example.com", [("new", 1234, 0, 0)],
+            (clock.time() + 60) * 1000,
+        )
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.push import push_tools
+from synapse.push.badge_counter import BadgeCounter
+from synapse.rest.client.v1 import admin, login, room
+from synapse.util.logcontext import make_deferred_yieldable
+
+from tests.unittest import HomeserverTestCase
+
+
+class BadgeCounterTestCase(HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.badge_counter = BadgeCounter(hs)
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+        self.other_tok = self.login(self.register_user("other", "pass"), "pass")
+        other_user_id = "@other:test"
+
+        self.room_ids = []
+        for i in range(3):
+            room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+            self.helper.invite(room_id, self.user_id, other_user_id, tok=self.tok)
+            self.helper.join(room_id, other_user_id, tok=self.other_tok)
+            self.room_ids.append(room_id)
+
+            event_id = self._send(room_id)
+            if i > 0:
+                self._send_receipt(room_id, event_id)
+
+        # the last room has an unread message
+        self._send(self.room_ids[2])
+
+    def _send(self, room_id):
+        return self.helper.send(room_id, tok=self.other_tok)["event_id"]
+
+    def _send_receipt(self, room_id, event_id):
+        self.get_success(
+            self.store.insert_receipt(
+                room_id, "m.read", self.user_id, [event_id], {},
+            )
+        )
+        self.get_success(
+            self.badge_counter.on_new_receipts(
+                [(room_id, "m.read", self.user_id, event_id)]
+            )
+        )
+
+    def _assert_badge_count(self, expected):
+        badge = self.get_success(self.badge_counter.get_badge_count(self.user_id))
+        self.assertEqual(badge, expected)
+
+    def test_badge_count_is_maintained(self):
+        self._assert_badge_count(1)
+        self.assertEqual(
+            self.get_success(push_tools.get_badge_count(self.store, self.user_id)), 1,
+        )
+
+        # from now on we shouldn't need to recalculate the unread rooms
+        self.store.get_unread_event_push_actions_by_rooms_for_user = Mock(
+            side_effect=AssertionError("recalculated unread rooms"),
+        )
+
+        # a new message in a read room
+        max_stream_ordering = self.get_success(
+            self.store.get_latest_push_action_stream_ordering()
+        )
+        self._send(self.room_ids[1])
+        self.badge_counter.on_new_notifications(
+            self.get_success(
+                self.store.get_push_action_users_and_rooms_in_range(
+                    max_stream_ordering + 1, max_stream_ordering + 100,
+                )
+            )
+        )
+        self._assert_badge_count(2)
+
+        # reading the last room
+        event_id = self._send(self.room_ids[2])
+        self._send_receipt(self.room_ids[2], event_id)
+        self._assert_badge_count(1)
+
+    def test_update_during_calculation(self):
+        calculate = self.store.get_unread_event_push_actions_by_rooms_for_user
+        pending = []
+
+        def get_unread(room_ids, user_id):
+            d = defer.Deferred()
+            pending.append(d)
+            d.addCallback(lambda _: calculate(room_ids, user_id))
+            return make_deferred_yieldable(d)
+
+        self.store.get_unread_event_push_actions_by_rooms_for_user = Mock(
+            side_effect=get_unread,
+        )
+
+        # a notification arriving while we calculate means the result may be
+        # stale, so it isn't cached
+        d = self.badge_counter.get_badge_count(self.user_id)
+        self.pump()
+        self.badge_counter.on_new_notifications([(self.user_id, self.room_ids[0])])
+        pending.pop().callback(None)
+        self.assertEqual(self.get_success(d), 1)
+
+        d = self.badge_counter.get_badge_count(self.user_id)
+        self.pump()
+        self.assertEqual(len(pending), 1)
+        pending.pop().callback(None)
+        self.assertEqual(self.get_success(d), 1)
+
+        # ... but otherwise it is
+        self._assert_badge_count(1)
+        self.assertEqual(pending, [])
+
+    def test_notification_during_receipt(self):
+        self._assert_badge_count(1)
+
+        event_id = self._send(self.room_ids[0])
+        self.get_success(
+            self.store.insert_receipt(
+                self.room_ids[0], "m.read", self.user_id, [event_id], {},
+            )
+        )
+
+        unread_d = defer.Deferred()
+        self.store.get_unread_event_push_actions_by_room_for_user = Mock(
+            return_value=make_deferred_yieldable(unread_d),
+        )
+
+        # a new message arrives while we are working out the effect of the
+        # receipt, so the result of that may be stale
+        receipts_d = self.badge_counter.on_new_receipts(
+            [(self.room_ids[0], "m.read", self.user_id, event_id)]
+        )
+        self.pump()
+        self._send(self.room_ids[0])
+        self.badge_counter.on_new_notifications([(self.user_id, self.room_ids[0])])
+
+        unread_d.callback({"notify_count": 0, "highlight_count": 0})
+        self.get_success(receipts_d)
+
+        del self.store.get_unread_event_push_actions_by_room_for_user
+        self._assert_badge_count(2)
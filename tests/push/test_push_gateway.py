@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet.defer import Deferred
+
+from synapse.util.logcontext import make_deferred_yieldable
+
+from tests.unittest import HomeserverTestCase
+
+URL = "https://push.example.com/_matrix/push/v1/notify"
+
+
+def _notification(event_id, *pushkeys):
+    return {
+        "notification": {
+            "event_id": event_id,
+            "room_id": "!room:test",
+            "counts": {"unread": 1},
+            "devices": [
+                {"app_id": "m.http", "pushkey": pushkey} for pushkey in pushkeys
+            ],
+        },
+    }
+
+
+class PushGatewayClientTestCase(HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        self.push_attempts = []
+
+        m = Mock()
+
+        def post_json_get_json(url, body):
+            d = Deferred()
+            self.push_attempts.append((d, url, body))
+            return make_deferred_yieldable(d)
+
+        m.post_json_get_json = post_json_get_json
+
+        config = self.default_config()
+        config.push_gateway_max_concurrent_requests = 1
+        config.push_gateway_batch_window_ms = 50
+
+        return self.setup_test_homeserver(config=config, simple_http_client=m)
+
+    def prepare(self, reactor, clock, hs):
+        self.client = hs.get_pusherpool().push_gateway_client
+
+    def test_coalesces_devices(self):
+        d1 = self.client.send_notification(URL, _notification("$1", "pk1"))
+        d2 = self.client.send_notification(URL, _notification("$1", "pk2", "pk3"))
+        d3 = self.client.send_notification(URL, _notification("$2", "pk4"))
+
+        # nothing is sent until the window has passed
+        self.pump()
+        self.assertEqual(self.push_attempts, [])
+        self.reactor.advance(0.05)
+
+        # the notifications for $1 go in one request, and the one for $2 waits
+        # for it to finish
+        self.assertEqual(len(self.push_attempts), 1)
+        d, url, body = self.push_attempts[0]
+        self.assertEqual(url, URL)
+        self.assertEqual(body, _notification("$1", "pk1", "pk2", "pk3"))
+
+        d.callback({"rejected": ["pk3"]})
+        self.assertEqual(self.successResultOf(d1), [])
+        self.assertEqual(self.successResultOf(d2), ["pk3"])
+
+        self.pump()
+        self.assertEqual(len(self.push_attempts), 2)
+        d, url, body = self.push_attempts[1]
+        self.assertEqual(body, _notification("$2", "pk4"))
+
+        d.callback({})
+        self.assertEqual(self.successResultOf(d3), [])
+
+    def test_failure_is_passed_on(self):
+        d1 = self.client.send_notification(URL, _notification("$1", "pk1"))
+        d2 = self.client.send_notification(URL, _notification("$1", "pk2"))
+        self.reactor.advance(0.05)
+
+        self.push_attempts[0][0].errback(Exception("gateway down"))
+        self.failureResultOf(d1, Exception)
+        self.failureResultOf(d2, Exception)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.events import FrozenEvent
+from synapse.push.baserules import list_with_base_rules
+from synapse.push.push_rule_evaluator import (
+    DisplayNameMatcher,
+    PushRuleEvaluatorForEvent,
+    compile_push_rules,
+)
+
+from tests import unittest
+
+USERS = {
+    "@alice:test": "Alice",
+    "@bob:test": "Bob",
+    "@carol:test": None,
+}
+
+
+def _make_message(body):
+    return FrozenEvent({
+        "event_id": "$1:test",
+        "type": "m.room.message",
+        "room_id": "!room:test",
+        "sender": "@sender:test",
+        "content": {"msgtype": "m.text", "body": body},
+    })
+
+
+def _naive_actions(evaluator, rules, user_id, display_name):
+    """Evaluate the rules for a single user, without any sharing"""
+    for rule in rules:
+        if 'enabled' in rule and not rule['enabled']:
+            continue
+        if all(
+            evaluator.matches(c, user_id, display_name) for c in rule['conditions']
+        ):
+            actions = [x for x in rule['actions'] if x != 'dont_notify']
+            if actions and 'notify' in actions:
+                return actions
+            return None
+    return None
+
+
+class CompiledPushRulesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rules = list_with_base_rules([])
+
+    def _check_matches_naive(self, event, room_member_count):
+        evaluator = PushRuleEvaluatorForEvent(event, room_member_count, 0, {})
+
+        compiled = compile_push_rules(self.rules)
+        actions_by_user = compiled.actions_for_users(
+            evaluator, list(USERS), USERS, {},
+        )
+
+        for user_id, display_name in USERS.items():
+            expected = _naive_actions(evaluator, self.rules, user_id, display_name)
+            self.assertEqual(actions_by_user.get(user_id), expected, user_id)
+
+        return actions_by_user
+
+    def test_identical_rules_are_shared(self):
+        self.assertIs(
+            compile_push_rules(self.rules),
+            compile_push_rules(list_with_base_rules([])),
+        )
+
+    def test_display_name_mention(self):
+        actions_by_user = self._check_matches_naive(
+            _make_message("hello bob, how are you?"), 10,
+        )
+        self.assertIn({"set_tweak": "highlight"}, actions_by_user["@bob:test"])
+        self.assertNotIn({"set_tweak": "highlight"}, actions_by_user["@alice:test"])
+
+    def test_user_localpart_mention(self):
+        actions_by_user = self._check_matches_naive(_make_message("carol: hi"), 10)
+        self.assertIn({"set_tweak": "highlight"}, actions_by_user["@carol:test"])
+
+    def test_one_to_one_room(self):
+        self._check_matches_naive(_make_message("hi"), 2)
+
+    def test_disabled_rule(self):
+        self.rules = list_with_base_rules([])
+        for rule in self.rules:
+            if rule["rule_id"] == "global/underride/.m.rule.message":
+                rule["enabled"] = False
+
+        actions_by_user = self._check_matches_naive(
+            _make_message("hello alice"), 10,
+        )
+        self.assertEqual(list(actions_by_user), ["@alice:test"])
+
+
+class DisplayNameMatcherTestCase(unittest.TestCase):
+    NAMES = [
+        "Alice", "alice", "Bob", "Bob Smith", "bob's bot", "[bot] eve",
+        "d*ve", "Zoë", "mallory", u"\u0130pek", "sam", u"\u03c3\u03bf\u03c6\u03af\u03b1",
+    ]
+
+    def _check_matches_regex(self, matcher, body):
+        event = _make_message(body)
+        per_name = PushRuleEvaluatorForEvent(event, 10, 0, {})
+        mentioned = matcher.find_mentions(body)
+        for name in self.NAMES:
+            if name not in matcher:
+                continue
+            self.assertEqual(
+                name in mentioned,
+                bool(per_name.matches(
+                    {"kind": "contains_display_name"}, None, name,
+                )),
+                "%s in %r" % (name, body),
+            )
+        return mentioned
+
+    def test_find_mentions(self):
+        matcher = DisplayNameMatcher()
+        for name in self.NAMES:
+            matcher.add(name)
+
+        for body in [
+            "hi ALICE",
+            "alicex and bob",
+            "bob smith: hello",
+            "bob's bot is broken",
+            "ping [bot] eve, dave",
+            "zoë?",
+            "nobody here",
+        ]:
+            self._check_matches_regex(matcher, body)
+
+    def test_find_mentions_case_folding(self):
+        """Names are found if they match case-insensitively, even where
+        lowercasing them gives different results.
+        """
+        matcher = DisplayNameMatcher()
+        for name in self.NAMES:
+            matcher.add(name)
+
+        for body, expected in [
+            (u"ipek hi", {u"\u0130pek"}),
+            (u"\u017fam?", {"sam"}),
+            (u"\u03a3\u03bf\u03c6\u03af\u03b1 and \u03c2\u03bf\u03c6\u03af\u03b1",
+             {u"\u03c3\u03bf\u03c6\u03af\u03b1"}),
+        ]:
+            self.assertEqual(self._check_matches_regex(matcher, body), expected)
+
+        self.assertEqual(
+            self._check_matches_regex(matcher, "bob smith: ping dave"),
+            {"Bob", "Bob Smith", "d*ve"},
+        )
+
+    def test_remove(self):
+        matcher = DisplayNameMatcher()
+        matcher.add("Bob")
+        matcher.add("Bob")
+        matcher.add("Bob Smith")
+
+        matcher.remove("Bob")
+        self.assertEqual(matcher.find_mentions("bob smith"), {"Bob", "Bob Smith"})
+
+        matcher.remove("Bob")
+        matcher.remove("Bob Smith")
+        self.assertNotIn("Bob", matcher)
+        self.assertEqual(len(matcher), 0)
+        self.assertEqual(matcher.find_mentions("bob smith"), set())
+
+    def test_evaluator_uses_matcher(self):
+        matcher = DisplayNameMatcher()
+        matcher.add("Bob")
+
+        evaluator = PushRuleEvaluatorForEvent(
+            _make_message("hi bob and alice"), 10, 0, {},
+            display_name_matcher=matcher,
+        )
+        condition = {"kind": "contains_display_name"}
+        self.assertTrue(evaluator.matches(condition, None, "Bob"))
+        self.assertFalse(evaluator.matches(condition, None, "Carol"))
+
+        # names which the matcher doesn't know about are checked directly
+        self.assertTrue(evaluator.matches(condition, None, "Alice"))
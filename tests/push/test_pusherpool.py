@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from synapse.push.pusherpool import get_pusher_shard_for_user
+from synapse.rest.client.v1 import admin, login
+
+from tests.unittest import HomeserverTestCase
+
+
+class PusherShardingTestCase(HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.start_pushers = True
+        config.worker_pusher_shard_count = 2
+        config.worker_pusher_shard_index = 1
+
+        return self.setup_test_homeserver(
+            config=config, simple_http_client=Mock(),
+        )
+
+    def test_shards_are_stable(self):
+        user_ids = ["@user%i:test" % (i,) for i in range(100)]
+        shards = [get_pusher_shard_for_user(u, 2) for u in user_ids]
+
+        # both shards get some users...
+        self.assertEqual(set(shards), {0, 1})
+        # ... and every user is always in the same one
+        self.assertEqual(shards, [get_pusher_shard_for_user(u, 2) for u in user_ids])
+        self.assertEqual(
+            set(get_pusher_shard_for_user(u, 1) for u in user_ids), {0},
+        )
+
+    def _add_pusher(self, localpart):
+        user_id = self.register_user(localpart, "pass")
+        access_token = self.login(localpart, "pass")
+        user_tuple = self.get_success(
+            self.hs.get_datastore().get_user_by_access_token(access_token)
+        )
+        self.get_success(
+            self.hs.get_pusherpool().add_pusher(
+                user_id=user_id,
+                access_token=user_tuple["token_id"],
+                kind="http",
+                app_id="m.http",
+                app_display_name="HTTP Push Notifications",
+                device_display_name="pushy push",
+                pushkey="%s@example.com" % (localpart,),
+                lang=None,
+                data={"url": "example.com"},
+            )
+        )
+        return user_id
+
+    def test_only_starts_pushers_in_shard(self):
+        pool = self.hs.get_pusherpool()
+
+        user_ids = [self._add_pusher("user%i" % (i,)) for i in range(10)]
+        ours = [u for u in user_ids if get_pusher_shard_for_user(u, 2) == 1]
+        self.assertTrue(0 < len(ours) < len(user_ids))
+
+        self.assertEqual(set(pool.pushers), set(ours))
+
+        # restarting the pushers from the database respects the shards too
+        pool.pushers = {}
+        self.get_success(pool._start_pushers())
+        self.assertEqual(set(pool.pushers), set(ours))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from synapse.replication.tcp.commands import FederationAckCommand
+from synapse.replication.tcp.resource import ReplicationStreamProtocolFactory
+
+from tests import unittest
+
+
+class FederationAckCommandTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        for token, shard_index in ((5, 0), (7, 2)):
+            cmd = FederationAckCommand.from_line(
+                FederationAckCommand(token, shard_index).to_line(),
+            )
+            self.assertEqual((cmd.token, cmd.shard_index), (token, shard_index))
+
+    def test_no_shard_index(self):
+        cmd = FederationAckCommand.from_line("12")
+        self.assertEqual((cmd.token, cmd.shard_index), (12, 0))
+
+
+class FederationAckTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.send_federation = False
+        config.worker_federation_sender_shard_count = 2
+
+        self.federation_sender = Mock()
+        return self.setup_test_homeserver(
+            config=config, federation_sender=self.federation_sender,
+        )
+
+    def prepare(self, reactor, clock, hs):
+        self.streamer = ReplicationStreamProtocolFactory(hs).streamer
+
+    def test_waits_for_all_shards(self):
+        self.streamer.federation_ack(0, 10)
+        self.federation_sender.federation_ack.assert_not_called()
+
+        self.streamer.federation_ack(1, 5)
+        self.federation_sender.federation_ack.assert_called_once_with(5)
+
+        self.streamer.federation_ack(1, 20)
+        self.federation_sender.federation_ack.assert_called_with(10)
+
+    def test_keeps_ack_after_disconnect(self):
+        self.streamer.federation_ack(0, 10)
+        self.streamer.lost_connection(Mock())
+
+        self.streamer.federation_ack(1, 20)
+        self.federation_sender.federation_ack.assert_called_once_with(10)
+
+    def test_ignores_unknown_shard(self):
+        self.streamer.federation_ack(0, 10)
+        self.streamer.federation_ack(2, 20)
+        self.federation_sender.federation_ack.assert_not_called()
@@ -13,7 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+
 from mock import Mock
+from six.moves.urllib.parse import quote
 
 from synapse.rest.client.v1 import admin, login, room
 from synapse.rest.client.v2_alpha import sync
@@ -188,3 +191,64 @@ class SyncTypingTests(unittest.HomeserverTestCase):
             "GET", sync_url % (access_token, next_batch)
         )
         self.assertRaises(TimedOutException, self.render, request)
+
+
+class SyncLazyLoadedMembersTests(unittest.HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+        sync.register_servlets,
+    ]
+    user_id = True
+    hijack_auth = False
+
+    def test_lazy_loaded_members_survive_restart(self):
+        """
+        Members which have already been sent to a device are not sent again
+        after the synchrotron forgets its in-memory cache (e.g. because it
+        restarted, or the device's syncs moved to another synchrotron).
+        """
+        sync_filter = quote(json.dumps({
+            "room": {"state": {"lazy_load_members": True}},
+        }))
+        sync_url = "/sync?filter=" + sync_filter + "&access_token="
+
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass", device_id="DEVICE")
+
+        other_user_id = self.register_user("otheruser", "pass")
+        other_access_token = self.login("otheruser", "pass")
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self.helper.invite(room=room, src=user_id, tok=access_token, targ=other_user_id)
+        self.helper.join(room=room, user=other_user_id, tok=other_access_token)
+        self.helper.send(room, body="Hi!", tok=other_access_token)
+
+        request, channel = self.make_request("GET", sync_url + access_token)
+        self.render(request)
+        self.assertEquals(200, channel.code)
+        next_batch = channel.json_body["next_batch"]
+
+        self.helper.send(room, body="There!", tok=other_access_token)
+
+        # Forget everything we had in memory
+        sync_handler = self.hs.get_sync_handler()
+        sync_handler.lazy_loaded_members_cache.pop((user_id, "DEVICE"))
+
+        request, channel = self.make_request(
+            "GET", (sync_url + access_token) + "&since=" + next_batch,
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+        self.assertEqual(
+            self._get_member_state_keys(channel.json_body, room), set(),
+        )
+
+    def _get_member_state_keys(self, sync_body, room_id):
+        state = sync_body["rooms"]["join"][room_id]["state"]["events"]
+        return set(
+            event["state_key"] for event in state
+            if event["type"] == "m.room.member"
+        )
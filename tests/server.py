@@ -120,6 +120,7 @@ class FakeSite:
     server_version_string = b"1"
     site_tag = "test"
     access_logger = logging.getLogger("synapse.access.http.fake")
+    log_phase_breakdown = False
 
 
 def make_request(
@@ -254,6 +255,9 @@ class ThreadedMemoryReactorClock(MemoryReactorClock):
         self.callLater(0, d.callback, True)
         return d
 
+    def getThreadPool(self):
+        return self.threadpool
+
 
 def setup_test_homeserver(cleanup_func, *args, **kwargs):
     """
@@ -314,6 +318,7 @@ def setup_test_homeserver(cleanup_func, *args, **kwargs):
             return d
 
     clock.threadpool = ThreadPool()
+    clock._reactor.threadpool = ThreadPool()
 
     if pool:
         pool.runWithConnection = runWithConnection
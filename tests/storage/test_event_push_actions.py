@@ -17,6 +17,8 @@ from mock import Mock
 
 from twisted.internet import defer
 
+from synapse.rest.client.v1 import admin, login, room
+
 import tests.unittest
 import tests.utils
 
@@ -196,3 +198,141 @@ class EventPushActionsStoreTestCase(tests.unittest.TestCase):
         yield add_event(0, 5)
         r = yield self.store.find_first_stream_ordering_after_ts(1)
         self.assertEqual(r, 0)
+
+
+class StreamingNotifRotationTestCase(tests.unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        config = tests.utils.default_config("test")
+        config.push_notif_rotation_chunk_size = 2
+        hs = yield tests.utils.setup_test_homeserver(self.addCleanup, config=config)
+        self.store = hs.get_datastore()
+
+    @defer.inlineCallbacks
+    def _inject_action(self, stream):
+        event = Mock()
+        event.room_id = "!foo:example.com"
+        event.event_id = "$test%i:example.com" % (stream,)
+        event.internal_metadata.stream_ordering = stream
+        event.depth = stream
+
+        yield self.store.add_push_actions_to_staging(
+            event.event_id, {USER_ID: PlAIN_NOTIF}
+        )
+        yield self.store.runInteraction(
+            "",
+            self.store._set_push_actions_for_event_and_users_txn,
+            [(event, None)],
+            [(event, None)],
+        )
+
+    @defer.inlineCallbacks
+    def _get_unrotated_stream_orderings(self):
+        rows = yield self.store._simple_select_onecol(
+            table="event_push_actions",
+            keyvalues={},
+            retcol="stream_ordering",
+        )
+        defer.returnValue(sorted(rows))
+
+    @defer.inlineCallbacks
+    def test_rotates_one_chunk_at_a_time(self):
+        for stream in range(1, 6):
+            yield self._inject_action(stream)
+
+        self.store.stream_ordering_day_ago = 10
+
+        # the lag is known before the first rotation
+        self.assertEqual(self.store._get_notif_rotation_lag(), 10)
+
+        yield self.store._rotate_notifs()
+        unrotated = yield self._get_unrotated_stream_orderings()
+        self.assertEqual(unrotated, [3, 4, 5])
+        self.assertEqual(self.store._get_notif_rotation_lag(), 7)
+
+        yield self.store._rotate_notifs()
+        unrotated = yield self._get_unrotated_stream_orderings()
+        self.assertEqual(unrotated, [])
+        self.assertEqual(self.store._get_notif_rotation_lag(), 0)
+
+        counts = yield self.store.runInteraction(
+            "", self.store._get_unread_counts_by_pos_txn,
+            "!foo:example.com", USER_ID, 0,
+        )
+        self.assertEqual(counts, {"notify_count": 5, "highlight_count": 0})
+
+
+class UnreadCountsForRoomsTestCase(tests.unittest.HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+        other_user_id = self.register_user("other", "pass")
+        other_tok = self.login("other", "pass")
+
+        # Create some rooms with different numbers of messages after the
+        # user's read receipt, and one room with no read receipt at all.
+        self.room_ids = []
+        for i in range(4):
+            room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+            self.helper.invite(room_id, self.user_id, other_user_id, tok=self.tok)
+            self.helper.join(room_id, other_user_id, tok=other_tok)
+
+            event_id = self.helper.send(room_id, body="read", tok=other_tok)["event_id"]
+            if i > 0:
+                self._send_receipt(room_id, event_id)
+
+            for j in range(i):
+                self.helper.send(room_id, body="unread %d" % (j,), tok=other_tok)
+            self.room_ids.append(room_id)
+
+    def _send_receipt(self, room_id, event_id):
+        self.get_success(
+            self.store.insert_receipt(
+                room_id, "m.read", self.user_id, [event_id], {},
+            )
+        )
+
+    def test_matches_single_room_counts(self):
+        receipts_by_room = self.get_success(
+            self.store.get_receipts_for_user(self.user_id, "m.read")
+        )
+        expected = {}
+        for room_id in self.room_ids:
+            if room_id not in receipts_by_room:
+                continue
+            expected[room_id] = self.get_success(
+                self.store.get_unread_event_push_actions_by_room_for_user(
+                    room_id, self.user_id, receipts_by_room[room_id],
+                )
+            )
+
+        # forget the cached counts, so that they get recalculated in bulk
+        self.store.get_unread_event_push_actions_by_room_for_user.invalidate_all()
+
+        counts = self.get_success(
+            self.store.get_unread_event_push_actions_by_rooms_for_user(
+                self.room_ids, self.user_id,
+            )
+        )
+        self.assertEqual(counts, expected)
+        self.assertEqual(
+            [counts[room_id]["notify_count"] for room_id in self.room_ids[1:]],
+            [1, 2, 3],
+        )
+
+        # and again, now that the counts are cached
+        counts = self.get_success(
+            self.store.get_unread_event_push_actions_by_rooms_for_user(
+                self.room_ids, self.user_id,
+            )
+        )
+        self.assertEqual(counts, expected)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.api.filtering import Filter
+from synapse.rest.client.v1 import room
+
+from tests.unittest import HomeserverTestCase
+
+
+class RecentEventsForRoomsTestCase(HomeserverTestCase):
+
+    user_id = "@red:server"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        hs = self.setup_test_homeserver("server", http_client=None)
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        self.room_ids = []
+        for i in range(3):
+            room_id = self.helper.create_room_as(self.user_id)
+            for j in range(i * 2):
+                self.helper.send(room_id, body="test%d" % (j,))
+            self.room_ids.append(room_id)
+
+    def test_matches_single_room_query(self):
+        """
+        The batched query returns the same events and tokens as querying each
+        room in turn.
+        """
+        end_token = self.get_success(self.store.get_room_events_max_id())
+
+        batched = self.get_success(
+            self.store.get_recent_events_for_rooms(
+                self.room_ids, limit=5, end_token=end_token,
+            )
+        )
+
+        self.assertEqual(set(batched), set(self.room_ids))
+        for room_id in self.room_ids:
+            events, token = self.get_success(
+                self.store.get_recent_events_for_room(
+                    room_id, limit=5, end_token=end_token,
+                )
+            )
+
+            batched_events, batched_token = batched[room_id]
+            self.assertEqual(
+                [e.event_id for e in batched_events],
+                [e.event_id for e in events],
+            )
+            self.assertEqual(
+                [e.internal_metadata.before for e in batched_events],
+                [e.internal_metadata.before for e in events],
+            )
+            self.assertEqual(batched_token, token)
+
+    def test_event_filter(self):
+        """
+        The event filter is applied in the database, including wildcard types.
+        """
+        end_token = self.get_success(self.store.get_room_events_max_id())
+
+        batched = self.get_success(
+            self.store.get_recent_events_for_rooms(
+                self.room_ids, limit=20, end_token=end_token,
+                event_filter=Filter({"types": ["m.room.mess*"]}),
+            )
+        )
+
+        for i, room_id in enumerate(self.room_ids):
+            events, _ = batched[room_id]
+            self.assertEqual(len(events), i * 2)
+            for event in events:
+                self.assertEqual(event.type, "m.room.message")
+
+        batched = self.get_success(
+            self.store.get_recent_events_for_rooms(
+                self.room_ids, limit=20, end_token=end_token,
+                event_filter=Filter({"not_types": ["m.room.*"]}),
+            )
+        )
+
+        for room_id in self.room_ids:
+            events, _ = batched[room_id]
+            self.assertEqual(events, [])
+
+    def test_large_event_filter(self):
+        """
+        Filters with many values don't take the query over the limit on the
+        number of arguments.
+        """
+        end_token = self.get_success(self.store.get_room_events_max_id())
+
+        senders = ["@user%d:server" % (i,) for i in range(400)] + [self.user_id]
+        batched = self.get_success(
+            self.store.get_recent_events_for_rooms(
+                self.room_ids, limit=20, end_token=end_token,
+                event_filter=Filter({
+                    "senders": senders, "types": ["m.room.message"],
+                }),
+            )
+        )
+
+        for i, room_id in enumerate(self.room_ids):
+            events, _ = batched[room_id]
+            self.assertEqual(len(events), i * 2)
+
+    def test_event_filter_matches_python_filter(self):
+        """
+        Empty lists of allowed values and `contains_url: false` are applied in
+        the database the same way as in `Filter.check`.
+        """
+        end_token = self.get_success(self.store.get_room_events_max_id())
+
+        for definition in (
+            {"types": []},
+            {"senders": []},
+            {"contains_url": False},
+            {"contains_url": True},
+        ):
+            event_filter = Filter(definition)
+            batched = self.get_success(
+                self.store.get_recent_events_for_rooms(
+                    self.room_ids, limit=20, end_token=end_token,
+                )
+            )
+            filtered = self.get_success(
+                self.store.get_recent_events_for_rooms(
+                    self.room_ids, limit=20, end_token=end_token,
+                    event_filter=event_filter,
+                )
+            )
+
+            for room_id in self.room_ids:
+                self.assertEqual(
+                    [e.event_id for e in filtered[room_id][0]],
+                    [e.event_id for e in event_filter.filter(batched[room_id][0])],
+                )
@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from synapse.storage.transactions import SERVER_RESOLUTION_MAX_STALE_MS
+
 from tests.unittest import HomeserverTestCase
 
 
@@ -43,3 +45,52 @@ class TransactionStoreTestCase(HomeserverTestCase):
         """
         d = self.store.set_destination_retry_timings("example.com", 50, 100)
         self.get_success(d)
+
+    def test_server_resolutions(self):
+        """Tests that the results of server lookups can be stored and replaced,
+        and that expired ones are ignored.
+        """
+        self.get_success(self.store.store_server_resolution(
+            "well_known", "example.com", "target.example.com", 1000,
+        ))
+        self.get_success(self.store.store_server_resolution(
+            "well_known", "other.example.com", None, 500,
+        ))
+        self.get_success(self.store.store_server_resolution(
+            "srv", "_matrix._tcp.example.com", [["target", 8448, 0, 0]], 1000,
+        ))
+        self.get_success(self.store.store_server_resolution(
+            "well_known", "example.com", "new.example.com", 2000,
+        ))
+
+        r = self.get_success(self.store.get_server_resolutions("well_known", 0))
+        self.assertEqual(sorted(r), [
+            ("example.com", "new.example.com", 2000),
+            ("other.example.com", None, 500),
+        ])
+
+        r = self.get_success(self.store.get_server_resolutions("well_known", 1000))
+        self.assertEqual(r, [("example.com", "new.example.com", 2000)])
+
+        r = self.get_success(self.store.get_server_resolutions("srv", 0))
+        self.assertEqual(r, [
+            ("_matrix._tcp.example.com", [["target", 8448, 0, 0]], 1000),
+        ])
+
+    def test_old_server_resolutions_pruned(self):
+        """Tests that results which are too old to be used are deleted."""
+        self.reactor.advance(SERVER_RESOLUTION_MAX_STALE_MS / 1000.)
+        now = self.clock.time_msec()
+        too_old_ts = now - SERVER_RESOLUTION_MAX_STALE_MS - 1
+
+        self.get_success(self.store.store_server_resolution(
+            "well_known", "old.example.com", None, too_old_ts,
+        ))
+        self.get_success(self.store.store_server_resolution(
+            "well_known", "stale.example.com", "target.example.com", now - 1,
+        ))
+
+        self.get_success(self.store._cleanup_transactions())
+
+        r = self.get_success(self.store.get_server_resolutions("well_known", 0))
+        self.assertEqual(r, [("stale.example.com", "target.example.com", now - 1)])
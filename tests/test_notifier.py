@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from tests.unittest import HomeserverTestCase
+
+ROOM_ID = "!room:test"
+
+
+class CoalescedWakeupsTestCase(HomeserverTestCase):
+
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.notifier_wakeup_coalesce_ms = 100
+        config.notifier_wakeup_batch_size = 2
+
+        hs = self.setup_test_homeserver(config=config, http_client=None)
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.notifier = hs.get_notifier()
+        self.start_token = self.get_success(
+            hs.get_event_sources().get_current_token()
+        )
+
+    def _wait_for_events(self, user_id, calls):
+        """Start waiting for events in ROOM_ID, recording the tokens each
+        wakeup is called with.
+        """
+        def callback(before_token, after_token):
+            calls.append(after_token)
+            return defer.succeed(True)
+
+        return self.notifier.wait_for_events(
+            user_id, 10000, callback, room_ids=[ROOM_ID],
+            from_token=self.start_token,
+        )
+
+    def test_wakeups_are_coalesced_and_batched(self):
+        calls = {}
+        for i in range(5):
+            user_id = "@user%d:test" % (i,)
+            calls[user_id] = []
+            self._wait_for_events(user_id, calls[user_id])
+
+        self.notifier.on_new_event("typing_key", 1, rooms=[ROOM_ID])
+        self.notifier.on_new_event("typing_key", 2, rooms=[ROOM_ID])
+
+        # nobody is woken up until the window has passed
+        self.assertEqual(sum(len(c) for c in calls.values()), 0)
+
+        # the streams have been advanced, even though they've not been woken
+        for user_id in calls:
+            stream = self.notifier.user_to_user_stream[user_id]
+            self.assertEqual(stream.current_token.typing_key, 2)
+
+        # each call wakes up at most one batch of streams...
+        self.notifier._wake_pending_streams()
+        self.assertEqual(sum(len(c) for c in calls.values()), 2)
+        self.assertEqual(len(self.notifier._pending_wakeups), 3)
+
+        # ... and the rest are woken up on later reactor iterations, each
+        # exactly once with the latest token.
+        self.reactor.advance(0.1)
+        for user_calls in calls.values():
+            self.assertEqual(len(user_calls), 1)
+            self.assertEqual(user_calls[0].typing_key, 2)
+
+        self.assertEqual(len(self.notifier._pending_wakeups), 0)
+        self.assertFalse(self.notifier._wakeup_scheduled)
+
+    def test_new_listener_sees_pending_token(self):
+        """A listener which starts waiting after a stream has been advanced
+        but before it has been woken returns immediately.
+        """
+        first_calls = []
+        self._wait_for_events("@user:test", first_calls)
+
+        self.notifier.on_new_event("typing_key", 1, rooms=[ROOM_ID])
+        self.assertEqual(first_calls, [])
+
+        self.reactor.advance(0.1)
+        self.assertEqual(len(first_calls), 1)
+
+        self.notifier.on_new_event("typing_key", 2, rooms=[ROOM_ID])
+
+        stream = self.notifier.user_to_user_stream["@user:test"]
+        listener = stream.new_listener(first_calls[0])
+        self.assertEqual(self.successResultOf(listener.deferred).typing_key, 2)
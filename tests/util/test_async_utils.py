@@ -12,13 +12,19 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from twisted.internet import defer
+import threading
+
+from twisted.internet import defer, reactor
 from twisted.internet.defer import CancelledError, Deferred
 from twisted.internet.task import Clock
 
 from synapse.util import logcontext
-from synapse.util.async_helpers import timeout_deferred
-from synapse.util.logcontext import LoggingContext
+from synapse.util.async_helpers import ThreadedBatcher, timeout_deferred
+from synapse.util.logcontext import (
+    LoggingContext,
+    make_deferred_yieldable,
+    run_in_background,
+)
 
 from tests.unittest import TestCase
 
@@ -102,3 +108,44 @@ class TimeoutDeferredTest(TestCase):
             )
             self.failureResultOf(timing_out_d, defer.TimeoutError, )
             self.assertIs(LoggingContext.current_context(), context_one)
+
+
+class ThreadedBatcherTest(TestCase):
+    @defer.inlineCallbacks
+    def test_calls_batched_in_thread(self):
+        threads = []
+
+        def double(x):
+            threads.append(threading.current_thread())
+            return x * 2
+
+        batcher = ThreadedBatcher(reactor, double)
+
+        with LoggingContext("test") as context:
+            results = yield make_deferred_yieldable(defer.gatherResults([
+                run_in_background(batcher.submit, x) for x in range(5)
+            ]))
+            self.assertIs(LoggingContext.current_context(), context)
+
+        self.assertEqual(results, [0, 2, 4, 6, 8])
+
+        # all of the calls were made by the same job in the thread pool
+        self.assertEqual(len(set(threads)), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    @defer.inlineCallbacks
+    def test_failures_passed_on(self):
+        def check(x):
+            if x < 0:
+                raise ValueError(x)
+            return x
+
+        batcher = ThreadedBatcher(reactor, check)
+
+        with LoggingContext("test"):
+            d1 = run_in_background(batcher.submit, 1)
+            d2 = run_in_background(batcher.submit, -1)
+
+            self.assertEqual((yield make_deferred_yieldable(d1)), 1)
+            with self.assertRaises(ValueError):
+                yield make_deferred_yieldable(d2)
@@ -3,6 +3,7 @@ from twisted.internet import defer, reactor
 
 from synapse.util import Clock, logcontext
 from synapse.util.logcontext import LoggingContext
+from synapse.util.metrics import Measure
 
 from .. import unittest
 
@@ -164,6 +165,42 @@ class LoggingContextTestCase(unittest.TestCase):
             nested_context = logcontext.nested_logging_context(suffix="bar")
             self.assertEqual(nested_context.request, "foo-bar")
 
+    def test_measure_records_phase(self):
+        clock = Clock(reactor)
+        with LoggingContext() as context:
+            with Measure(clock, "phase_one"):
+                context.add_database_transaction(0.5)
+                context.record_event_fetch(3)
+            with Measure(clock, "phase_one"):
+                pass
+            with Measure(clock, "phase_two"):
+                context.add_database_transaction(0.5)
+
+            phase_usage = context.get_phase_usage()
+
+        self.assertEqual(set(phase_usage), {"phase_one", "phase_two"})
+        self.assertEqual(phase_usage["phase_one"].count, 2)
+        self.assertEqual(phase_usage["phase_one"].resource_usage.db_txn_count, 1)
+        self.assertEqual(
+            phase_usage["phase_one"].resource_usage.evt_db_fetch_count, 3,
+        )
+        self.assertEqual(phase_usage["phase_two"].count, 1)
+
+    def test_phase_usage_passed_to_parent(self):
+        with LoggingContext() as parent_context:
+            with LoggingContext(parent_context=parent_context) as child_context:
+                child_context.record_phase(
+                    "phase", 1.5, child_context.get_resource_usage(),
+                )
+            parent_context.record_phase(
+                "phase", 0.5, parent_context.get_resource_usage(),
+            )
+
+            phase_usage = parent_context.get_phase_usage()
+
+        self.assertEqual(phase_usage["phase"].count, 2)
+        self.assertEqual(phase_usage["phase"].real_time_sec, 2)
+
 
 # a function which returns a deferred which has been "called", but
 # which had a function which returned another incomplete deferred on
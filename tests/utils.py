@@ -133,6 +133,7 @@ def default_config(name):
     config.password_providers = []
     config.worker_replication_url = ""
     config.worker_app = None
+    config.worker_name = None
     config.email_enable_notifs = False
     config.block_non_admin_invites = False
     config.federation_domain_whitelist = None
@@ -141,6 +142,20 @@ def default_config(name):
     config.federation_rc_sleep_delay = 100
     config.federation_rc_concurrent = 10
     config.filter_timeline_limit = 5000
+    config.notifier_wakeup_coalesce_ms = 0
+    config.notifier_wakeup_batch_size = 1000
+    config.push_notif_rotation_chunk_size = 0
+    config.push_notif_rotation_interval_ms = 10000
+    config.push_gateway_max_concurrent_requests = 50
+    config.push_gateway_batch_window_ms = 0
+    config.worker_pusher_shard_count = 1
+    config.worker_pusher_shard_index = 0
+    config.worker_federation_sender_shard_count = 1
+    config.federation_transaction_max_in_flight = 1
+    config.federation_max_idle_connections_per_host = 5
+    config.federation_idle_connection_timeout_ms = 2 * 60 * 1000
+    config.partial_state_joins = False
+    config.worker_federation_sender_shard_index = 0
     config.user_directory_search_all_users = False
     config.user_consent_server_notice_content = None
     config.block_events_without_consent_error = None